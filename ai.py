@@ -0,0 +1,167 @@
+import random
+
+import engines
+from game import WINDOW_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_SIZE, TICK_RATE, BALL_MAX_Y, BALL_RIGHT_CONTACT_X
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Computer-controlled paddles. A room's paddles that nobody plays belong to bots, the free one
+# in a single-player match and both in a bot match (server.py --bots). The server's AIService
+# moves every bot in every room in one batched pass, once per TICK_RATE of simulation time
+# like a player at 60 FPS: it predicts where the ball will meet each bot's paddle face, wall
+# bounces included, and moves the paddle towards that point. With numpy the prediction is done
+# with whole-array operations over all the bots looking at the ball, reading the balls straight
+# from the numpy engine's arrays when the server runs it, and without numpy in a loop.
+#
+# How well a bot plays is its difficulty:
+#   reaction   seconds between looks at the ball, in between it heads for where it last aimed
+#   error      pixels of aim error, random with this deviation when the ball is a whole court away
+#              and shrinking as it comes closer
+#   speed      share of the moves a player could make that the bot makes
+#   dead_zone  pixels off its aim the bot accepts before moving, more than half a paddle
+#              move (PADDLE_SPEED) or it would jitter around its aim
+
+DIFFICULTIES = {
+    "easy": {"reaction": 0.35, "error": 90.0, "speed": 0.55, "dead_zone": 12},
+    "normal": {"reaction": 0.2, "error": 45.0, "speed": 0.8, "dead_zone": 10},
+    "hard": {"reaction": 0.1, "error": 15.0, "speed": 1.0, "dead_zone": 8},
+}
+DEFAULT_DIFFICULTY = "normal"
+BOT_RESTART_DELAY = 3.0  # Seconds a finished bot match shows its winner before the bots start another
+VECTOR_MIN_BOTS = 128  # Fewer bots looking at once are predicted in a loop, numpy's overhead isn't worth it
+COURT_LENGTH = BALL_RIGHT_CONTACT_X - PADDLE_WIDTH  # Distance between the two paddle faces
+
+
+class Bot:
+    # One computer-controlled paddle
+    def __init__(self, room, player, difficulty=DEFAULT_DIFFICULTY, rng=random):
+        self.room = room
+        self.player = player
+        self.difficulty = difficulty
+        self.settings = DIFFICULTIES[difficulty]
+        self.face_x = PADDLE_WIDTH if player == 1 else BALL_RIGHT_CONTACT_X  # Where the ball meets the paddle
+        self.time = 0.0  # Simulation time not moved for yet
+        self.look_time = rng.uniform(0, self.settings["reaction"])  # Until the next look, spread so bots don't all look at once
+        self.aim = WINDOW_HEIGHT / 2  # Paddle centre it's heading for
+        self.move_credit = 0.0  # Moves earned at the difficulty's speed and not made yet
+        self.finished_time = 0.0  # How long the match has been over, bot matches restart themselves
+
+
+def predict_intercept(x, y, velocity_x, velocity_y, face_x):
+    # Ball y when it reaches face_x, its path folded back at the walls, or None if it's moving away
+    if velocity_x == 0 or (face_x - x) * velocity_x < 0:
+        return None
+    y = (y + velocity_y * (face_x - x) / velocity_x) % (2 * BALL_MAX_Y)
+    return y if y <= BALL_MAX_Y else 2 * BALL_MAX_Y - y
+
+
+def predict_intercepts(x, y, velocity_x, velocity_y, face_x):
+    # predict_intercept over arrays, NaN where the ball is moving away
+    distance = face_x - x
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.mod(y + velocity_y * distance / velocity_x, 2 * BALL_MAX_Y)
+    y = np.where(y <= BALL_MAX_Y, y, 2 * BALL_MAX_Y - y)
+    return np.where(distance * velocity_x > 0, y, np.nan)
+
+
+class AIService:
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.use_numpy = np is not None
+        self.vector_min_bots = VECTOR_MIN_BOTS
+        self.decisions = 0  # Bot decisions since start
+        self.looks = 0  # Of which the bot looked at the ball and aimed again
+
+    def new_bot(self, room, player, difficulty=DEFAULT_DIFFICULTY):
+        return Bot(room, player, difficulty, self.rng)
+
+    def update(self, rooms, dt):
+        # Advance every bot in rooms by dt of simulation time, making the moves that come due
+        due = []
+        for room in rooms:
+            for bot in room.bots.values():
+                bot.time += dt
+                if bot.time >= TICK_RATE - 1e-9:  # A little slack for float rounding
+                    due.append(bot)
+        while due:
+            playing = []
+            for bot in due:
+                bot.time -= TICK_RATE
+                game = bot.room.game
+                if game.game_active:
+                    playing.append(bot)
+                elif game.winner and bot.room.bot_match and bot.player == 1:
+                    # Nobody is there to press R, the bots start another match after a while
+                    bot.finished_time += TICK_RATE
+                    if bot.finished_time >= BOT_RESTART_DELAY:
+                        bot.finished_time = 0.0
+                        bot.room.restart()
+            if playing:
+                self.decide(playing)
+            due = [bot for bot in due if bot.time >= TICK_RATE - 1e-9]
+
+    def decide(self, bots):
+        self.decisions += len(bots)
+        looking = []
+        for bot in bots:
+            bot.look_time -= TICK_RATE
+            if bot.look_time <= 0:
+                bot.look_time += bot.settings["reaction"]
+                looking.append(bot)
+        if looking:
+            self.looks += len(looking)
+            self.aim(looking)
+
+        # Move towards the aim, as fast as the difficulty allows
+        for bot in bots:
+            settings = bot.settings
+            bot.move_credit = min(1.0, bot.move_credit + settings["speed"])
+            if bot.move_credit < 1.0:
+                continue
+            game = bot.room.game
+            paddle_center = (game.player1_y if bot.player == 1 else game.player2_y) + PADDLE_HEIGHT // 2
+            if paddle_center < bot.aim - settings["dead_zone"]:
+                bot.room.move_paddle(bot.player, "down")
+            elif paddle_center > bot.aim + settings["dead_zone"]:
+                bot.room.move_paddle(bot.player, "up")
+            else:
+                continue
+            bot.move_credit -= 1.0
+
+    def aim(self, bots):
+        # Predict where the ball meets each bot's paddle and aim the paddle centre there, give or
+        # take the difficulty's error. With the ball going away the bot heads back to the middle.
+        games = [bot.room.game for bot in bots]
+        if self.use_numpy and len(bots) >= self.vector_min_bots:
+            if isinstance(games[0], engines.NumpyGame):
+                # Every game of a server lives in the same engine, index its arrays
+                arrays = games[0].engine.arrays
+                index = np.fromiter((game.index for game in games), np.intp, len(games))
+                x = arrays["ball_x"][index]
+                y = arrays["ball_y"][index]
+                velocity_x = arrays["ball_velocity_x"][index]
+                velocity_y = arrays["ball_velocity_y"][index]
+            else:
+                x = np.fromiter((game.ball_x for game in games), float, len(games))
+                y = np.fromiter((game.ball_y for game in games), float, len(games))
+                velocity_x = np.fromiter((game.ball_velocity_x for game in games), float, len(games))
+                velocity_y = np.fromiter((game.ball_velocity_y for game in games), float, len(games))
+            face_x = np.fromiter((bot.face_x for bot in bots), float, len(bots))
+            intercepts = predict_intercepts(x, y, velocity_x, velocity_y, face_x)
+            closeness = np.minimum(1.0, np.abs(face_x - x) / COURT_LENGTH)
+            errors = np.fromiter((self.rng.gauss(0.0, bot.settings["error"]) for bot in bots), float, len(bots))
+            aims = np.where(np.isnan(intercepts), WINDOW_HEIGHT / 2, intercepts + BALL_SIZE / 2 + errors * closeness)
+            for bot, aim in zip(bots, aims.tolist()):
+                bot.aim = aim
+            return
+        for bot, game in zip(bots, games):
+            intercept = predict_intercept(game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y,
+                                          bot.face_x)
+            error = self.rng.gauss(0.0, bot.settings["error"])
+            if intercept is None:
+                bot.aim = WINDOW_HEIGHT / 2
+            else:
+                bot.aim = intercept + BALL_SIZE / 2 + error * min(1.0, abs(bot.face_x - game.ball_x) / COURT_LENGTH)
@@ -0,0 +1,959 @@
+import argparse
+import array
+import collections
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import ai
+import bot
+import broadcast
+import engines
+import protocol
+import results
+import server
+from game import (WINDOW_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_SIZE, BALL_RIGHT_CONTACT_X, WINNING_SCORE,
+                  move_paddle_y)
+from server import PongGame, Room, TICK_RATE
+
+# Benchmark settings
+BENCH_TICKS = 120  # Ticks measured per room count
+LAG_REACH = (40, 400)  # Pixels from the paddle a lagged player starts reacting to the ball, random per approach
+
+
+def make_rooms(count, engine):
+    rooms = []
+    ai_service = ai.AIService(0)
+    for room_id in range(count):
+        room = Room(room_id, engine.new_game(), ai_service=ai_service)
+        # One seated player keeps the AI paddle moving, like a single-player match
+        room.players[1] = None
+        room.seat_bots()
+        room.game.game_active = True
+        rooms.append(room)
+    return rooms
+
+
+def keep_playing(game):
+    # Skip the countdown after a point so every game keeps simulating
+    if not game.game_active:
+        if game.winner:
+            game.restart_game()
+        game.game_active = True
+
+
+def time_ticks(engine, rooms, ticks=BENCH_TICKS):
+    # Step every room and encode its outgoing delta, the same work the server loop does per tick
+    durations = []
+    for _ in range(ticks):
+        start = time.perf_counter()
+        server.advance_rooms(engine, rooms[0].ai, rooms, TICK_RATE)
+        for room in rooms:
+            room.record_snapshot()
+            protocol.encode_delta(room.snapshot_seq, room.snapshot(room.snapshot_seq),
+                                  room.snapshot_seq - 1, room.snapshot(room.snapshot_seq - 1))
+            keep_playing(room.game)
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return durations
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def bench_rooms(args):
+    budget = TICK_RATE
+    print(f"Tick budget: {budget * 1000:.2f} ms ({1 / budget:.0f} Hz), p99 must fit")
+
+    # Double the room count until a tick no longer fits, then bisect between the last two counts
+    low, high = 0, args.start
+    while True:
+        engine = engines.create_engine(args.engine)
+        durations = time_ticks(engine, make_rooms(high, engine))
+        p99 = percentile(durations, 0.99)
+        print(f"{high:6d} rooms: p50 {percentile(durations, 0.5) * 1000:7.3f} ms, p99 {p99 * 1000:7.3f} ms")
+        if p99 > budget:
+            break
+        low, high = high, high * 2
+
+    while high - low > max(1, low // 50):
+        middle = (low + high) // 2
+        engine = engines.create_engine(args.engine)
+        durations = time_ticks(engine, make_rooms(middle, engine))
+        p99 = percentile(durations, 0.99)
+        print(f"{middle:6d} rooms: p50 {percentile(durations, 0.5) * 1000:7.3f} ms, p99 {p99 * 1000:7.3f} ms")
+        if p99 > budget:
+            high = middle
+        else:
+            low = middle
+
+    print(f"Max rooms ticked at {1 / budget:.0f} Hz on one core with the {args.engine} engine: {low}")
+
+
+def play_games(engine_name, count, steps, seed):
+    # Deterministic matches: same seed, same creation order and the same paddle moves
+    random.seed(seed)
+    engine = engines.create_engine(engine_name)
+    games = [engine.new_game() for _ in range(count)]
+    for game in games:
+        game.game_active = True
+    for step in range(steps):
+        engine.step(TICK_RATE)
+        for number, game in enumerate(games):
+            # Follow the ball, badly for every third game so points get scored
+            target = game.ball_y - PADDLE_HEIGHT // 2 + (60 if number % 3 == 0 else 0)
+            game.move_paddle(1 + step % 2, "down" if (game.player1_y if step % 2 == 0 else game.player2_y) < target else "up")
+            keep_playing(game)
+    return [protocol.state_values(game) + (game.ball_velocity_x, game.ball_velocity_y) for game in games]
+
+
+def bench_engines(args):
+    names = [name for name in engines.ENGINES if name != "scalar"]
+    reference = play_games("scalar", args.verify_games, args.verify_steps, args.seed)
+    for name in names:
+        result = play_games(name, args.verify_games, args.verify_steps, args.seed)
+        mismatches = sum(1 for expected, actual in zip(reference, result) if expected != actual)
+        print(f"{name}: {mismatches} of {args.verify_games} games differ from scalar after {args.verify_steps} steps")
+
+    for count in args.games:
+        line = f"{count:6d} games:"
+        for name in ["scalar"] + names:
+            engine = engines.create_engine(name)
+            games = [engine.new_game() for _ in range(count)]
+            for game in games:
+                game.game_active = True
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                engine.step(TICK_RATE)
+            per_step = (time.perf_counter() - start) / args.steps
+            line += f"  {name} {per_step * 1000:8.3f} ms/step"
+        print(line)
+
+
+def bench_protocol(args):
+    game = PongGame()
+    game.game_active = True
+    for _ in range(37):
+        game.update()
+    decoder = json.JSONDecoder()
+
+    def run(label, encode, decode):
+        encoded = encode()
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            encode()
+        encode_time = (time.perf_counter() - start) / args.iterations
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            decode(encoded)
+        decode_time = (time.perf_counter() - start) / args.iterations
+        print(f"{label:6s} {len(encoded):4d} bytes/state, encode {encode_time * 1e6:6.2f} us, decode {decode_time * 1e6:6.2f} us")
+        return len(encoded), encode_time, decode_time
+
+    json_result = run("json", lambda: json.dumps(game.get_state()).encode(),
+                      lambda data: decoder.decode(data.decode()))
+    header = protocol.FRAME_HEADER.size + 1
+    baseline = protocol.state_values(game)
+    baselines = {1: baseline}
+    game.update()  # Only the ball moves between baseline and current state, the common case
+    binary_result = run("full", lambda: protocol.encode_snapshot(2, protocol.state_values(game)),
+                        lambda data: protocol.state_dict(protocol.decode_snapshot(data[header:])[1]))
+    delta_result = run("delta", lambda: protocol.encode_delta(2, protocol.state_values(game), 1, baseline),
+                       lambda data: protocol.state_dict(protocol.decode_delta(data[header:], baselines)[1]))
+    for label, result in (("full", binary_result), ("delta", delta_result)):
+        print(f"{label} vs json: {json_result[0] / result[0]:.1f}x fewer bytes, "
+              f"{json_result[1] / result[1]:.1f}x faster encode, {json_result[2] / result[2]:.1f}x faster decode")
+
+
+def legacy_json_latest(chunks):
+    # The brace-counting parser PongClient.receive_game_state used before JsonStreamDecoder, kept to compare against
+    buffer = ""
+    latest = None
+    for data in chunks:
+        buffer += data.decode()
+        while True:
+            obj_start = buffer.find("{")
+            if obj_start == -1:
+                buffer = ""
+                break
+            brace_count = 0
+            obj_end = -1
+            for i in range(obj_start, len(buffer)):
+                if buffer[i] == '{':
+                    brace_count += 1
+                elif buffer[i] == '}':
+                    brace_count -= 1
+                    if brace_count == 0:
+                        obj_end = i
+                        break
+            if obj_end == -1:
+                break
+            latest = json.loads(buffer[obj_start:obj_end + 1])
+            buffer = buffer[obj_end + 1:]
+    return latest
+
+
+def stream_json_latest(chunks):
+    decoder = protocol.JsonStreamDecoder()
+    latest = None
+    for data in chunks:
+        decoder.feed(data)
+        state = decoder.latest()
+        if state is not None:
+            latest = state
+    return latest
+
+
+def binary_all_states(chunks, baselines):
+    # Decoding every state in the backlog, what skipping superseded frames avoids
+    decoder = protocol.FrameDecoder()
+    snapshots = dict(baselines)
+    latest = None
+    for data in chunks:
+        decoder.feed(data)
+        for msg_type, body in decoder.frames():
+            seq, values = protocol.decode_snapshot(body) if msg_type == protocol.MSG_SNAPSHOT else protocol.decode_delta(body, snapshots)
+            snapshots[seq] = values
+            latest = protocol.state_dict(values)
+    return latest
+
+
+def binary_latest_state(chunks, baselines):
+    # As PongClient does: of the states in a read only the newest is decoded, the server bases
+    # deltas on acked snapshots only so it never refers to one that was skipped
+    decoder = protocol.FrameDecoder()
+    snapshots = dict(baselines)
+    latest = None
+    for data in chunks:
+        decoder.feed(data)
+        for msg_type, body in decoder.frames(latest_only=protocol.STATE_MESSAGES):
+            seq, values = protocol.decode_snapshot(body) if msg_type == protocol.MSG_SNAPSHOT else protocol.decode_delta(body, snapshots)
+            if values is not None:
+                snapshots[seq] = values
+                latest = protocol.state_dict(values)
+    return latest
+
+
+def backlog_streams(count):
+    # count states of a live game, as JSON and as the server sends them to a client that stopped
+    # acknowledging: deltas against the last acked snapshot 1 while the room still keeps it, full
+    # snapshots after that
+    random.seed(1)
+    game = PongGame()
+    baselines = {1: protocol.state_values(game)}
+    json_stream = b""
+    binary_stream = b""
+    for seq in range(2, count + 2):
+        game.step(TICK_RATE)
+        keep_playing(game)
+        json_stream += json.dumps(game.get_state()).encode()
+        values = protocol.state_values(game)
+        if seq - 1 < min(server.SNAPSHOT_HISTORY, protocol.MAX_BASELINE_AGE + 1):
+            binary_stream += protocol.encode_delta(seq, values, 1, baselines[1])
+        else:
+            binary_stream += protocol.encode_snapshot(seq, values)
+    return json_stream, binary_stream, baselines
+
+
+def bench_parser(args):
+    for count in args.states:
+        json_stream, binary_stream, baselines = backlog_streams(count)
+        for chunk_size in args.chunk_sizes:
+            line = f"{count:6d} states backlogged, {chunk_size:6d} byte reads:"
+            results = []
+            for label, parse, stream in (("legacy json", legacy_json_latest, json_stream),
+                                         ("stream json", stream_json_latest, json_stream),
+                                         ("bin all", lambda chunks: binary_all_states(chunks, baselines), binary_stream),
+                                         ("bin latest", lambda chunks: binary_latest_state(chunks, baselines), binary_stream)):
+                chunks = [stream[offset:offset + chunk_size] for offset in range(0, len(stream), chunk_size)]
+                start = time.perf_counter()
+                results.append(parse(chunks))
+                line += f"  {label} {(time.perf_counter() - start) * 1000:8.2f} ms"
+            print(line)
+
+            # Every decoder has to end on the same newest state (binary positions are float32)
+            for state in results[1:]:
+                assert state["score"] == results[0]["score"]
+                assert abs(state["ball"]["x"] - results[0]["ball"]["x"]) < 0.01
+
+
+def run_bot_process(port, clients, duration, connection):
+    summary = bot.run_bots("127.0.0.1", port, clients, duration, on_ready=lambda: connection.send("ready"))
+    connection.send(summary)
+
+
+def milliseconds(sorted_values, fraction):
+    return percentile(sorted_values, fraction) * 1000 if sorted_values else 0.0
+
+
+def measure_allocations(rooms, ticks, warmup, protocol_name=protocol.BINARY_PROTOCOL, engine="scalar"):
+    # Memory allocated by steady-state ticks: every room steps and sends each of its two clients
+    # their state over a real socket, and the clients drain into a preallocated buffer. Returns the
+    # bytes the ticks kept, each tick's peak above its start and the lines that grew the most.
+    random.seed(1)
+    game_server = server.PongServer("127.0.0.1", 0, engine=engine)
+    listener = socket.create_server(("127.0.0.1", 0))
+    peers = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(rooms * 2):
+            peer = socket.create_connection(listener.getsockname())
+            connection, address = listener.accept()
+            game_server.add_client(connection, address)
+            peer.setblocking(False)
+            peers.append(peer)
+    listener.close()
+    for client in game_server.clients:
+        client.protocol = protocol_name
+    drain = bytearray(65536)
+
+    def run_ticks(count):
+        for _ in range(count):
+            game_server.step_rooms(game_server.physics_dt)
+            for room in game_server.rooms.values():
+                keep_playing(room.game)
+            game_server.send_snapshots()
+            for client in game_server.clients:
+                client.acked_seq = client.room.snapshot_seq  # As if every client acknowledged right away
+            for peer in peers:
+                try:
+                    while peer.recv_into(drain):
+                        pass
+                except BlockingIOError:
+                    pass
+
+    # Trace the warm-up too, so what the measured ticks free is traced like what they allocate
+    tracemalloc.start()
+    run_ticks(warmup)
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    peaks = array.array("q", [0]) * ticks  # Not a list, its int objects would count as kept
+    start_size = tracemalloc.get_traced_memory()[0]
+    for tick in range(ticks):
+        tracemalloc.reset_peak()
+        tick_start_size = tracemalloc.get_traced_memory()[0]
+        run_ticks(1)
+        peaks[tick] = tracemalloc.get_traced_memory()[1] - tick_start_size
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - start_size
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    for peer in peers:
+        peer.close()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for client in list(game_server.clients):
+            game_server.remove_client(client)
+
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    growth = [stat for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+              if stat.size_diff > 0]
+    return retained, sorted(peaks), growth
+
+
+def bench_allocations(args):
+    retained, peaks, growth = measure_allocations(args.rooms, args.ticks, args.warmup, args.protocol, args.engine)
+    print(f"{args.rooms} rooms, {args.rooms * 2} {args.protocol} clients, {args.ticks} ticks after {args.warmup} warm-up ticks")
+    print(f"retained        {retained} bytes in total, {retained / args.ticks:.1f} bytes per tick")
+    print(f"peak per tick   p50 {percentile(peaks, 0.5)} bytes, max {peaks[-1]} bytes above the start of the tick")
+    for stat in growth[:5]:
+        print(f"  {stat.size_diff:+7d} bytes {stat.count_diff:+5d} blocks  {stat.traceback}")
+    if retained / args.ticks > args.limit:
+        print(f"A tick keeps more than {args.limit} bytes")
+        sys.exit(1)
+
+
+def bench_load(args):
+    # Server in this process, bots in another so this process's CPU time is the server's
+    game_server = server.PongServer("127.0.0.1", 0, args.max_rooms, args.physics_rate, args.snapshot_rate, args.engine)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        server_thread = threading.Thread(target=game_server.start, daemon=True)
+        server_thread.start()
+        while not game_server.running:
+            time.sleep(0.01)
+        port = game_server.server_socket.getsockname()[1]
+
+        connection, child_connection = multiprocessing.Pipe()
+        bots = multiprocessing.Process(target=run_bot_process, args=(port, args.clients, args.duration, child_connection))
+        bots.start()
+        connection.recv()  # All bots connected
+        rooms = len(game_server.rooms)
+
+        # Measure from here, the connection burst isn't steady state
+        game_server.step_times.clear()
+        game_server.send_times.clear()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        summary = connection.recv()
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+
+        bots.join()
+        game_server.stop()
+        server_thread.join()
+
+    step_times = sorted(game_server.step_times)
+    send_times = sorted(game_server.send_times)
+    latencies = summary["input_latencies"]
+    print(f"{summary['bots']} clients in {rooms} rooms for {wall_seconds:.1f} s, "
+          f"{1 / game_server.physics_dt:.0f} Hz physics, "
+          f"{1 / game_server.snapshot_interval:.0f} Hz snapshots, {args.engine} engine")
+    print(f"step time       p50 {milliseconds(step_times, 0.5):7.3f} ms  p90 {milliseconds(step_times, 0.9):7.3f} ms  "
+          f"p99 {milliseconds(step_times, 0.99):7.3f} ms  max {milliseconds(step_times, 1):7.3f} ms  "
+          f"(budget {game_server.physics_dt * 1000:.2f} ms)")
+    print(f"snapshot send   p50 {milliseconds(send_times, 0.5):7.3f} ms  p99 {milliseconds(send_times, 0.99):7.3f} ms  "
+          f"per client p50 {milliseconds(send_times, 0.5) * 1000 / max(1, summary['bots']):.2f} us")
+    print(f"input ack       p50 {milliseconds(latencies, 0.5):7.3f} ms  p99 {milliseconds(latencies, 0.99):7.3f} ms")
+    print(f"per client      {summary['bytes_in_per_client']:.0f} B/s in, {summary['bytes_out_per_client']:.0f} B/s out, "
+          f"{summary['snapshots_per_client']:.1f} snapshots/s, {summary['full_snapshots']} full snapshots in total")
+    print(f"server CPU      {cpu_seconds / wall_seconds * 100:.1f}% of a core, "
+          f"{cpu_seconds / wall_seconds / max(1, rooms) * 1000:.3f} ms CPU per match per second")
+    if summary["disconnected"]:
+        print(f"{summary['disconnected']} client(s) were disconnected")
+
+
+def run_viewer_process(port, viewers, duration, connection):
+    # Spectators all watching the same match, reading as fast as they can
+    selector = selectors.DefaultSelector()
+    sockets = []
+    for _ in range(viewers):
+        viewer = socket.create_connection(("127.0.0.1", port))
+        viewer.sendall(json.dumps({"watch": None}).encode())
+        viewer.setblocking(False)
+        selector.register(viewer, selectors.EVENT_READ)
+        sockets.append(viewer)
+    connection.send("ready")
+    received = 0
+    closed = 0
+    drain = bytearray(65536)
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for key, _ in selector.select(0.1):
+            try:
+                count = key.fileobj.recv_into(drain)
+            except OSError:
+                count = 0
+            if not count:
+                selector.unregister(key.fileobj)
+                closed += 1
+            received += count
+    for viewer in sockets:
+        viewer.close()
+    connection.send({"bytes": received, "closed": closed})
+
+
+def bench_spectators(args):
+    # Player step times and input latency without spectators and then with them all on one match
+    print(f"{args.clients} players, {args.viewers} spectators on one match at {args.spectator_rate} Hz, "
+          f"{args.duration:.0f} s per run")
+    for viewers in (0, args.viewers):
+        game_server = server.PongServer("127.0.0.1", 0, spectator_port=0, spectator_rate=args.spectator_rate)
+        with contextlib.redirect_stdout(io.StringIO()):
+            server_thread = threading.Thread(target=game_server.start, daemon=True)
+            server_thread.start()
+            while not game_server.running:
+                time.sleep(0.01)
+            port = game_server.server_socket.getsockname()[1]
+            spectator_port = game_server.broadcaster.socket.getsockname()[1]
+
+            bot_connection, child_connection = multiprocessing.Pipe()
+            bots = multiprocessing.Process(target=run_bot_process,
+                                           args=(port, args.clients, args.duration + 1, child_connection))
+            bots.start()
+            bot_connection.recv()
+            viewer_connection, child_connection = multiprocessing.Pipe()
+            viewer_process = multiprocessing.Process(target=run_viewer_process,
+                                                     args=(spectator_port, viewers, args.duration, child_connection))
+            viewer_process.start()
+            viewer_connection.recv()
+
+            game_server.step_times.clear()
+            start = time.perf_counter()
+            viewer_summary = viewer_connection.recv()
+            elapsed = time.perf_counter() - start
+            summary = bot_connection.recv()
+            bots.join()
+            viewer_process.join()
+            game_server.stop()
+            server_thread.join()
+
+        step_times = sorted(game_server.step_times)
+        latencies = summary["input_latencies"]
+        print(f"{viewers:5d} spectators  step p99 {milliseconds(step_times, 0.99):6.3f} ms  "
+              f"max {milliseconds(step_times, 1):6.3f} ms  input ack p50 {milliseconds(latencies, 0.5):6.2f} ms  "
+              f"p99 {milliseconds(latencies, 0.99):6.2f} ms", end="")
+        if viewers:
+            print(f"  {viewer_summary['bytes'] / viewers / elapsed:.0f} B/s per spectator, "
+                  f"{game_server.broadcaster.dropped} dropped, {game_server.skipped_broadcasts} rounds skipped")
+        else:
+            print()
+
+
+def play_bot_match(engine, ai_service, difficulties, seed):
+    # A whole match between two bots, stepped headless as fast as it goes. Returns the winner.
+    room = Room(seed, engine.new_game(seed), ai_service=ai_service, bot_match=True)
+    for player, difficulty in enumerate(difficulties, 1):
+        room.bots[player] = ai_service.new_bot(room, player, difficulty)
+    room.start_countdown(0)
+    while not room.game.winner:
+        server.advance_rooms(engine, ai_service, (room,), TICK_RATE)
+    engine.remove_game(room.game)
+    return room.game.winner
+
+
+def bench_bots(args):
+    # The AI pass on its own, then bots against each other, then a server full of bot matches
+    ai_service = ai.AIService(args.seed)
+    engine = engines.create_engine(args.engine)
+    rooms = [Room(room_id, engine.new_game(room_id), ai_service=ai_service, bot_match=True)
+             for room_id in range(args.matches)]
+    for room in rooms:
+        room.game.game_active = True
+        room.game.countdown_timer = None
+
+    # Loop and numpy predictions agree, on the rooms as they are mid-rally
+    bots = [bot for room in rooms for bot in room.bots.values()]
+    if ai.np is not None:
+        engine.step(TICK_RATE)
+        ai_service.rng.seed(args.seed)
+        ai_service.use_numpy = False
+        ai_service.aim(bots)
+        looped = [bot.aim for bot in bots]
+        ai_service.rng.seed(args.seed)
+        ai_service.use_numpy = True
+        ai_service.vector_min_bots = 0
+        ai_service.aim(bots)
+        ai_service.vector_min_bots = ai.VECTOR_MIN_BOTS
+        differ = sum(abs(a - b.aim) > 1e-9 for a, b in zip(looped, bots))
+        print(f"numpy and loop aims differ for {differ} of {len(bots)} bots")
+        if differ:
+            sys.exit(1)
+
+    bot_count = sum(len(room.bots) for room in rooms)
+    print(f"{args.matches} bot matches, {bot_count} bots, {args.engine} engine")
+    for name, use_numpy in (("loop", False), ("numpy", True)):
+        if use_numpy and ai.np is None:
+            continue
+        ai_service.use_numpy = use_numpy
+        ai_service.vector_min_bots = 0 if use_numpy else ai.VECTOR_MIN_BOTS
+        durations = []
+        aims = []
+        looks = ai_service.looks
+        for _ in range(BENCH_TICKS):
+            engine.step(TICK_RATE)
+            for room in rooms:
+                keep_playing(room.game)
+            start = time.perf_counter()
+            ai_service.update(rooms, TICK_RATE)
+            durations.append(time.perf_counter() - start)
+            # Every bot aiming at once, the batch the looks of a tick are spread out to avoid
+            start = time.perf_counter()
+            ai_service.aim(bots)
+            aims.append(time.perf_counter() - start)
+        durations.sort()
+        aims.sort()
+        print(f"  {name:5s} AI pass p50 {milliseconds(durations, 0.5):6.3f} ms  p99 {milliseconds(durations, 0.99):6.3f} ms  "
+              f"{milliseconds(durations, 0.5) * 1000 / bot_count:.2f} us per bot, "
+              f"{(ai_service.looks - looks) / BENCH_TICKS:.0f} looks per tick, all bots aiming "
+              f"{milliseconds(aims, 0.5) * 1000 / bot_count:.2f} us per bot")
+
+    # Who beats whom, best of args.games matches per pairing
+    ai_service.use_numpy = ai.np is not None
+    ai_service.vector_min_bots = ai.VECTOR_MIN_BOTS
+    match_engine = engines.create_engine(args.engine)  # Of its own, the rooms above would play along otherwise
+    names = sorted(ai.DIFFICULTIES, key=lambda name: ai.DIFFICULTIES[name]["reaction"], reverse=True)
+    print(f"Match wins out of {args.games} per pairing, left paddle first:")
+    for index, left in enumerate(names):
+        for right in names[index:]:
+            wins = sum(play_bot_match(match_engine, ai_service, (left, right), args.seed + game) == "Player 1"
+                       for game in range(args.games))
+            print(f"  {left:7s} vs {right:7s} {wins:3d} - {args.games - wins:3d}")
+
+    # A soak run: a server with only bot matches, as `server.py --bots N` runs one
+    game_server = server.PongServer("127.0.0.1", 0, engine=args.engine, bot_matches=args.matches,
+                                    ai_difficulty=args.difficulty)
+    with contextlib.redirect_stdout(io.StringIO()):
+        server_thread = threading.Thread(target=game_server.start, daemon=True)
+        server_thread.start()
+        time.sleep(args.duration)
+        game_server.stop()
+        server_thread.join()
+    step_times = sorted(game_server.step_times)
+    print(f"Server with {args.matches} bot matches for {args.duration:.0f} s: step p50 {milliseconds(step_times, 0.5):.3f} ms "
+          f"p99 {milliseconds(step_times, 0.99):.3f} ms, {game_server.ai.decisions} bot decisions, "
+          f"{game_server.slow_steps + game_server.dropped_steps} late steps")
+
+
+def play_lag_match(seed, delay, max_rewind, steps):
+    # Two players delay snapshot rounds of round trip away, half each way, who see their own
+    # paddle move straight away (client prediction) and react to the ball some way out, closer
+    # on some approaches than others. Like the client they see the ball the interpolation delay
+    # late on top of the trip. Returns (hits, misses, hits granted by rewinding).
+    rng = random.Random(seed)
+    game = PongGame(seed)
+    room = Room(seed, game, max_rewind=max_rewind)
+    room.start_countdown(0)
+    to_player = delay // 2  # Rounds a snapshot takes to reach a player
+    to_server = delay - to_player
+    view_lag = to_player + round(protocol.INTERPOLATION_DELAY / TICK_RATE)  # Rounds what a player sees is behind
+    paddles = {1: game.player1_y, 2: game.player2_y}  # Each player's own view of their paddle
+    reach = {1: 0.0, 2: 0.0}
+    in_flight = collections.deque()  # (step it's applied before, player, direction, view sequence number)
+    hits = points = granted = 0
+    finished = 0  # Steps since someone won
+    velocity_x = game.ball_velocity_x
+    for step in range(steps):
+        while in_flight and in_flight[0][0] <= step:
+            _, player, direction, view_seq = in_flight.popleft()
+            room.move_paddle(player, direction)
+            if max_rewind and room.rewind_hit(player, view_seq, TICK_RATE):
+                granted += 1
+        game.step(TICK_RATE)
+        room.record_snapshot()
+        if game.ball_velocity_x * velocity_x < 0 and abs(game.ball_velocity_x) > abs(velocity_x):
+            hits += 1  # Serves go out at BALL_SPEED, only a paddle speeds the ball up
+        velocity_x = game.ball_velocity_x
+        
+        if game.winner:
+            # Restart once a late hit can't take the winning point back any more
+            finished += 1
+            if finished > max_rewind + view_lag + to_server:
+                points += game.score_player1 + game.score_player2
+                room.restart()
+                room.start_countdown(0)
+                in_flight.clear()
+                paddles = {1: game.player1_y, 2: game.player2_y}
+                velocity_x = game.ball_velocity_x
+                finished = 0
+            continue
+        
+        view_seq = room.snapshot_seq - view_lag
+        values, previous = room.snapshot(view_seq), room.snapshot(view_seq - 1)
+        if values is None or previous is None or values[6] != -1:
+            continue
+        for player, face_x in ((1, PADDLE_WIDTH), (2, BALL_RIGHT_CONTACT_X)):
+            intercept = ai.predict_intercept(values[0], values[1], values[0] - previous[0], values[1] - previous[1], face_x)
+            if intercept is None:
+                reach[player] = rng.uniform(*LAG_REACH)  # For the next approach
+                target = WINDOW_HEIGHT / 2
+            elif abs(face_x - values[0]) < reach[player]:
+                target = intercept + BALL_SIZE / 2
+            else:
+                continue
+            paddle_center = paddles[player] + PADDLE_HEIGHT // 2
+            if paddle_center < target - 8:
+                direction = "down"
+            elif paddle_center > target + 8:
+                direction = "up"
+            else:
+                continue
+            paddles[player] = move_paddle_y(paddles[player], direction)
+            in_flight.append((step + 1 + to_server, player, direction, view_seq))
+    points += game.score_player1 + game.score_player2
+    return hits, points, granted
+
+
+def bench_lag(args):
+    # How many of the hits players make on their own screens the server turns into misses, with
+    # and without lag compensation. The same players at 0 ms are the fair result.
+    steps = round(args.seconds / TICK_RATE)
+    max_rewind = min(server.SNAPSHOT_HISTORY - 2, round(args.max_rewind / 1000 / TICK_RATE))
+    print(f"{args.seconds:.0f} s of play per run, max rewind {args.max_rewind:.0f} ms ({max_rewind} rounds)")
+    print("  RTT ms   miss rate off   miss rate on   hits granted   lost vs 0 ms off / on")
+    fair = None
+    for latency in args.latencies:
+        delay = round(latency / 1000 / TICK_RATE)
+        rates = []
+        for rewind in (0, max_rewind):
+            hits, misses, granted = play_lag_match(args.seed, delay, rewind, steps)
+            rates.append(misses / max(1, hits + misses))
+        if fair is None:
+            fair = rates[0]
+        print(f"  {latency:6.0f}   {rates[0] * 100:12.1f}%   {rates[1] * 100:11.1f}%   {granted:12d}   "
+              f"{(rates[0] - fair) * 100:+8.1f} / {(rates[1] - fair) * 100:+.1f} points")
+
+
+def random_result(rng, names):
+    player1, player2 = rng.sample(names, 2)
+    winner = rng.choice((1, 2))
+    scores = (WINNING_SCORE, rng.randrange(WINNING_SCORE))
+    return (time.time(), rng.uniform(60, 300), player1, player2) + (scores if winner == 1 else scores[::-1]) + (winner, None)
+
+
+def read_history(path, names, stop, timings):
+    # What `results.py` run alongside the server does: incremental exports, stats and the leaderboard
+    connection = results.connect(path)
+    rng = random.Random(0)
+    exported = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        count = results.export(connection, io.StringIO(), "csv", exported)
+        timings["export"].append((time.perf_counter() - start, count))
+        exported += count
+        start = time.perf_counter()
+        results.player_stats(connection, rng.choice(names))
+        results.recent_matches(connection, rng.choice(names))
+        timings["player"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        results.leaderboard(connection)
+        timings["leaderboard"].append(time.perf_counter() - start)
+        stop.wait(0.05)
+    connection.close()
+
+
+def bench_results(args):
+    # The match history with matches finishing at args.rate a second: what recording costs the
+    # server loop, whether the writer keeps up, and queries and exports running meanwhile
+    rng = random.Random(args.seed)
+    names = [f"player{index}" for index in range(args.players)]
+    with tempfile.TemporaryDirectory() as directory:
+        # For comparison, writing each result in its own transaction as it comes in
+        path = os.path.join(directory, "sync.db")
+        connection = results.connect(path)
+        start = time.perf_counter()
+        for _ in range(args.sync_results):
+            results.write_results(connection, [random_result(rng, names)])
+        sync_time = (time.perf_counter() - start) / args.sync_results
+        connection.close()
+        print(f"One transaction per result: {sync_time * 1e6:.0f} us of the server loop per match")
+
+        path = os.path.join(directory, "results.db")
+        store = results.ResultStore(path)
+        stop = threading.Event()
+        timings = {"export": [], "player": [], "leaderboard": []}
+        reader = threading.Thread(target=read_history, args=(path, names, stop, timings), daemon=True)
+        reader.start()
+        record_times = []
+        tick_times = []
+        most_pending = 0
+        owed = 0.0
+        ticks = round(args.duration / TICK_RATE)
+        start = time.perf_counter()
+        for tick in range(ticks):
+            owed += args.rate * TICK_RATE
+            tick_start = time.perf_counter()
+            while owed >= 1:
+                owed -= 1
+                result = random_result(rng, names)
+                record_start = time.perf_counter()
+                store.record(*result)
+                record_times.append(time.perf_counter() - record_start)
+            tick_times.append(time.perf_counter() - tick_start)
+            most_pending = max(most_pending, store.pending())
+            delay = start + (tick + 1) * TICK_RATE - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        elapsed = time.perf_counter() - start
+        close_start = time.perf_counter()
+        store.close()
+        drain_time = time.perf_counter() - close_start
+        stop.set()
+        reader.join()
+
+        record_times.sort()
+        tick_times.sort()
+        print(f"{len(record_times)} matches in {elapsed:.1f} s ({len(record_times) / elapsed:.0f}/s) through the writer: "
+              f"record p50 {record_times[len(record_times) // 2] * 1e6:.1f} us, "
+              f"p99 {record_times[int(len(record_times) * 0.99)] * 1e6:.1f} us, max {record_times[-1] * 1e6:.0f} us, "
+              f"per tick p99 {milliseconds(tick_times, 0.99):.3f} ms")
+        print(f"Writer: {store.written} written in {store.batches} batches, {store.dropped} dropped, "
+              f"at most {most_pending} waiting, {drain_time * 1000:.0f} ms to drain on close")
+        exports = timings["export"]
+        exported = sum(count for _, count in exports)
+        export_time = sum(duration for duration, _ in exports)
+        for name in ("player", "leaderboard"):
+            timings[name].sort()
+        print(f"Meanwhile: {len(exports)} incremental exports, {exported} rows at {exported / max(export_time, 1e-9):.0f} rows/s, "
+              f"player stats and recent matches p50 {milliseconds(timings['player'], 0.5):.2f} ms, "
+              f"leaderboard p50 {milliseconds(timings['leaderboard'], 0.5):.2f} ms")
+
+        connection = results.connect(path)
+        matches, = connection.execute("SELECT COUNT(*) FROM matches").fetchone()
+        played, = connection.execute("SELECT SUM(played) FROM players").fetchone()
+        print(f"Database: {matches} matches, player totals {'add up' if played == 2 * matches else 'DO NOT add up'}")
+        for fmt in ("csv", "jsonl"):
+            with open(os.devnull, "w") as out:
+                start = time.perf_counter()
+                count = results.export(connection, out, fmt)
+                print(f"Full {fmt} export: {count} rows at {count / (time.perf_counter() - start):.0f} rows/s")
+        for query, parameters in (("SELECT played FROM players WHERE name = ?", (names[0],)),
+                                  ("SELECT match_id FROM match_players WHERE name = ? ORDER BY match_id DESC LIMIT 10",
+                                   (names[0],)),
+                                  ("SELECT name FROM players ORDER BY won DESC, played LIMIT 10", ())):
+            plan = "; ".join(row[-1] for row in connection.execute("EXPLAIN QUERY PLAN " + query, parameters))
+            print(f"  {plan}")
+        connection.close()
+        if played != 2 * matches or store.dropped:
+            sys.exit(1)
+
+
+def micro_benchmarks():
+    # Each returns the cost of one call in microseconds, best of a few runs to keep noise out
+    def measure(function, iterations=20000, repeats=5):
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best / iterations * 1e6
+
+    random.seed(1)
+    game = PongGame()
+    game.game_active = True
+
+    def step():
+        game.step(TICK_RATE)
+        keep_playing(game)
+
+    baseline = protocol.state_values(game)
+    game.step(TICK_RATE)
+    stream = b"".join(protocol.encode_delta(seq, protocol.state_values(game), seq - 1, baseline) for seq in range(2, 102))
+    header = protocol.FRAME_HEADER.size + 1
+    delta = protocol.encode_delta(2, protocol.state_values(game), 1, baseline)
+    buffer = bytearray(protocol.MAX_STATE_FRAME)
+
+    def parse_frames():
+        decoder = protocol.FrameDecoder()
+        decoder.feed(stream)
+        for _ in decoder.frames():
+            pass
+
+    return {
+        "PongGame.step": measure(step),
+        "get_state json encode": measure(lambda: json.dumps(game.get_state()).encode()),
+        "snapshot encode": measure(lambda: protocol.encode_snapshot(2, protocol.state_values(game))),
+        "snapshot encode into buffer": measure(lambda: protocol.encode_snapshot_into(buffer, 0, 2, protocol.state_values(game))),
+        "delta encode": measure(lambda: protocol.encode_delta(2, protocol.state_values(game), 1, baseline)),
+        "delta encode into buffer": measure(lambda: protocol.encode_delta_into(buffer, 0, 2, protocol.state_values(game), 1, baseline)),
+        "state json encode": measure(lambda: protocol.encode_json_state(protocol.state_values(game))),
+        "delta decode": measure(lambda: protocol.state_dict(protocol.decode_delta(delta[header:], {1: baseline})[1])),
+        "frame parser, 100 frames": measure(parse_frames, 2000),
+    }
+
+
+def bench_micro(args):
+    results = micro_benchmarks()
+    reference = None
+    if args.compare:
+        with open(args.compare) as reference_file:
+            reference = json.load(reference_file)
+
+    regressions = []
+    for name, cost in results.items():
+        line = f"{name:28s} {cost:9.3f} us"
+        if reference and name in reference:
+            ratio = cost / reference[name]
+            line += f"  {ratio:5.2f}x reference"
+            if ratio > 1 + args.tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save:
+        with open(args.save, "w") as reference_file:
+            json.dump(results, reference_file, indent=2)
+        print(f"Saved results to {args.save}")
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) slower than the reference by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pong server benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    rooms_parser = subparsers.add_parser("rooms", help="how many rooms one core can tick at the tick rate")
+    rooms_parser.add_argument("--start", type=int, default=64, help="first room count to try")
+    rooms_parser.add_argument("--engine", choices=sorted(engines.ENGINES), default="scalar")
+    rooms_parser.set_defaults(func=bench_rooms)
+
+    protocol_parser = subparsers.add_parser("protocol", help="state size and encode/decode cost per wire protocol")
+    protocol_parser.add_argument("--iterations", type=int, default=100000)
+    protocol_parser.set_defaults(func=bench_protocol)
+
+    engines_parser = subparsers.add_parser("engines", help="check physics engines agree and compare step cost")
+    engines_parser.add_argument("--games", type=int, nargs="+", default=[100, 1000, 10000])
+    engines_parser.add_argument("--steps", type=int, default=100)
+    engines_parser.add_argument("--verify-games", type=int, default=200)
+    engines_parser.add_argument("--verify-steps", type=int, default=3000)
+    engines_parser.add_argument("--seed", type=int, default=1)
+    engines_parser.set_defaults(func=bench_engines)
+
+    load_parser = subparsers.add_parser("load", help="headless bots against a local server")
+    load_parser.add_argument("--clients", type=int, default=100)
+    load_parser.add_argument("--duration", type=float, default=10)
+    load_parser.add_argument("--max-rooms", type=int, default=server.MAX_ROOMS)
+    load_parser.add_argument("--physics-rate", type=int, default=server.PHYSICS_RATE)
+    load_parser.add_argument("--snapshot-rate", type=int, default=server.SNAPSHOT_RATE)
+    load_parser.add_argument("--engine", choices=sorted(engines.ENGINES), default=server.PHYSICS_ENGINE)
+    load_parser.add_argument("--verbose", action="store_true", help="show the server's own output")
+    load_parser.set_defaults(func=bench_load)
+
+    allocations_parser = subparsers.add_parser("allocations", help="memory allocated by steady-state ticks, with tracemalloc")
+    allocations_parser.add_argument("--rooms", type=int, default=50)
+    allocations_parser.add_argument("--ticks", type=int, default=600)
+    allocations_parser.add_argument("--warmup", type=int, default=300)
+    allocations_parser.add_argument("--protocol", choices=protocol.SUPPORTED_PROTOCOLS, default=protocol.BINARY_PROTOCOL)
+    allocations_parser.add_argument("--engine", choices=sorted(engines.ENGINES), default="scalar")
+    allocations_parser.add_argument("--limit", type=float, default=16, help="bytes a tick may keep before this fails")
+    allocations_parser.set_defaults(func=bench_allocations)
+
+    spectators_parser = subparsers.add_parser("spectators", help="player latency with many spectators on one match")
+    spectators_parser.add_argument("--clients", type=int, default=20)
+    spectators_parser.add_argument("--viewers", type=int, default=2000)
+    spectators_parser.add_argument("--spectator-rate", type=int, default=broadcast.SPECTATOR_RATE)
+    spectators_parser.add_argument("--duration", type=float, default=8)
+    spectators_parser.set_defaults(func=bench_spectators)
+
+    bots_parser = subparsers.add_parser("bots", help="batched AI cost, difficulty win rates and a bot-filled server")
+    bots_parser.add_argument("--matches", type=int, default=1000)
+    bots_parser.add_argument("--games", type=int, default=20, help="matches played per difficulty pairing")
+    bots_parser.add_argument("--difficulty", choices=sorted(ai.DIFFICULTIES), default=ai.DEFAULT_DIFFICULTY)
+    bots_parser.add_argument("--engine", choices=sorted(engines.ENGINES),
+                             default="numpy" if engines.np is not None else "scalar")
+    bots_parser.add_argument("--duration", type=float, default=10.0, help="seconds the bot-filled server runs")
+    bots_parser.add_argument("--seed", type=int, default=1)
+    bots_parser.set_defaults(func=bench_bots)
+
+    lag_parser = subparsers.add_parser("lag", help="paddle hits lost to latency with and without lag compensation")
+    lag_parser.add_argument("--latencies", type=float, nargs="+", default=[0, 50, 100, 150, 200, 250, 300, 400], help="round trips in ms")
+    lag_parser.add_argument("--max-rewind", type=float, default=server.MAX_REWIND * 1000, help="in ms")
+    lag_parser.add_argument("--seconds", type=float, default=1200, help="simulated play per run")
+    lag_parser.add_argument("--seed", type=int, default=1)
+    lag_parser.set_defaults(func=bench_lag)
+
+    results_parser = subparsers.add_parser("results", help="match history writes, queries and exports at a high match rate")
+    results_parser.add_argument("--rate", type=float, default=1000, help="matches finishing per second")
+    results_parser.add_argument("--duration", type=float, default=10)
+    results_parser.add_argument("--players", type=int, default=10000)
+    results_parser.add_argument("--sync-results", type=int, default=500, help="results written one transaction each first")
+    results_parser.add_argument("--seed", type=int, default=1)
+    results_parser.set_defaults(func=bench_results)
+
+    parser_parser = subparsers.add_parser("parser", help="client stream decoders on a backlog of states")
+    parser_parser.add_argument("--states", type=int, nargs="+", default=[100, 1000, 10000])
+    parser_parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[4096, 65536])
+    parser_parser.set_defaults(func=bench_parser)
+
+    micro_parser = subparsers.add_parser("micro", help="hot path microbenchmarks, optionally against saved results")
+    micro_parser.add_argument("--save", help="write results to this JSON file")
+    micro_parser.add_argument("--compare", help="JSON file from an earlier --save to check against")
+    micro_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before failing")
+    micro_parser.set_defaults(func=bench_micro)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,199 @@
+import argparse
+import json
+import selectors
+import socket
+import time
+
+import protocol
+from game import PADDLE_HEIGHT, BALL_SIZE
+
+# Headless players for load testing, no pygame or display needed. Many bots share one
+# selector, so a single process can keep thousands of them connected.
+
+BOT_MOVE_RATE = 60  # Paddle decisions per second, like a client running at 60 FPS
+SNAPSHOT_HISTORY = 64
+
+
+class PongBot:
+    def __init__(self, host, port):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self.player_number = None
+        self.frames = protocol.FrameDecoder()
+        self.snapshots = {}  # Applied state values indexed by snapshot sequence number
+        self.state = None
+        self.state_seq = None  # Sequence number of state, what the bot is looking at
+        self.input_seq = 0
+        self.sent_inputs = {}  # Send time indexed by move sequence number, until acknowledged
+
+        # Measurements
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.snapshots_received = 0
+        self.full_snapshots = 0
+        self.input_latencies = []  # Seconds from sending a move to seeing it acknowledged
+
+        self.received = b""  # Bytes read past the handshake messages
+        self.handshake()
+        self.frames.feed(self.received)
+        self.socket.setblocking(False)
+
+    def handshake(self):
+        welcome = self.receive_json()
+        if welcome is None or "error" in welcome:
+            raise ConnectionError(f"Server refused bot: {welcome}")
+        self.player_number = welcome["player_number"]
+        self.send(json.dumps({"protocols": [protocol.BINARY_PROTOCOL]}).encode())
+        reply = self.receive_json()
+        if reply is None or reply.get("protocol") != protocol.BINARY_PROTOCOL:
+            raise ConnectionError(f"Server doesn't speak {protocol.BINARY_PROTOCOL}: {reply}")
+
+    def receive_json(self):
+        # Read one handshake message, binary frames may already follow it
+        decoder = json.JSONDecoder()
+        while True:
+            text = self.received.decode("latin-1").lstrip()
+            try:
+                message, end = decoder.raw_decode(text)
+                self.received = text[end:].encode("latin-1")
+                return message
+            except json.JSONDecodeError:
+                pass
+            data = self.socket.recv(1024)
+            if not data:
+                return None
+            self.received += data
+
+    def send(self, data):
+        try:
+            self.socket.send(data)
+            self.bytes_sent += len(data)
+        except (BlockingIOError, InterruptedError):
+            pass  # Socket buffer full, a bot can afford to lose a message
+        except OSError:
+            self.close()
+
+    def on_readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+            return
+        self.bytes_received += len(data)
+        self.frames.feed(data)
+
+        latest = None
+        for msg_type, body in self.frames.frames():
+            if msg_type in protocol.STATE_MESSAGES:
+                self.snapshots_received += 1
+                latest = (msg_type, body)
+        if latest is None:
+            return
+
+        if latest[0] == protocol.MSG_SNAPSHOT:
+            self.full_snapshots += 1
+            seq, values = protocol.decode_snapshot(latest[1])
+        else:
+            seq, values = protocol.decode_delta(latest[1], self.snapshots)
+        if values is None:
+            self.send(protocol.encode_frame(protocol.MSG_REQUEST_STATE))
+            return
+        self.snapshots[seq] = values
+        protocol.prune_baselines(self.snapshots, seq, SNAPSHOT_HISTORY)
+        self.state = values
+        self.state_seq = seq
+        self.send(protocol.encode_ack(seq))
+
+        # Moves the server has now processed
+        acked_seq = values[8] if self.player_number == 1 else values[9]
+        now = time.perf_counter()
+        for sent_seq in [sent_seq for sent_seq in self.sent_inputs if protocol.input_acked(sent_seq, acked_seq)]:
+            self.input_latencies.append(now - self.sent_inputs.pop(sent_seq))
+
+    def think(self):
+        # Chase the ball like the server's AI does
+        if self.state is None or self.closed:
+            return
+        ball_y = self.state[1]
+        paddle_y = self.state[2] if self.player_number == 1 else self.state[3]
+        paddle_center = paddle_y + PADDLE_HEIGHT // 2
+        ball_center = ball_y + BALL_SIZE // 2
+        if paddle_center < ball_center - 10:
+            direction = "down"
+        elif paddle_center > ball_center + 10:
+            direction = "up"
+        else:
+            return
+        self.input_seq = (self.input_seq + 1) % protocol.INPUT_SEQ_MODULO
+        self.sent_inputs[self.input_seq] = time.perf_counter()
+        self.send(protocol.encode_move(direction, self.input_seq, self.state_seq))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.socket.close()
+
+
+def run_bots(host, port, count, duration, move_rate=BOT_MOVE_RATE, on_ready=None):
+    selector = selectors.DefaultSelector()
+    bots = []
+    for _ in range(count):
+        bot = PongBot(host, port)
+        selector.register(bot.socket, selectors.EVENT_READ, bot)
+        bots.append(bot)
+    if on_ready is not None:
+        on_ready()
+
+    start = time.perf_counter()
+    next_think = start
+    while time.perf_counter() - start < duration:
+        for key, _ in selector.select(max(0.0, next_think - time.perf_counter())):
+            key.data.on_readable()
+            if key.data.closed:
+                selector.unregister(key.fileobj)
+        if time.perf_counter() >= next_think:
+            for bot in bots:
+                bot.think()
+            next_think += 1 / move_rate
+    summary = summarize(bots, time.perf_counter() - start)
+
+    for bot in bots:
+        bot.close()
+    selector.close()
+    return summary
+
+
+def summarize(bots, elapsed):
+    latencies = sorted(latency for bot in bots for latency in bot.input_latencies)
+    return {
+        "bots": len(bots),
+        "disconnected": sum(1 for bot in bots if bot.closed),
+        "seconds": elapsed,
+        "bytes_in_per_client": sum(bot.bytes_received for bot in bots) / len(bots) / elapsed,
+        "bytes_out_per_client": sum(bot.bytes_sent for bot in bots) / len(bots) / elapsed,
+        "snapshots_per_client": sum(bot.snapshots_received for bot in bots) / len(bots) / elapsed,
+        "full_snapshots": sum(bot.full_snapshots for bot in bots),
+        "input_latencies": latencies,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless Pong bots")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--bots", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    summary = run_bots(args.host, args.port, args.bots, args.duration)
+    latencies = summary.pop("input_latencies")
+    for name, value in summary.items():
+        print(f"{name}: {value:.1f}" if isinstance(value, float) else f"{name}: {value}")
+    if latencies:
+        print(f"input ack latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
@@ -0,0 +1,268 @@
+import collections
+import json
+import selectors
+import socket
+import time
+
+import protocol
+
+# Spectators. Viewers connect to a separate port and send {"watch": room id}, or
+# {"watch": null} for any match being played. The answer is {"watching": room id,
+# "protocol": "bin3", "snapshot_rate": n} and from then on the same binary state frames players
+# get, at a lower rate. Viewers never send anything else and nothing is acknowledged.
+#
+# Each match has one Broadcast stream. Every state it publishes is encoded once, as a delta
+# against the state published before it, and that one frame goes to every viewer. TCP keeps a
+# viewer's frames in order, so the previous state is always its baseline. A new viewer starts
+# with a full snapshot of the latest state.
+#
+# The Broadcaster does the sending. Publishing only queues the frame, fan_out sends it to the
+# viewers and can stop at a deadline and resume later, so the server sends to spectators in
+# the time left before its next physics step and players never wait for them. A viewer whose
+# socket doesn't keep up and has more than MAX_VIEWER_BACKLOG bytes queued is dropped.
+#
+# relay.py speaks this protocol on both sides, it watches matches on a server (or another
+# relay) and broadcasts them again to its own viewers. Chaining relays fans a match out to
+# more viewers than one process could send to, without adding any work to the game server.
+
+SPECTATOR_PORT = 5556  # Usual port, the server only accepts spectators when given one
+SPECTATOR_RATE = 15  # States per second sent to spectators, players get SNAPSHOT_RATE
+MAX_VIEWER_BACKLOG = 16384  # Bytes queued for a viewer before it counts as fallen behind
+MAX_VIEWER_REQUEST = 1024  # Bytes of watch request before the viewer counts as misbehaving
+FAN_OUT_CHECK = 32  # Viewers sent to between looks at the clock
+
+
+class Broadcast:
+    # One match's stream, the latest state published is the baseline of the next one. A stream_id
+    # of None is a stream still being set up, see Broadcaster.
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.viewers = []
+        self.seq = None
+        self.values = None
+
+    def publish(self, seq, values, frame=None):
+        # Returns the frame taking viewers from the previous state to this one, encoding it
+        # unless a relay passes on the one it received
+        if frame is None:
+            if self.values is None or not 0 < seq - self.seq <= protocol.MAX_BASELINE_AGE:
+                frame = protocol.encode_snapshot(seq, values)
+            else:
+                frame = protocol.encode_delta(seq, values, self.seq, self.values)
+        self.seq = seq
+        self.values = values
+        return frame
+
+    def snapshot_frame(self):
+        return protocol.encode_snapshot(self.seq, self.values)
+
+
+class Viewer:
+    def __init__(self, broadcaster, sock, address):
+        self.broadcaster = broadcaster
+        self.socket = sock
+        self.address = address
+        self.stream = None  # The Broadcast watched, None until the request is in
+        self.request = b""
+        self.outbound = collections.deque()  # Frames the socket hasn't taken yet
+        self.out_offset = 0  # Bytes of the first queued frame already sent
+        self.backlog = 0  # Bytes queued
+        self.closed = False
+
+    def handle_event(self, events):
+        if events & selectors.EVENT_READ:
+            self.read()
+        if events & selectors.EVENT_WRITE and not self.closed:
+            self.flush()
+
+    def read(self):
+        try:
+            data = self.socket.recv(MAX_VIEWER_REQUEST)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.broadcaster.remove_viewer(self)
+            return
+        if self.stream is not None:
+            return  # Nothing is expected once watching
+        self.request += data
+        try:
+            message, _ = json.JSONDecoder().raw_decode(self.request.decode("latin-1").lstrip())
+        except ValueError:
+            if len(self.request) > MAX_VIEWER_REQUEST:
+                self.broadcaster.remove_viewer(self)
+            return  # Incomplete, wait for the rest
+        self.broadcaster.watch(self, message)
+
+    def send(self, frame):
+        if self.closed:
+            return
+        if self.outbound:
+            self.queue(frame)
+            return
+        try:
+            sent = self.socket.send(frame)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.broadcaster.remove_viewer(self)
+            return
+        self.broadcaster.bytes_sent += sent
+        if sent < len(frame):
+            self.out_offset = sent
+            self.broadcaster.selector.modify(self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                             self.handle_event)
+            self.queue(frame)
+
+    def queue(self, frame):
+        self.outbound.append(frame)
+        self.backlog += len(frame)
+        if self.backlog > MAX_VIEWER_BACKLOG:
+            self.broadcaster.dropped += 1
+            print(f"Spectator {self.address} is not keeping up, dropping it")
+            self.broadcaster.remove_viewer(self)
+
+    def flush(self):
+        while self.outbound:
+            frame = self.outbound[0]
+            try:
+                sent = self.socket.send(memoryview(frame)[self.out_offset:])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self.broadcaster.remove_viewer(self)
+                return
+            self.broadcaster.bytes_sent += sent
+            self.out_offset += sent
+            if self.out_offset < len(frame):
+                return
+            self.outbound.popleft()
+            self.backlog -= len(frame)
+            self.out_offset = 0
+        self.broadcaster.selector.modify(self.socket, selectors.EVENT_READ, self.handle_event)
+
+
+class Broadcaster:
+    # Accepts viewers on its own port in the owner's selector and fans published frames out to them.
+    # find_stream(room id or None) returns the Broadcast to watch or None, on_stream_empty(stream)
+    # is called when a stream's last viewer leaves. find_stream can also return a stream without
+    # an id yet, whose viewers wait for their answer until the owner calls stream_ready or
+    # stream_failed, so a relay never blocks on its upstream.
+    def __init__(self, selector, host, port, find_stream, snapshot_rate, on_stream_empty=None):
+        self.selector = selector
+        self.find_stream = find_stream
+        self.snapshot_rate = snapshot_rate
+        self.on_stream_empty = on_stream_empty
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(1024)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        self.viewers = set()
+        self.work = collections.deque()  # [frame, viewers, index of the next one to send to], oldest first
+        self.dropped = 0
+        self.bytes_sent = 0
+        print(f"Accepting spectators on {host}:{port}")
+
+    def accept(self, events):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Error accepting spectator: {e}")
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            viewer = Viewer(self, sock, address)
+            self.viewers.add(viewer)
+            self.selector.register(sock, selectors.EVENT_READ, viewer.handle_event)
+
+    def watch(self, viewer, message):
+        room_id = message.get("watch") if isinstance(message, dict) else None
+        valid = room_id is None or isinstance(room_id, int) and not isinstance(room_id, bool)
+        stream = self.find_stream(room_id) if valid else None
+        if stream is None:
+            viewer.send(json.dumps({"error": f"No match {room_id} to watch" if room_id else "No match to watch"}).encode())
+            self.remove_viewer(viewer)
+            return
+        viewer.stream = stream
+        stream.viewers.append(viewer)
+        if stream.stream_id is not None:
+            self.welcome(viewer)
+
+    def welcome(self, viewer):
+        stream = viewer.stream
+        viewer.send(json.dumps({"watching": stream.stream_id, "protocol": protocol.BINARY_PROTOCOL,
+                                "snapshot_rate": self.snapshot_rate}).encode())
+        if stream.values is not None:
+            viewer.send(stream.snapshot_frame())
+
+    def stream_ready(self, stream, target=None):
+        # The stream's viewers get their answer, those of target instead when the match being set
+        # up turned out to be one that is already watched
+        if target is not None:
+            for viewer in stream.viewers:
+                viewer.stream = target
+                target.viewers.append(viewer)
+            viewers, stream.viewers = stream.viewers, []
+        else:
+            viewers = list(stream.viewers)
+        for viewer in viewers:
+            self.welcome(viewer)
+
+    def stream_failed(self, stream, error):
+        for viewer in list(stream.viewers):
+            viewer.send(json.dumps({"error": error}).encode())
+            self.remove_viewer(viewer)
+
+    def publish(self, stream, seq, values, frame=None):
+        frame = stream.publish(seq, values, frame)
+        if stream.viewers:
+            self.work.append([frame, list(stream.viewers), 0])
+
+    def fan_out(self, deadline=None):
+        # Send published frames to their viewers, stopping once perf_counter passes deadline.
+        # Returns True when everything is sent.
+        while self.work:
+            item = self.work[0]
+            frame, viewers, index = item
+            while index < len(viewers):
+                viewers[index].send(frame)
+                index += 1
+                if deadline is not None and index % FAN_OUT_CHECK == 0 and time.perf_counter() >= deadline:
+                    item[2] = index
+                    return False
+            self.work.popleft()
+        return True
+
+    def remove_viewer(self, viewer):
+        if viewer.closed:
+            return
+        viewer.closed = True
+        self.viewers.discard(viewer)
+        try:
+            self.selector.unregister(viewer.socket)
+        except (KeyError, ValueError):
+            pass
+        viewer.socket.close()
+        stream = viewer.stream
+        if stream is not None:
+            stream.viewers.remove(viewer)
+            if not stream.viewers and self.on_stream_empty is not None:
+                self.on_stream_empty(stream)
+
+    def close_stream(self, stream):
+        # The match is over, its viewers see the connection close
+        for viewer in list(stream.viewers):
+            self.remove_viewer(viewer)
+
+    def close(self):
+        for viewer in list(self.viewers):
+            self.remove_viewer(viewer)
+        self.selector.unregister(self.socket)
+        self.socket.close()
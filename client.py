@@ -1,8 +1,35 @@
+import argparse
 import socket
 import threading
+import collections
 import json
 import pygame
 import sys
+import time
+
+import broadcast
+import protocol
+import udp
+from game import move_paddle_y
+
+# Snapshots kept as possible delta baselines, matches the server's history
+SNAPSHOT_HISTORY = 64
+
+# Moves sent but not yet acknowledged by the server, replayed over every state for prediction
+MAX_PENDING_INPUTS = 120
+
+# Snapshot interpolation: the ball and the other paddle are drawn this far in the past, between
+# the two snapshots around that moment, and extrapolated for at most MAX_EXTRAPOLATION seconds
+# when the next snapshot is late. The server allows for the delay when it judges paddle hits.
+INTERPOLATION_DELAY = protocol.INTERPOLATION_DELAY
+MAX_EXTRAPOLATION = 0.1
+INTERPOLATION_BUFFER = 32
+CLOCK_OFFSET_SMOOTHING = 0.05  # How quickly the server clock estimate follows slower arrivals
+
+# Seconds the UDP receive loop waits for a datagram before resending control messages and
+# releasing datagrams the network shim delayed
+UDP_POLL_INTERVAL = 0.005
+UDP_CONNECT_TIMEOUT = 5.0
 
 # Game settings
 WINDOW_WIDTH = 800
@@ -14,13 +41,116 @@ WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 FPS = 60
 
+# Rendering: the background is drawn once and each frame only the rectangles that changed are
+# erased, redrawn and sent to the display. Text is rendered once per distinct string.
+TEXT_CACHE_SIZE = 64  # Rendered strings kept before the cache starts over
+FRAME_TIME_INTERVAL = 0.5  # Seconds the frame time overlay averages over
+
+class SnapshotBuffer:
+    def __init__(self, delay=INTERPOLATION_DELAY, max_extrapolation=MAX_EXTRAPOLATION):
+        self.delay = delay
+        self.max_extrapolation = max_extrapolation
+        self.snapshots = collections.deque(maxlen=INTERPOLATION_BUFFER)  # (server time, state), oldest first
+        self.clock_offset = None  # Local time minus server time for the fastest recent arrivals
+        self.render_time = None  # Server time of the last state sampled, what is on screen
+    
+    def add(self, server_time, state, now):
+        if self.snapshots and server_time <= self.snapshots[-1][0]:
+            return  # Duplicate or out of order
+        
+        # Late packets only nudge the estimate, an early one resets it
+        offset = now - server_time
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        else:
+            self.clock_offset += (offset - self.clock_offset) * CLOCK_OFFSET_SMOOTHING
+        self.snapshots.append((server_time, state))
+    
+    def sample(self, now):
+        if not self.snapshots:
+            return None
+        render_time = now - self.clock_offset - self.delay
+        self.render_time = render_time
+        
+        # Before the oldest snapshot or nothing to blend yet
+        oldest_time, oldest = self.snapshots[0]
+        if render_time <= oldest_time or len(self.snapshots) == 1:
+            return oldest
+        
+        newest_time, newest = self.snapshots[-1]
+        if render_time >= newest_time:
+            # Next snapshot is late, keep the ball moving the way it was for a little while
+            previous_time, previous = self.snapshots[-2]
+            ahead = min(render_time - newest_time, self.max_extrapolation)
+            return self.blend(previous, newest, 1 + ahead / (newest_time - previous_time))
+        
+        # Find the pair of snapshots around the render time
+        for index in range(len(self.snapshots) - 1, 0, -1):
+            before_time, before = self.snapshots[index - 1]
+            if before_time <= render_time:
+                after_time, after = self.snapshots[index]
+                return self.blend(before, after, (render_time - before_time) / (after_time - before_time))
+    
+    def blend(self, before, after, fraction):
+        # A point was scored in between and the ball jumped back to the centre, don't sweep it across
+        if before["score"] != after["score"] or before["winner"] != after["winner"]:
+            return after if fraction >= 1 else before
+        
+        def mix(start, end):
+            return start + (end - start) * fraction
+        
+        state = dict(after if fraction >= 1 else before)
+        state["ball"] = {"x": mix(before["ball"]["x"], after["ball"]["x"]),
+                         "y": min(max(mix(before["ball"]["y"], after["ball"]["y"]), 0), WINDOW_HEIGHT - BALL_SIZE)}
+        state["player1"] = {"y": mix(before["player1"]["y"], after["player1"]["y"])}
+        state["player2"] = {"y": mix(before["player2"]["y"], after["player2"]["y"])}
+        return state
+    
+    def clear(self):
+        self.snapshots.clear()
+        self.clock_offset = None
+        self.render_time = None
+
+
 class PongClient:
-    def __init__(self, server_host='localhost', server_port=5555):
+    def __init__(self, server_host='localhost', server_port=5555, interpolation_delay=INTERPOLATION_DELAY,
+                 use_udp=False, loss=0.0, latency=0.0, jitter=0.0, spectate=False, room_id=None,
+                 show_frame_time=False, dirty_rects=True, name=None):
         self.server_host = server_host
         self.server_port = server_port
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.name = name  # Shown in the server's match history, which uses our address without one
         self.player_number = None
+        self.spectate = spectate  # Watch a match from the server's spectator port instead of playing
+        self.room_id = room_id  # Match to watch, None for any
+        self.watching = None  # Room id of the match being watched
         self.game_state = None
+        self.protocol = protocol.JSON_PROTOCOL
+        self.received = b""  # Bytes read past the handshake messages
+        
+        # Over UDP states are unreliable and the rest goes through the peer's reliable channel,
+        # optionally through a shim simulating a bad network on what we send
+        self.use_udp = use_udp
+        self.peer = None
+        self.peer_lock = threading.Lock()  # The receive thread and the game loop both send through the peer
+        self.network_shim = None
+        self.match_info = None  # Score and winner from the server's reliable events
+        if use_udp:
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.client_socket.settimeout(UDP_POLL_INTERVAL)
+            if loss or latency or jitter:
+                self.network_shim = udp.LossySocket(self.client_socket, loss, latency, jitter)
+        else:
+            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        
+        # Client-side prediction of our own paddle
+        self.input_seq = 0
+        self.pending_inputs = collections.deque(maxlen=MAX_PENDING_INPUTS)  # (sequence number, direction)
+        self.predicted_y = None
+        
+        # States as they arrive, drawn slightly in the past so uneven arrival doesn't show
+        self.snapshot_buffer = SnapshotBuffer(interpolation_delay)
+        self.snapshot_interval = None  # Seconds between server snapshots, when the server says
+        self.state_lock = threading.Lock()  # Shared by the receive thread and the game loop
         self.running = True
         self.connected = False
         
@@ -33,21 +163,42 @@ class PongClient:
         # Load fonts
         self.font = pygame.font.Font(None, 36)
         self.large_font = pygame.font.Font(None, 72)
+        self.small_font = pygame.font.Font(None, 24)
+        
+        # Rendering state, see render
+        self.text_cache = {}  # Rendered text surface indexed by (font, string)
+        self.blank = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT)).convert()
+        self.blank.fill(BLACK)
+        self.background = self.blank.copy()  # The court, center line included
+        for y in range(0, WINDOW_HEIGHT, 20):
+            self.background.fill(WHITE, (WINDOW_WIDTH // 2 - 2, y, 4, 10))
+        self.dirty_rects = dirty_rects  # False redraws and flips the whole screen every frame
+        self.scene = None  # What was drawn last frame, a change of scene redraws everything
+        self.sprites = []  # (surface or None for a white rectangle, rect) drawn last frame
+        
+        # Optional overlay with the time spent drawing each frame
+        self.show_frame_time = show_frame_time
+        self.frame_times = []
+        self.updated_pixels = 0
+        self.frame_time_text = ""
+        self.frame_time_reset = time.perf_counter()
     
     def connect(self):
+        if self.use_udp:
+            return self.connect_udp()
+        if self.spectate:
+            return self.connect_spectator()
         try:
             print(f"Connecting to server at {self.server_host}:{self.server_port}...")
             self.client_socket.connect((self.server_host, self.server_port))
             self.connected = True
             
             # Receive player number
-            data = self.client_socket.recv(1024).decode()
-            if not data:
+            response = self.receive_json_message()
+            if response is None:
                 print("No response from server")
                 self.connected = False
                 return False
-                
-            response = json.loads(data)
             
             # Check if server is full
             if "error" in response:
@@ -57,6 +208,22 @@ class PongClient:
                 
             self.player_number = response["player_number"]
             print(f"Connected as Player {self.player_number}")
+            if response.get("snapshot_rate"):
+                self.snapshot_interval = 1 / response["snapshot_rate"]
+            
+            # Negotiate the wire protocol, older servers don't offer any and only speak JSON
+            if "protocols" in response:
+                hello = {"protocols": protocol.SUPPORTED_PROTOCOLS}
+                if self.name:
+                    hello["name"] = self.name
+                self.client_socket.send(json.dumps(hello).encode())
+                reply = self.receive_json_message()
+                if reply is None:
+                    print("No response from server")
+                    self.connected = False
+                    return False
+                self.protocol = reply.get("protocol", protocol.JSON_PROTOCOL)
+            print(f"Using {self.protocol} protocol")
             
             # Start receiving game state in a separate thread
             receive_thread = threading.Thread(target=self.receive_game_state)
@@ -65,7 +232,7 @@ class PongClient:
             
             # Request initial game state
             try:
-                self.client_socket.send(json.dumps({"request_state": True}).encode())
+                self.send_command("request_state")
             except:
                 pass  # It's OK if this fails, we'll get the state in the next update cycle
             
@@ -79,79 +246,281 @@ class PongClient:
             self.connected = False
             return False
     
-    def receive_game_state(self):
-        buffer = ""
-        tries = 0
-        max_tries = 5
+    def connect_spectator(self):
+        # Spectators only receive binary states, see broadcast.py
+        print(f"Connecting to spectator port {self.server_host}:{self.server_port}...")
+        if not self.watch(self.room_id):
+            return False
+        
+        self.connected = True
+        print(f"Watching match {self.watching}")
+        receive_thread = threading.Thread(target=self.receive_spectator_states)
+        receive_thread.daemon = True
+        receive_thread.start()
+        return True
+    
+    def watch(self, room_id):
+        # Ask the spectator port for a match, the first state it sends after the reply is a full snapshot
+        try:
+            self.client_socket.connect((self.server_host, self.server_port))
+            self.client_socket.send(json.dumps({"watch": room_id}).encode())
+            reply = self.receive_json_message()
+        except (OSError, ValueError) as e:
+            print(f"Error connecting to server: {e}")
+            return False
+        if not isinstance(reply, dict) or "watching" not in reply:
+            print(f"Server error: {reply.get('error', 'unexpected reply') if isinstance(reply, dict) else 'no response'}")
+            return False
+        
+        self.watching = reply["watching"]
+        self.protocol = reply.get("protocol", protocol.BINARY_PROTOCOL)
+        if reply.get("snapshot_rate"):
+            self.snapshot_interval = 1 / reply["snapshot_rate"]
+        return True
+    
+    def watch_again(self):
+        # A fresh connection for the same match, the only way back to a full snapshot
+        self.client_socket.close()
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.received = b""
+        return self.watch(self.watching)
+    
+    def connect_udp(self):
+        print(f"Connecting to server at {self.server_host}:{self.server_port} over UDP...")
+        try:
+            address = socket.getaddrinfo(self.server_host, self.server_port, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+        except OSError as e:
+            print(f"Error connecting to server: {e}")
+            return False
+        self.peer = udp.Peer(self.network_shim or self.client_socket, address)
+        self.peer.send_reliable({"join": True, "name": self.name} if self.name else {"join": True})
         
-        # Try to request game state a few times initially
-        while self.running and self.connected and self.game_state is None and tries < max_tries:
+        # The join is resent until the welcome comes back
+        welcome = None
+        deadline = time.monotonic() + UDP_CONNECT_TIMEOUT
+        while welcome is None and time.monotonic() < deadline:
+            for message in self.poll_udp()[1]:
+                if isinstance(message, dict) and ("player_number" in message or "error" in message):
+                    welcome = message
+                    break
+        if welcome is None:
+            print("No response from server")
+            return False
+        if "error" in welcome:
+            print(f"Server error: {welcome['error']}")
+            return False
+        
+        self.player_number = welcome["player_number"]
+        self.protocol = welcome.get("protocol", protocol.BINARY_PROTOCOL)
+        if welcome.get("snapshot_rate"):
+            self.snapshot_interval = 1 / welcome["snapshot_rate"]
+        print(f"Connected as Player {self.player_number} over UDP")
+        self.connected = True
+        
+        receive_thread = threading.Thread(target=self.receive_udp_states)
+        receive_thread.daemon = True
+        receive_thread.start()
+        self.send_command("request_state")
+        return True
+    
+    def poll_udp(self):
+        # Wait briefly for one datagram, returns (state frames or None, control messages)
+        with self.peer_lock:
+            if self.network_shim is not None:
+                self.network_shim.flush()
+            self.peer.service(time.monotonic())
+        try:
+            packet, address = self.client_socket.recvfrom(udp.MAX_DATAGRAM)
+        except socket.timeout:
+            return None, []
+        except ConnectionRefusedError:
+            return None, []  # Nothing listening yet, keep trying until the timeout
+        if address != self.peer.address:
+            return None, []
+        with self.peer_lock:
+            return self.peer.receive(packet)
+    
+    def receive_json_message(self):
+        # Read until one complete JSON message is buffered, keeping anything after it
+        decoder = json.JSONDecoder()
+        while True:
+            text = self.received.decode("latin-1").lstrip()
             try:
-                # Request initial game state
-                self.client_socket.send(json.dumps({"request_state": True}).encode())
-                tries += 1
-                print(f"Requesting initial game state (try {tries}/{max_tries})...")
-                pygame.time.wait(1000)  # Wait a second between tries
-            except:
+                message, end = decoder.raw_decode(text)
+                self.received = text[end:].encode("latin-1")
+                return message
+            except json.JSONDecodeError:
                 pass
+            data = self.client_socket.recv(1024)
+            if not data:
+                return None
+            self.received += data
+    
+    def receive_game_state(self):
+        # The server streams states on its own, the one request sent on connect covers the first
+        if self.protocol == protocol.BINARY_PROTOCOL:
+            self.receive_binary_states()
+        else:
+            self.receive_json_states()
+    
+    def receive_binary_states(self):
+        frames = protocol.FrameDecoder()
+        frames.feed(self.received)
+        snapshots = {}  # Applied state values indexed by snapshot sequence number
         
         while self.running and self.connected:
             try:
-                data = self.client_socket.recv(4096).decode()
-                if not data:
+                # Only the newest state in a batch matters, deltas never refer to snapshots we haven't acked,
+                # so the decoder skips older states by their length headers without decoding them
+                latest = None
+                for msg_type, body in frames.frames(latest_only=protocol.STATE_MESSAGES):
+                    if msg_type in protocol.STATE_MESSAGES:
+                        latest = (msg_type, body)
+                
+                if latest is not None:
+                    self.apply_binary_state(latest[0], latest[1], snapshots)
+                
+                if not frames.recv_into(self.client_socket):
                     print("Connection closed by server")
                     self.connected = False
                     break
+            except ConnectionResetError:
+                print("Connection reset by server")
+                self.connected = False
+                break
+            except Exception as e:
+                print(f"Error receiving game state: {e}")
+                self.connected = False
+                break
+    
+    def receive_spectator_states(self):
+        # Each spectator delta is based on the state sent just before it (see broadcast.Broadcast),
+        # so every state is decoded to keep the chain and only the newest of a read is applied.
+        # Should the chain break anyway, watching again starts it over from a full snapshot.
+        frames = protocol.FrameDecoder()
+        frames.feed(self.received)
+        baselines = {}
+        
+        while self.running and self.connected:
+            try:
+                latest = None
+                chain_broken = False
+                for msg_type, body in frames.frames():
+                    if msg_type == protocol.MSG_SNAPSHOT:
+                        seq, values = protocol.decode_snapshot(body)
+                    elif msg_type == protocol.MSG_DELTA:
+                        seq, values = protocol.decode_delta(body, baselines)
+                    else:
+                        continue
+                    if values is None:
+                        chain_broken = True
+                        break
+                    baselines = {seq: values}
+                    latest = values
                 
-                buffer += data
+                if latest is not None:
+                    self.apply_state(protocol.state_dict(latest))
                 
-                # Process complete JSON messages
-                while True:
-                    try:
-                        # Find a complete JSON object by looking for opening and closing braces
-                        obj_start = buffer.find("{")
-                        if obj_start == -1:
-                            buffer = ""  # Clear invalid data
-                            break
-                            
-                        # Count braces to find the end of the complete JSON object
-                        brace_count = 0
-                        obj_end = -1
-                        
-                        for i in range(obj_start, len(buffer)):
-                            if buffer[i] == '{':
-                                brace_count += 1
-                            elif buffer[i] == '}':
-                                brace_count -= 1
-                                if brace_count == 0:
-                                    obj_end = i
-                                    break
-                        
-                        if obj_end == -1:
-                            # Incomplete JSON, wait for more data
-                            break
-                            
-                        # Extract and process the JSON object
-                        json_str = buffer[obj_start:obj_end + 1]
-                        buffer = buffer[obj_end + 1:]
-                        
-                        parsed_state = json.loads(json_str)
-                        self.game_state = parsed_state
-                        
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding JSON: {e}")
-                        # Remove potentially corrupted data up to the next opening brace
-                        next_obj = buffer.find("{", 1)
-                        if next_obj != -1:
-                            buffer = buffer[next_obj:]
-                        else:
-                            buffer = ""
+                if chain_broken:
+                    print(f"Lost track of match {self.watching}, watching it again")
+                    if not self.watch_again():
+                        self.connected = False
                         break
-                    except Exception as e:
-                        print(f"Error processing game state: {e}")
-                        buffer = ""
-                        break
-                        
+                    frames = protocol.FrameDecoder()
+                    frames.feed(self.received)
+                    baselines = {}
+                    continue
+                
+                if not frames.recv_into(self.client_socket):
+                    print("Connection closed by server")
+                    self.connected = False
+                    break
+            except ConnectionResetError:
+                print("Connection reset by server")
+                self.connected = False
+                break
+            except Exception as e:
+                print(f"Error receiving game state: {e}")
+                self.connected = False
+                break
+    
+    def receive_udp_states(self):
+        frames = protocol.FrameDecoder()
+        snapshots = {}
+        newest_seq = 0  # States arrive unordered, anything not newer than this is stale
+        
+        while self.running and self.connected:
+            try:
+                data, messages = self.poll_udp()
+                for message in messages:
+                    self.apply_event(message)
+                if data is not None:
+                    frames.feed(data)
+                    latest = None
+                    for msg_type, body in frames.frames(latest_only=protocol.STATE_MESSAGES):
+                        if msg_type in protocol.STATE_MESSAGES:
+                            latest = (msg_type, body)
+                    if latest is not None and protocol.state_seq(latest[1]) > newest_seq:
+                        newest_seq = self.apply_binary_state(latest[0], latest[1], snapshots) or newest_seq
+                    frames.clear()
+                
+                if time.monotonic() - self.peer.last_heard > udp.PEER_TIMEOUT:
+                    print("Connection to server lost")
+                    self.connected = False
+                    break
+            except Exception as e:
+                print(f"Error receiving game state: {e}")
+                self.connected = False
+                break
+    
+    def apply_binary_state(self, msg_type, body, snapshots):
+        # Decode a snapshot or delta, apply and acknowledge it, returns its sequence number or None
+        if msg_type == protocol.MSG_SNAPSHOT:
+            seq, values = protocol.decode_snapshot(body)
+        else:
+            seq, values = protocol.decode_delta(body, snapshots)
+        
+        if values is None:
+            # Baseline lost, ask for a full snapshot
+            self.send_command("request_state")
+            return None
+        snapshots[seq] = values
+        protocol.prune_baselines(snapshots, seq, SNAPSHOT_HISTORY)
+        # Snapshot numbers give evenly spaced server times, however the packets arrived
+        server_time = seq * self.snapshot_interval if self.snapshot_interval else None
+        self.apply_state(protocol.state_dict(values), server_time)
+        self.send_message(protocol.encode_ack(seq))
+        return seq
+    
+    def apply_event(self, message):
+        # Reliable score and winner events, UDP states carrying them may have been lost
+        if not isinstance(message, dict) or "event" not in message:
+            return
+        with self.state_lock:
+            self.match_info = {"score": message["score"], "winner": message["winner"]}
+        if message["event"] == "winner":
+            print(f"{message['winner']} wins!")
+        elif message["event"] == "restart":
+            print("Game restarted")
+    
+    def receive_json_states(self):
+        decoder = protocol.JsonStreamDecoder()
+        decoder.feed(self.received)
+        
+        while self.running and self.connected:
+            try:
+                # Parse only the newest complete state, older ones in the backlog are dropped unparsed
+                try:
+                    state = decoder.latest()
+                    if state is not None:
+                        self.apply_state(state)
+                except json.JSONDecodeError as e:
+                    print(f"Error decoding JSON: {e}")
+                
+                if not decoder.recv_into(self.client_socket):
+                    print("Connection closed by server")
+                    self.connected = False
+                    break
             except ConnectionResetError:
                 print("Connection reset by server")
                 self.connected = False
@@ -161,24 +530,89 @@ class PongClient:
                 self.connected = False
                 break
     
+    def apply_state(self, state, server_time=None):
+        with self.state_lock:
+            self.game_state = state
+            now = time.perf_counter()
+            self.snapshot_buffer.add(now if server_time is None else server_time, state, now)
+            if self.player_number is None:
+                return  # Spectating, no paddle of our own
+            
+            server_y = state[f"player{self.player_number}"]["y"]
+            input_seq = state.get("input_seq")
+            if input_seq is None:
+                # Server doesn't acknowledge moves, show its paddle as is
+                self.pending_inputs.clear()
+                self.predicted_y = server_y
+                return
+            
+            # Reconcile: start from the server's paddle and replay the moves it hasn't processed yet
+            acked_seq = input_seq[f"player{self.player_number}"]
+            while self.pending_inputs and protocol.input_acked(self.pending_inputs[0][0], acked_seq):
+                self.pending_inputs.popleft()
+            predicted_y = server_y
+            for seq, direction in self.pending_inputs:
+                predicted_y = move_paddle_y(predicted_y, direction)
+            self.predicted_y = predicted_y
+    
+    def send_message(self, message):
+        if self.peer is None:
+            self.client_socket.send(message)
+            return
+        with self.peer_lock:
+            self.peer.send_state(message)
+    
+    def send_command(self, name, seq=0):
+        # Encode a command for the negotiated protocol, name is "up", "down", "restart" or "request_state"
+        if self.peer is not None and name == "restart":
+            # Must not be lost, so it goes reliably
+            with self.peer_lock:
+                self.peer.send_reliable({"restart": True})
+            return
+        if self.protocol == protocol.BINARY_PROTOCOL:
+            if name in protocol.MOVE_MESSAGES:
+                message = protocol.encode_move(name, seq, self.view_seq())
+            elif name == "restart":
+                message = protocol.encode_frame(protocol.MSG_RESTART)
+            else:
+                message = protocol.encode_frame(protocol.MSG_REQUEST_STATE)
+        elif name in protocol.MOVE_MESSAGES:
+            message = json.dumps({"move": name, "seq": seq}).encode()
+        else:
+            message = json.dumps({name: True}).encode()
+        self.send_message(message)
+    
+    def view_seq(self):
+        # The snapshot the player is looking at, the server rewinds to it to judge paddle hits
+        render_time = self.snapshot_buffer.render_time
+        if render_time is None or not self.snapshot_interval:
+            return None
+        return max(0, int(render_time / self.snapshot_interval))
+    
     def send_movement(self, direction):
-        if not self.connected:
+        if not self.connected or self.spectate:
             return
             
+        # Move our paddle right away instead of waiting a round trip for the server
+        with self.state_lock:
+            self.input_seq = (self.input_seq + 1) % protocol.INPUT_SEQ_MODULO
+            seq = self.input_seq
+            self.pending_inputs.append((seq, direction))
+            if self.predicted_y is not None:
+                self.predicted_y = move_paddle_y(self.predicted_y, direction)
+        
         try:
-            command = {"move": direction}
-            self.client_socket.send(json.dumps(command).encode())
+            self.send_command(direction, seq)
         except:
             print("Error sending movement")
             self.connected = False
     
     def send_restart(self):
-        if not self.connected:
+        if not self.connected or self.spectate:
             return
             
         try:
-            command = {"restart": True}
-            self.client_socket.send(json.dumps(command).encode())
+            self.send_command("restart")
         except:
             print("Error sending restart command")
             self.connected = False
@@ -196,7 +630,7 @@ class PongClient:
                 if event.type == pygame.QUIT:
                     self.running = False
                 elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_r and self.game_state and self.game_state.get("winner"):
+                    if event.key == pygame.K_r and self.game_state and (self.match_info or self.game_state).get("winner"):
                         self.send_restart()
                     elif event.key == pygame.K_ESCAPE:
                         self.running = False
@@ -216,88 +650,164 @@ class PongClient:
         
         # Clean up
         if self.connected:
+            if self.peer is not None:
+                # Best effort, the server times us out if this is lost
+                with self.peer_lock:
+                    self.peer.send_reliable({"leave": True})
+                    if self.network_shim is not None:
+                        # Let the delayed datagrams out before the socket goes
+                        time.sleep(self.network_shim.latency + self.network_shim.jitter)
+                        self.network_shim.flush()
             self.client_socket.close()
         pygame.quit()
         sys.exit()
     
+    def text(self, font, string):
+        # The rendered surface for string, rendering it only the first time it's shown
+        key = (font, string)
+        surface = self.text_cache.get(key)
+        if surface is None:
+            if len(self.text_cache) >= TEXT_CACHE_SIZE:
+                self.text_cache.clear()
+            surface = self.text_cache[key] = font.render(string, True, WHITE)
+        return surface
+    
+    def centered(self, font, string, center):
+        surface = self.text(font, string)
+        return surface, tuple(surface.get_rect(center=center))
+    
+    def at(self, font, string, position):
+        surface = self.text(font, string)
+        return surface, (position[0], position[1], surface.get_width(), surface.get_height())
+    
+    def compose(self):
+        # The scene to draw and its sprites, (surface, rect) or (None, rect) for a white rectangle
+        if not self.connected:
+            return "disconnected", [
+                self.centered(self.font, "Disconnected from server", (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 - 20)),
+                self.centered(self.font, "Please restart the application", (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 + 20)),
+            ]
+        if not self.game_state:
+            # Display waiting message when not receiving game state
+            return "waiting", [
+                self.centered(self.font, "Waiting for game state...", (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2)),
+            ]
+        
+        # Sample the state once per frame so everything drawn is from the same moment
+        with self.state_lock:
+            state = self.snapshot_buffer.sample(time.perf_counter())
+        
+        # Paddles, our own one where prediction has it
+        player1_y = state["player1"]["y"]
+        player2_y = state["player2"]["y"]
+        if self.predicted_y is not None:
+            if self.player_number == 1:
+                player1_y = self.predicted_y
+            else:
+                player2_y = self.predicted_y
+        sprites = [
+            (None, (0, int(player1_y), PADDLE_WIDTH, PADDLE_HEIGHT)),
+            (None, (WINDOW_WIDTH - PADDLE_WIDTH, int(player2_y), PADDLE_WIDTH, PADDLE_HEIGHT)),
+            (None, (int(state["ball"]["x"]), int(state["ball"]["y"]), BALL_SIZE, BALL_SIZE)),
+            self.at(self.font, str(state["score"]["player1"]), (WINDOW_WIDTH // 4, 20)),
+            self.at(self.font, str(state["score"]["player2"]), (WINDOW_WIDTH * 3 // 4, 20)),
+        ]
+        
+        # Countdown if active
+        if state["countdown"] is not None:
+            sprites.append(self.centered(self.large_font, str(state["countdown"]), (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2)))
+        
+        # Winner message if game is over
+        if state["winner"]:
+            sprites.append(self.centered(self.large_font, f"{state['winner']} wins!",
+                                         (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 - 50)))
+            if not self.spectate:
+                sprites.append(self.centered(self.font, "Press R to restart", (WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 + 50)))
+        
+        if self.spectate:
+            sprites.append(self.at(self.font, f"Watching match {self.watching}, ESC to quit", (10, WINDOW_HEIGHT - 40)))
+        else:
+            # Player indicator and controls reminder
+            sprites.append(self.at(self.font, f"You are Player {self.player_number}", (10, WINDOW_HEIGHT - 40)))
+            sprites.append(self.at(self.font, "Controls: ↑/↓ arrows to move, ESC to quit",
+                                   (WINDOW_WIDTH // 2 - 180, WINDOW_HEIGHT - 40)))
+        return "game", sprites
+    
     def render(self):
-        # Clear the screen
-        self.screen.fill(BLACK)
+        frame_start = time.perf_counter()
+        scene, sprites = self.compose()
+        if self.show_frame_time and self.frame_time_text:
+            sprites.append(self.at(self.small_font, self.frame_time_text, (10, 10)))
+        background = self.background if scene == "game" else self.blank
         
-        if not self.connected:
-            disconnected_text = self.font.render("Disconnected from server", True, WHITE)
-            text_rect = disconnected_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 - 20))
-            retry_text = self.font.render("Please restart the application", True, WHITE)
-            retry_rect = retry_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 + 20))
-            self.screen.blit(disconnected_text, text_rect)
-            self.screen.blit(retry_text, retry_rect)
-        elif self.game_state:
-            # Draw paddles
-            pygame.draw.rect(self.screen, WHITE, 
-                            (0, self.game_state["player1"]["y"], PADDLE_WIDTH, PADDLE_HEIGHT))
-            pygame.draw.rect(self.screen, WHITE, 
-                            (WINDOW_WIDTH - PADDLE_WIDTH, self.game_state["player2"]["y"], 
-                            PADDLE_WIDTH, PADDLE_HEIGHT))
-            
-            # Draw ball
-            pygame.draw.rect(self.screen, WHITE, 
-                           (self.game_state["ball"]["x"], self.game_state["ball"]["y"], 
-                            BALL_SIZE, BALL_SIZE))
-            
-            # Draw center line
-            for y in range(0, WINDOW_HEIGHT, 20):
-                pygame.draw.rect(self.screen, WHITE, (WINDOW_WIDTH // 2 - 2, y, 4, 10))
-            
-            # Draw scores
-            score_1 = self.font.render(str(self.game_state["score"]["player1"]), True, WHITE)
-            score_2 = self.font.render(str(self.game_state["score"]["player2"]), True, WHITE)
-            self.screen.blit(score_1, (WINDOW_WIDTH // 4, 20))
-            self.screen.blit(score_2, (WINDOW_WIDTH * 3 // 4, 20))
-            
-            # Draw countdown if active
-            if self.game_state["countdown"] is not None:
-                countdown_text = self.large_font.render(str(self.game_state["countdown"]), True, WHITE)
-                text_rect = countdown_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2))
-                self.screen.blit(countdown_text, text_rect)
-            
-            # Draw winner message if game is over
-            if self.game_state["winner"]:
-                winner_text = self.large_font.render(f"{self.game_state['winner']} wins!", True, WHITE)
-                restart_text = self.font.render("Press R to restart", True, WHITE)
-                
-                winner_rect = winner_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 - 50))
-                restart_rect = restart_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2 + 50))
-                
-                self.screen.blit(winner_text, winner_rect)
-                self.screen.blit(restart_text, restart_rect)
-            
-            # Draw player indicator
-            player_text = self.font.render(f"You are Player {self.player_number}", True, WHITE)
-            self.screen.blit(player_text, (10, WINDOW_HEIGHT - 40))
-            
-            # Controls reminder
-            controls_text = self.font.render("Controls: ↑/↓ arrows to move, ESC to quit", True, WHITE)
-            self.screen.blit(controls_text, (WINDOW_WIDTH // 2 - 180, WINDOW_HEIGHT - 40))
+        full_redraw = scene != self.scene or not self.dirty_rects
+        if full_redraw:
+            self.screen.blit(background, (0, 0))
         else:
-            # Display waiting message when not receiving game state
-            waiting_text = self.font.render("Waiting for game state...", True, WHITE)
-            text_rect = waiting_text.get_rect(center=(WINDOW_WIDTH // 2, WINDOW_HEIGHT // 2))
-            self.screen.blit(waiting_text, text_rect)
+            # Erase last frame's sprites
+            for _, rect in self.sprites:
+                self.screen.blit(background, rect, rect)
         
-        # Update the display
-        pygame.display.flip()
+        # Everything is drawn again, it's cheap next to sending pixels to the display, and
+        # sprites that an erased one overlapped come back whole
+        for surface, rect in sprites:
+            if surface is None:
+                self.screen.fill(WHITE, rect)
+            else:
+                self.screen.blit(surface, rect)
+        
+        if full_redraw:
+            pygame.display.flip()
+            updated = WINDOW_WIDTH * WINDOW_HEIGHT
+        else:
+            # Only what moved or changed goes to the display: where it was and where it is now
+            changed = [rect for _, rect in set(self.sprites).symmetric_difference(sprites)]
+            pygame.display.update(changed)
+            updated = sum(rect[2] * rect[3] for rect in changed)
+        self.scene = scene
+        self.sprites = sprites
+        
+        if self.show_frame_time:
+            self.frame_times.append(time.perf_counter() - frame_start)
+            self.updated_pixels += updated
+            if frame_start - self.frame_time_reset >= FRAME_TIME_INTERVAL:
+                frames = len(self.frame_times)
+                self.frame_time_text = (f"frame {sum(self.frame_times) / frames * 1000:.2f} ms "
+                                        f"(max {max(self.frame_times) * 1000:.2f}), "
+                                        f"{self.updated_pixels / frames / (WINDOW_WIDTH * WINDOW_HEIGHT) * 100:.1f}% "
+                                        f"of the screen updated, {self.clock.get_fps():.0f} fps")
+                self.frame_times.clear()
+                self.updated_pixels = 0
+                self.frame_time_reset = frame_start
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pong client")
+    parser.add_argument("--udp", action="store_true", help="play over UDP, the server must be started with --udp")
+    parser.add_argument("--loss", type=float, default=0.0, help="simulated loss of UDP datagrams sent, 0 to 1")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated delay of UDP datagrams sent, in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- variation of that delay, in ms")
+    parser.add_argument("--spectate", action="store_true", help="watch a match from the server's spectator port")
+    parser.add_argument("--room", type=int, help="match to watch, any match being played by default")
+    parser.add_argument("--frame-time", action="store_true", help="show how long drawing each frame takes")
+    parser.add_argument("--full-redraw", action="store_true",
+                        help="redraw the whole window every frame instead of only what changed")
+    parser.add_argument("--name", help="your name in the server's match history and leaderboard")
+    args = parser.parse_args()
+    
     # Ask for server address
     server_host = input("Enter server IP (default: localhost): ").strip()
     if not server_host:
         server_host = "localhost"
     
+    default_port = broadcast.SPECTATOR_PORT if args.spectate else 5555
     try:
-        server_port = int(input("Enter server port (default: 5555): ").strip())
+        server_port = int(input(f"Enter server port (default: {default_port}): ").strip())
     except:
-        server_port = 5555
+        server_port = default_port
     
-    client = PongClient(server_host, server_port)
+    client = PongClient(server_host, server_port, use_udp=args.udp,
+                        loss=args.loss, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                        spectate=args.spectate, room_id=args.room,
+                        show_frame_time=args.frame_time, dirty_rects=not args.full_redraw, name=args.name)
     client.run()
\ No newline at end of file
@@ -0,0 +1,266 @@
+from game import (PongGame, WINDOW_WIDTH, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_SIZE, BALL_SPEED, TICK_RATE,
+                  WINNING_SCORE, BALL_MAX_Y, BALL_RIGHT_CONTACT_X, MAX_BOUNCES)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Physics engines step every game a server hosts. new_game() hands out a game that behaves like
+# a PongGame for everything outside the step (paddle moves, state reads, restarts) and step(dt)
+# advances all of them at once.
+
+WINNER_CODES = {None: 0, "Player 1": 1, "Player 2": 2}
+WINNER_NAMES = {code: name for name, code in WINNER_CODES.items()}
+INITIAL_CAPACITY = 64
+
+
+class ScalarEngine:
+    # The reference engine, one PongGame.step call per game
+    name = "scalar"
+
+    def __init__(self):
+        self.games = {}  # Insertion ordered, so games step in the order they were created
+
+    def new_game(self, seed=None):
+        game = PongGame(seed)
+        self.games[id(game)] = game
+        return game
+
+    def remove_game(self, game):
+        self.games.pop(id(game), None)
+
+    def step(self, dt=TICK_RATE):
+        for game in self.games.values():
+            game.step(dt)
+
+
+def _array_field(name, to_python):
+    # A PongGame attribute stored in one element of the engine's arrays
+    def get(self):
+        return to_python(self.engine.arrays[name][self.index])
+
+    def set(self, value):
+        self.engine.arrays[name][self.index] = value
+
+    return property(get, set)
+
+
+def _optional_float(value):
+    return None if value != value else float(value)  # NaN stands for None
+
+
+class NumpyGame(PongGame):
+    __slots__ = ("engine", "index")
+
+    ball_x = _array_field("ball_x", float)
+    ball_y = _array_field("ball_y", float)
+    ball_velocity_x = _array_field("ball_velocity_x", float)
+    ball_velocity_y = _array_field("ball_velocity_y", float)
+    player1_y = _array_field("player1_y", float)
+    player2_y = _array_field("player2_y", float)
+    score_player1 = _array_field("score_player1", int)
+    score_player2 = _array_field("score_player2", int)
+    game_active = _array_field("game_active", bool)
+    countdown = _array_field("countdown", int)
+    clock = _array_field("clock", float)
+
+    def __init__(self, engine, index, seed=None):
+        self.engine = engine
+        self.index = index
+        super().__init__(seed)
+
+    @property
+    def countdown_timer(self):
+        return _optional_float(self.engine.arrays["countdown_timer"][self.index])
+
+    @countdown_timer.setter
+    def countdown_timer(self, value):
+        self.engine.arrays["countdown_timer"][self.index] = float("nan") if value is None else value
+
+    @property
+    def winner(self):
+        return WINNER_NAMES[int(self.engine.arrays["winner"][self.index])]
+
+    @winner.setter
+    def winner(self, value):
+        self.engine.arrays["winner"][self.index] = WINNER_CODES[value]
+
+
+class NumpyEngine:
+    # Struct-of-arrays engine: one array per game attribute, every game stepped by whole-array
+    # operations. Matches PongGame.step for each game, the random draws after a point come from
+    # each game's own generator as they do there.
+    name = "numpy"
+
+    FIELDS = {
+        "ball_x": "float64", "ball_y": "float64",
+        "ball_velocity_x": "float64", "ball_velocity_y": "float64",
+        "player1_y": "float64", "player2_y": "float64",
+        "score_player1": "int32", "score_player2": "int32",
+        "game_active": "bool", "countdown": "int32", "countdown_timer": "float64",
+        "winner": "int8", "clock": "float64",
+    }
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        if np is None:
+            raise RuntimeError("The numpy engine needs numpy, install it with 'pip install numpy'")
+        self.capacity = 0
+        self.arrays = {}
+        self.games = {}  # NumpyGame indexed by its slot
+        self.free_slots = []
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        for name, dtype in self.FIELDS.items():
+            array = np.zeros(capacity, dtype=dtype)
+            if name == "countdown_timer":
+                array[:] = np.nan
+            if name in self.arrays:
+                array[:self.capacity] = self.arrays[name]
+            self.arrays[name] = array
+        # Hand out low slots first so games step in creation order while no slot is reused
+        self.free_slots = list(range(capacity - 1, self.capacity - 1, -1)) + self.free_slots
+        self.capacity = capacity
+
+    def new_game(self, seed=None):
+        if not self.free_slots:
+            self.grow(self.capacity * 2)
+        index = self.free_slots.pop()
+        game = NumpyGame(self, index, seed)
+        self.games[index] = game
+        return game
+
+    def remove_game(self, game):
+        if self.games.pop(game.index, None) is None:
+            return
+        # Park the slot so stepping leaves it alone until it is handed out again
+        self.arrays["game_active"][game.index] = False
+        self.arrays["countdown_timer"][game.index] = np.nan
+        self.free_slots.append(game.index)
+
+    def step(self, dt=TICK_RATE):
+        a = self.arrays
+        a["clock"] += dt
+        clock = a["clock"]
+
+        # Countdowns, as in PongGame.update_countdown
+        timer = a["countdown_timer"]
+        due = clock >= timer  # False for NaN, i.e. no countdown running
+        if due.any():
+            a["countdown"][due] -= 1
+            started = due & (a["countdown"] <= 0)
+            ticking = due & ~started
+            a["game_active"][started] = True
+            timer[started] = np.nan
+            timer[ticking] = clock[ticking] + 1
+
+        active = a["game_active"]
+        if not active.any():
+            return
+        indices = np.flatnonzero(active)
+
+        # Sweep the balls through the step as PongGame.update does: each round finds every
+        # ball's first contact in the time it has left and bounces it there. Games drop out of
+        # the rounds once nothing else is reached, so the rounds shrink to the few fast balls.
+        scale = dt / TICK_RATE
+        x = a["ball_x"][indices]
+        y = a["ball_y"][indices]
+        velocity_x = a["ball_velocity_x"][indices]
+        velocity_y = a["ball_velocity_y"][indices]
+        player1_y = a["player1_y"][indices]
+        player2_y = a["player2_y"][indices]
+        remaining = np.ones(len(indices))
+        passed_left = np.zeros(len(indices), dtype=bool)
+        passed_right = np.zeros(len(indices), dtype=bool)
+        live = np.arange(len(indices))  # Games whose ball may still reach something this step
+        for _ in range(MAX_BOUNCES):
+            if not len(live):
+                break
+            ball_x = x[live]
+            ball_y = y[live]
+            dx = velocity_x[live] * scale
+            dy = velocity_y[live] * scale
+            
+            # Earliest contact, walls before paddles when they tie
+            up = dy < 0
+            down = dy > 0
+            wall_time = np.full(len(live), np.inf)
+            wall_time[up] = -ball_y[up] / dy[up]
+            wall_time[down] = (BALL_MAX_Y - ball_y[down]) / dy[down]
+            left = (dx < 0) & ~passed_left[live] & (ball_x >= PADDLE_WIDTH)
+            right = (dx > 0) & ~passed_right[live] & (ball_x <= BALL_RIGHT_CONTACT_X)
+            face_time = np.full(len(live), np.inf)
+            face_time[left] = (PADDLE_WIDTH - ball_x[left]) / dx[left]
+            face_time[right] = (BALL_RIGHT_CONTACT_X - ball_x[right]) / dx[right]
+            time_left = remaining[live]
+            face = face_time < np.minimum(wall_time, time_left)
+            wall = ~face & (wall_time < time_left)
+            contact = face | wall
+            first = np.where(face, face_time, wall_time)[contact]
+            first[first < 0] = 0.0  # Already past a wall, bounce straight away
+            
+            live = live[contact]
+            dx = dx[contact]
+            dy = dy[contact]
+            x[live] = ball_x[contact] + dx * first
+            y[live] = ball_y[contact] + dy * first
+            remaining[live] = time_left[contact] - first
+            
+            # Ball collision with top and bottom walls
+            wall = wall[contact]
+            top = live[wall & (dy < 0)]
+            bottom = live[wall & (dy > 0)]
+            y[top] = 0.0
+            y[bottom] = BALL_MAX_Y
+            velocity_y[top] = -velocity_y[top]
+            velocity_y[bottom] = -velocity_y[bottom]
+            
+            # Ball collision with paddles
+            # Player 1 paddle (left), then player 2 paddle (right)
+            face = ~wall
+            for games, paddle_y, contact_x, passed in ((live[face & (dx < 0)], player1_y, PADDLE_WIDTH, passed_left),
+                                                       (live[face & (dx > 0)], player2_y, BALL_RIGHT_CONTACT_X,
+                                                        passed_right)):
+                x[games] = contact_x
+                ball_y = y[games]
+                paddle = paddle_y[games]
+                hit = (ball_y + BALL_SIZE >= paddle) & (ball_y <= paddle + PADDLE_HEIGHT)
+                hits = games[hit]
+                velocity_x[hits] *= -1.1  # Increase speed slightly
+                # Change angle based on where the ball hits the paddle
+                paddle_center = paddle[hit] + PADDLE_HEIGHT // 2
+                offset = (ball_y[hit] + BALL_SIZE // 2 - paddle_center) / (PADDLE_HEIGHT // 2)
+                velocity_y[hits] = BALL_SPEED * offset
+                passed[games[~hit]] = True
+        
+        ball_x = x + velocity_x * scale * remaining
+        ball_y = y + velocity_y * scale * remaining
+        a["ball_x"][indices] = ball_x
+        a["ball_y"][indices] = ball_y
+        a["ball_velocity_x"][indices] = velocity_x
+        a["ball_velocity_y"][indices] = velocity_y
+
+        # Ball out of bounds (scoring) is rare, finish those games one at a time
+        scored = indices[(ball_x < 0) | (ball_x > WINDOW_WIDTH)]
+        for index in scored.tolist():
+            game = self.games[index]
+            if game.ball_x < 0:
+                game.score_player2 += 1
+                game.reset_ball()
+                if game.score_player2 >= WINNING_SCORE:
+                    game.winner = "Player 2"
+                    game.game_active = False
+            else:
+                game.score_player1 += 1
+                game.reset_ball()
+                if game.score_player1 >= WINNING_SCORE:
+                    game.winner = "Player 1"
+                    game.game_active = False
+
+
+ENGINES = {engine.name: engine for engine in (ScalarEngine, NumpyEngine)}
+
+
+def create_engine(name):
+    return ENGINES[name]()
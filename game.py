@@ -0,0 +1,213 @@
+import random
+
+# Game settings
+WINDOW_WIDTH = 800
+WINDOW_HEIGHT = 600
+PADDLE_WIDTH = 15
+PADDLE_HEIGHT = 100
+BALL_SIZE = 15
+BALL_SPEED = 5
+TICK_RATE = 1 / 60  # 60 FPS, ball and paddle speeds are per tick of this length
+WINNING_SCORE = 5
+PADDLE_SPEED = 15  # Increased from 10
+
+# Ball positions (its top left corner) where it touches a wall or paddle face
+BALL_MAX_Y = WINDOW_HEIGHT - BALL_SIZE
+BALL_RIGHT_CONTACT_X = WINDOW_WIDTH - PADDLE_WIDTH - BALL_SIZE
+MAX_BOUNCES = 32  # Contacts resolved in one step, only a ball crossing the court many times a step gets near
+
+
+def move_paddle_y(paddle_y, direction):
+    # One paddle move, shared by PongGame.move_paddle and the client's prediction of its own paddle
+    if direction == "up" and paddle_y > 0:
+        return paddle_y - PADDLE_SPEED
+    elif direction == "down" and paddle_y < WINDOW_HEIGHT - PADDLE_HEIGHT:
+        return paddle_y + PADDLE_SPEED
+    return paddle_y
+
+
+class PongGame:
+    # Slots instead of a __dict__: smaller games and faster attribute access in the step
+    __slots__ = ("ball_x", "ball_y", "ball_velocity_x", "ball_velocity_y", "player1_y", "player2_y",
+                 "score_player1", "score_player2", "game_active", "countdown", "countdown_timer", "winner", "clock",
+                 "seed", "rng_state")
+    
+    def __init__(self, seed=None):
+        # Every random draw comes from the game's own generator, so the seed and the paddle moves
+        # replay a match exactly
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.rng_state = self.seed & 0xFFFFFFFF or 1  # Xorshift state, must not be zero
+        
+        # Game state
+        self.ball_x = WINDOW_WIDTH // 2
+        self.ball_y = WINDOW_HEIGHT // 2
+        self.ball_velocity_x = BALL_SPEED * self.random_sign()
+        self.ball_velocity_y = BALL_SPEED * 0.5 * self.random_sign()
+        
+        self.player1_y = WINDOW_HEIGHT // 2 - PADDLE_HEIGHT // 2
+        self.player2_y = WINDOW_HEIGHT // 2 - PADDLE_HEIGHT // 2
+        
+        self.score_player1 = 0
+        self.score_player2 = 0
+        
+        self.game_active = False
+        self.countdown = 3
+        self.countdown_timer = None
+        self.winner = None
+        
+        # Simulation time in seconds, countdowns run on it so a busy server can't skip them
+        self.clock = 0.0
+
+    def step(self, dt=TICK_RATE):
+        self.clock += dt
+        self.update_countdown()
+        self.update(dt)
+
+    def update(self, dt=TICK_RATE):
+        if not self.game_active:
+            return
+        
+        # Sweep the ball through the step instead of jumping it there and checking for overlaps,
+        # so a fast ball can't pass through a paddle or bounce off a wall twice. Find the first
+        # wall or paddle face the ball reaches, move it there, bounce and carry on with the time
+        # left, until nothing else is reached this step. Velocities are per TICK_RATE so scale
+        # them to the step length.
+        scale = dt / TICK_RATE
+        x, y = self.ball_x, self.ball_y
+        velocity_x, velocity_y = self.ball_velocity_x, self.ball_velocity_y
+        remaining = 1.0  # Fraction of the step left to move
+        passed_left = passed_right = False  # Paddle faces the ball reached beside the paddle
+        for _ in range(MAX_BOUNCES):
+            dx = velocity_x * scale
+            dy = velocity_y * scale
+            
+            # Earliest contact, walls before paddles when they tie
+            first = remaining
+            contact = None
+            if dy < 0:
+                time = -y / dy
+                if time < first:
+                    first, contact = time, "top"
+            elif dy > 0:
+                time = (BALL_MAX_Y - y) / dy
+                if time < first:
+                    first, contact = time, "bottom"
+            if dx < 0 and not passed_left and x >= PADDLE_WIDTH:
+                time = (PADDLE_WIDTH - x) / dx
+                if time < first:
+                    first, contact = time, "left"
+            elif dx > 0 and not passed_right and x <= BALL_RIGHT_CONTACT_X:
+                time = (BALL_RIGHT_CONTACT_X - x) / dx
+                if time < first:
+                    first, contact = time, "right"
+            if contact is None:
+                break
+            if first < 0:
+                first = 0.0  # Already past a wall, bounce straight away
+            x += dx * first
+            y += dy * first
+            remaining -= first
+            
+            # Ball collision with top and bottom walls
+            if contact == "top":
+                y = 0.0
+                velocity_y = -velocity_y
+            elif contact == "bottom":
+                y = BALL_MAX_Y
+                velocity_y = -velocity_y
+            
+            # Ball collision with paddles
+            # Player 1 paddle (left)
+            elif contact == "left":
+                x = PADDLE_WIDTH
+                if y + BALL_SIZE >= self.player1_y and y <= self.player1_y + PADDLE_HEIGHT:
+                    velocity_x *= -1.1  # Increase speed slightly
+                    # Change angle based on where the ball hits the paddle
+                    paddle_center = self.player1_y + PADDLE_HEIGHT // 2
+                    offset = (y + BALL_SIZE // 2 - paddle_center) / (PADDLE_HEIGHT // 2)
+                    velocity_y = BALL_SPEED * offset
+                else:
+                    passed_left = True
+            
+            # Player 2 paddle (right)
+            else:
+                x = BALL_RIGHT_CONTACT_X
+                if y + BALL_SIZE >= self.player2_y and y <= self.player2_y + PADDLE_HEIGHT:
+                    velocity_x *= -1.1  # Increase speed slightly
+                    # Change angle based on where the ball hits the paddle
+                    paddle_center = self.player2_y + PADDLE_HEIGHT // 2
+                    offset = (y + BALL_SIZE // 2 - paddle_center) / (PADDLE_HEIGHT // 2)
+                    velocity_y = BALL_SPEED * offset
+                else:
+                    passed_right = True
+        
+        self.ball_x = x + velocity_x * scale * remaining
+        self.ball_y = y + velocity_y * scale * remaining
+        self.ball_velocity_x = velocity_x
+        self.ball_velocity_y = velocity_y
+        
+        # Ball out of bounds (scoring)
+        if self.ball_x < 0:
+            self.score_player2 += 1
+            self.reset_ball()
+            if self.score_player2 >= WINNING_SCORE:
+                self.winner = "Player 2"
+                self.game_active = False
+        elif self.ball_x > WINDOW_WIDTH:
+            self.score_player1 += 1
+            self.reset_ball()
+            if self.score_player1 >= WINNING_SCORE:
+                self.winner = "Player 1"
+                self.game_active = False
+    
+    def reset_ball(self):
+        self.ball_x = WINDOW_WIDTH // 2
+        self.ball_y = WINDOW_HEIGHT // 2
+        self.ball_velocity_x = BALL_SPEED * self.random_sign()
+        self.ball_velocity_y = BALL_SPEED * 0.5 * self.random_sign()
+        self.start_countdown(3)
+    
+    def random_sign(self):
+        # -1 or 1 from a 32-bit xorshift generator, the same sequence on every platform and Python version
+        x = self.rng_state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.rng_state = x
+        return 1 if x & 0x80000000 else -1
+    
+    def start_countdown(self, seconds):
+        self.game_active = False
+        self.countdown = seconds
+        self.countdown_timer = self.clock + 1
+    
+    def update_countdown(self):
+        if self.countdown_timer and self.clock >= self.countdown_timer:
+            self.countdown -= 1
+            if self.countdown <= 0:
+                self.game_active = True
+                self.countdown_timer = None
+            else:
+                self.countdown_timer = self.clock + 1
+    
+    def move_paddle(self, player, direction):
+        if player == 1:
+            self.player1_y = move_paddle_y(self.player1_y, direction)
+        elif player == 2:
+            self.player2_y = move_paddle_y(self.player2_y, direction)
+    
+    def get_state(self):
+        return {
+            "ball": {"x": self.ball_x, "y": self.ball_y},
+            "player1": {"y": self.player1_y},
+            "player2": {"y": self.player2_y},
+            "score": {"player1": self.score_player1, "player2": self.score_player2},
+            "countdown": self.countdown if not self.game_active and self.countdown_timer else None,
+            "winner": self.winner
+        }
+    
+    def restart_game(self):
+        self.score_player1 = 0
+        self.score_player2 = 0
+        self.winner = None
+        self.reset_ball()
@@ -0,0 +1,290 @@
+import bisect
+import collections
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+# Server instrumentation. With --metrics-port the server answers HTTP on that port (localhost
+# by default) from its own event loop, nothing else touches the rooms:
+#
+#   GET /metrics          Prometheus text format: tick, send and serialize time histograms,
+#                         per-client queue depth, round trip time and snapshot rate, bytes in
+#                         and out, inputs, tick overruns, lag-compensated hits, match results
+#                         written, rooms, players and why they left
+#   GET /profile/start    start sampling the server loop's stack
+#   GET /profile/stop     stop and answer with the samples as collapsed stacks, one
+#                         "outer;...;inner count" line per stack, the input flamegraph tools take
+#
+# Sending the server SIGUSR1 toggles the profiler as well and writes the profile to a file.
+#
+# Metrics are collected as plain dicts, {name: {"type", "help", "value"}} where the value is a
+# number, a {label value: number} dict for metrics with a label, or a Histogram export. Worker
+# processes send theirs to the main process as JSON and merge_metrics adds them up.
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.0167, 0.025, 0.05, 0.1, 0.25)
+RTT_BUCKETS = (0.005, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+QUEUE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+MAX_REQUEST_SIZE = 8192
+MAX_HTTP_CONNECTIONS = 16
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_TOP_FUNCTIONS = 15  # Functions printed when a profile stops
+
+
+class Histogram:
+    # Cumulative-bucket histogram, observe is a bisect and an increment
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one counts values above every bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def export(self):
+        return {"buckets": self.buckets, "counts": self.counts, "sum": self.sum, "count": self.count}
+
+    @classmethod
+    def of(cls, buckets, values):
+        histogram = cls(buckets)
+        for value in values:
+            histogram.observe(value)
+        return histogram
+
+
+def merge_metrics(collected):
+    # Add up metrics from several processes, each a dict as returned by PongServer.collect_metrics
+    merged = {}
+    for metrics in collected:
+        for name, metric in metrics.items():
+            if name not in merged:
+                merged[name] = dict(metric, value=copy_value(metric["value"]))
+                continue
+            total, value = merged[name]["value"], metric["value"]
+            if isinstance(value, dict) and "buckets" in value:
+                total["counts"] = [a + b for a, b in zip(total["counts"], value["counts"])]
+                total["sum"] += value["sum"]
+                total["count"] += value["count"]
+            elif isinstance(value, dict):
+                for label, number in value.items():
+                    total[label] = total.get(label, 0) + number
+            else:
+                merged[name]["value"] = total + value
+    return merged
+
+
+def copy_value(value):
+    if isinstance(value, dict):
+        return {key: list(item) if isinstance(item, list) else item for key, item in value.items()}
+    return value
+
+
+def render(metrics):
+    # Prometheus text exposition format
+    lines = []
+    for name, metric in metrics.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        value = metric["value"]
+        if isinstance(value, dict) and "buckets" in value:
+            cumulative = 0
+            for bound, count in zip(value["buckets"], value["counts"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {value["count"]}')
+            lines.append(f"{name}_sum {value['sum']}")
+            lines.append(f"{name}_count {value['count']}")
+        elif isinstance(value, dict):
+            for label, number in value.items():
+                lines.append(f'{name}{{{metric["label"]}="{label}"}} {number}')
+        else:
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    # Samples one thread's Python stack from a background thread every PROFILE_INTERVAL seconds.
+    # Unlike cProfile the sampled thread runs untouched, so it can stay on in a loaded server.
+    def __init__(self, thread_id=None, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = collections.Counter()  # Sample count indexed by stack, outermost frame first
+        self.thread = None
+        self.running = False
+        self.started_at = 0.0
+
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self.running = True
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        # Returns the profile as collapsed stacks
+        if not self.running:
+            return ""
+        self.running = False
+        self.thread.join()
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.samples.most_common())
+
+    def top_functions(self, count=PROFILE_TOP_FUNCTIONS):
+        # (share of samples, function) for the functions most often on top of the stack
+        total = sum(self.samples.values()) or 1
+        on_top = collections.Counter()
+        for stack, samples in self.samples.items():
+            on_top[stack[-1]] += samples
+        return [(samples / total, function) for function, samples in on_top.most_common(count)]
+
+    def toggle(self, directory="."):
+        # For the signal handler: start, or stop and write the profile to a file, returns its path
+        if not self.running:
+            self.start()
+            print(f"Profiling process {os.getpid()}, send SIGUSR1 again to stop")
+            return None
+        elapsed = time.monotonic() - self.started_at
+        profile = self.stop()
+        path = os.path.join(directory, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        with open(path, "w") as f:
+            f.write(profile)
+        self.print_summary(elapsed)
+        print(f"Profile written to {path}")
+        return path
+
+    def print_summary(self, elapsed):
+        print(f"Profile of process {os.getpid()}: {sum(self.samples.values())} samples over {elapsed:.1f} s, "
+              f"most time spent in:")
+        for share, function in self.top_functions():
+            print(f"  {share * 100:5.1f}%  {function}")
+
+
+class HttpEndpoint:
+    # A tiny HTTP/1.0 server living in its owner's selector, one request per connection and
+    # answered straight from the event loop. The listener and each connection are registered
+    # with a bound method as their data, the owner's loop calls it with the ready events.
+    # handler(path) returns (status, content type, body text).
+    def __init__(self, host, port, selector, handler):
+        self.selector = selector
+        self.handler = handler
+        self.connections = 0
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen(MAX_HTTP_CONNECTIONS)
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        print(f"Metrics on http://{host}:{port}/metrics")
+
+    def accept(self, events):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if self.connections >= MAX_HTTP_CONNECTIONS:
+                sock.close()
+                continue
+            sock.setblocking(False)
+            self.connections += 1
+            connection = HttpConnection(self, sock)
+            self.selector.register(sock, selectors.EVENT_READ, connection.handle_event)
+
+    def close(self):
+        try:
+            self.selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        self.socket.close()
+
+
+class HttpConnection:
+    def __init__(self, endpoint, sock):
+        self.endpoint = endpoint
+        self.socket = sock
+        self.request = b""
+        self.response = None
+        self.closed = False
+
+    def handle_event(self, events):
+        if self.response is None:
+            self.read()
+        if self.response is not None and not self.closed:
+            self.write()
+
+    def read(self):
+        try:
+            data = self.socket.recv(MAX_REQUEST_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data or len(self.request) + len(data) > MAX_REQUEST_SIZE:
+            self.close()
+            return
+        self.request += data
+        if b"\r\n\r\n" not in self.request and b"\n\n" not in self.request:
+            return
+
+        parts = self.request.split(b"\r\n", 1)[0].split()
+        if len(parts) < 2 or parts[0] != b"GET":
+            status, content_type, body = 405, "text/plain", "Only GET is supported\n"
+        else:
+            status, content_type, body = self.endpoint.handler(parts[1].decode("latin-1").split("?", 1)[0])
+        body = body.encode()
+        reason = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}.get(status, "")
+        self.response = (f"HTTP/1.0 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+        self.endpoint.selector.modify(self.socket, selectors.EVENT_WRITE, self.handle_event)
+
+    def write(self):
+        try:
+            sent = self.socket.send(self.response)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close()
+            return
+        self.response = self.response[sent:]
+        if not self.response:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.endpoint.connections -= 1
+        try:
+            self.endpoint.selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        self.socket.close()
+
+
+def text(body, status=200):
+    return status, "text/plain; charset=utf-8", body
+
+
+def prometheus(metrics):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", render(metrics)
@@ -0,0 +1,362 @@
+import json
+import operator
+import re
+import struct
+
+# Wire protocol shared by server.py and client.py.
+#
+# Both ends start in JSON: the server greets with {"player_number": n, "protocols": [...]}
+# and the client answers with the protocols it speaks, best first. The server replies
+# {"protocol": name} and from then on every message uses the chosen protocol. Clients that
+# skip the handshake keep the original JSON messages.
+#
+# A binary frame is a 2-byte big-endian length followed by that many bytes: one message
+# type byte and a fixed-layout body. The binary protocol name carries its version, a client
+# offering only an older version is answered with JSON.
+#
+# States are numbered snapshots. The client acknowledges the newest snapshot it applied and
+# the server sends each following snapshot as a delta against that acknowledged baseline:
+# a bitmask of the fields that changed followed by just those fields. A full snapshot goes
+# out when the client joins or its baseline is no longer in the server's history.
+#
+# Paddle moves carry a sequence number and every snapshot carries the newest move the server
+# has processed for each player, so clients can replay the moves still in flight on top of it.
+
+BINARY_PROTOCOL = "bin3"
+JSON_PROTOCOL = "json"
+SUPPORTED_PROTOCOLS = [BINARY_PROTOCOL, JSON_PROTOCOL]
+
+FRAME_HEADER = struct.Struct("!H")
+MAX_FRAME_SIZE = 0xFFFF
+RECV_SIZE = 4096
+
+# Server to client
+MSG_SNAPSHOT = 0x01
+MSG_DELTA = 0x02
+STATE_MESSAGES = (MSG_SNAPSHOT, MSG_DELTA)  # A newer one supersedes all earlier ones
+
+# Client to server, the type byte is the whole message
+MSG_MOVE_UP = 0x10
+MSG_MOVE_DOWN = 0x11
+MSG_RESTART = 0x12
+MSG_REQUEST_STATE = 0x13
+MSG_ACK = 0x14
+
+MOVE_MESSAGES = {"up": MSG_MOVE_UP, "down": MSG_MOVE_DOWN}
+MOVE_DIRECTIONS = {MSG_MOVE_UP: "up", MSG_MOVE_DOWN: "down"}
+MOVE_BODY = struct.Struct("!H")  # Input sequence number
+MOVE_VIEW_BODY = struct.Struct("!HI")  # Input sequence number, snapshot the player was looking at (lag compensation)
+INPUT_SEQ_MODULO = 1 << 16
+INTERPOLATION_DELAY = 0.1  # Seconds clients draw states in the past, what they look at lags the server by this too
+
+# ball x, ball y, player 1 y, player 2 y, score 1, score 2, countdown (-1 when none), winner (0 when none),
+# last input sequence processed for player 1 and player 2
+STATE_FIELDS = "ffffBBbBHH"
+STATE_BODY = struct.Struct("!" + STATE_FIELDS)
+SNAPSHOT_HEADER = struct.Struct("!I")  # Snapshot sequence number
+DELTA_HEADER = struct.Struct("!IBH")  # Sequence number, how many snapshots back the baseline is, changed field mask
+ACK_BODY = struct.Struct("!I")
+MAX_BASELINE_AGE = 255
+WINNER_CODES = {None: 0, "Player 1": 1, "Player 2": 2}
+WINNER_NAMES = {code: name for name, code in WINNER_CODES.items()}
+MAX_STATE_FRAME = FRAME_HEADER.size + 1 + DELTA_HEADER.size + STATE_BODY.size  # Largest snapshot or delta frame
+
+# Whole frames up to the changed fields, for writing into a buffer in one call
+SNAPSHOT_FRAME = struct.Struct("!HBI" + STATE_FIELDS)
+DELTA_FRAME_HEADER = struct.Struct("!HBIBH")
+
+# The JSON protocol's state, formatted straight from state values. Produces the same text as
+# json.dumps of PongGame.get_state() with the input sequence numbers added.
+JSON_STATE = ('{"ball": {"x": %r, "y": %r}, "player1": {"y": %r}, "player2": {"y": %r}, '
+              '"score": {"player1": %d, "player2": %d}, "countdown": %s, "winner": %s, '
+              '"input_seq": {"player1": %d, "player2": %d}}')
+JSON_WINNERS = {code: json.dumps(name) for code, name in WINNER_NAMES.items()}
+
+
+def choose_protocol(offered):
+    # Pick the client's most preferred protocol that we also speak, JSON when the offer isn't a list of names
+    if not isinstance(offered, list):
+        return JSON_PROTOCOL
+    for name in offered:
+        if isinstance(name, str) and name in SUPPORTED_PROTOCOLS:
+            return name
+    return JSON_PROTOCOL
+
+
+def encode_frame(msg_type, body=b""):
+    return FRAME_HEADER.pack(len(body) + 1) + bytes((msg_type,)) + body
+
+
+def state_values(game, input_seq1=0, input_seq2=0):
+    # Snapshot of the game in wire order, taken straight from its attributes
+    countdown = game.countdown if not game.game_active and game.countdown_timer else -1
+    return (game.ball_x, game.ball_y, game.player1_y, game.player2_y,
+            game.score_player1, game.score_player2, countdown, WINNER_CODES[game.winner],
+            input_seq1, input_seq2)
+
+
+def encode_move(direction, seq, view_seq=None):
+    if view_seq is None:
+        return encode_frame(MOVE_MESSAGES[direction], MOVE_BODY.pack(seq))
+    return encode_frame(MOVE_MESSAGES[direction], MOVE_VIEW_BODY.pack(seq, view_seq))
+
+
+def decode_move(body):
+    # (input sequence number, snapshot sequence number on screen), older clients send one or neither
+    if len(body) == MOVE_VIEW_BODY.size:
+        return MOVE_VIEW_BODY.unpack(body)
+    if len(body) == MOVE_BODY.size:
+        return MOVE_BODY.unpack(body)[0], None
+    return None, None
+
+
+def input_acked(seq, acked_seq):
+    # True when seq is at or before acked_seq, allowing for the 16-bit counter wrapping around
+    return (acked_seq - seq) % INPUT_SEQ_MODULO < INPUT_SEQ_MODULO // 2
+
+
+_delta_layouts = {}
+
+
+def delta_layout(mask):
+    # Struct of the changed fields selected by mask, and an itemgetter that picks the new state out
+    # of the changed values followed by the baseline's, built once per mask
+    layout = _delta_layouts.get(mask)
+    if layout is None:
+        bits = [bit for bit in range(len(STATE_FIELDS)) if mask & (1 << bit)]
+        picks = [bits.index(bit) if bit in bits else len(bits) + bit for bit in range(len(STATE_FIELDS))]
+        layout = (struct.Struct("!" + "".join(STATE_FIELDS[bit] for bit in bits)), operator.itemgetter(*picks))
+        _delta_layouts[mask] = layout
+    return layout
+
+
+def delta_struct(mask):
+    return delta_layout(mask)[0]
+
+
+def encode_snapshot(seq, values):
+    return encode_frame(MSG_SNAPSHOT, SNAPSHOT_HEADER.pack(seq) + STATE_BODY.pack(*values))
+
+
+def encode_snapshot_into(buffer, offset, seq, values):
+    # Same frame as encode_snapshot written into buffer at offset, returns the offset after it
+    SNAPSHOT_FRAME.pack_into(buffer, offset, SNAPSHOT_FRAME.size - FRAME_HEADER.size, MSG_SNAPSHOT, seq, *values)
+    return offset + SNAPSHOT_FRAME.size
+
+
+def encode_delta(seq, values, baseline_seq, baseline_values):
+    mask = 0
+    changed = []
+    for bit, value in enumerate(values):
+        if value != baseline_values[bit]:
+            mask |= 1 << bit
+            changed.append(value)
+    body = DELTA_HEADER.pack(seq, seq - baseline_seq, mask) + delta_struct(mask).pack(*changed)
+    return encode_frame(MSG_DELTA, body)
+
+
+def encode_delta_into(buffer, offset, seq, values, baseline_seq, baseline_values):
+    # Same frame as encode_delta written into buffer at offset, returns the offset after it
+    mask = 0
+    changed = []
+    for bit, value in enumerate(values):
+        if value != baseline_values[bit]:
+            mask |= 1 << bit
+            changed.append(value)
+    layout = delta_struct(mask)
+    DELTA_FRAME_HEADER.pack_into(buffer, offset, DELTA_FRAME_HEADER.size - FRAME_HEADER.size + layout.size,
+                                 MSG_DELTA, seq, seq - baseline_seq, mask)
+    layout.pack_into(buffer, offset + DELTA_FRAME_HEADER.size, *changed)
+    return offset + DELTA_FRAME_HEADER.size + layout.size
+
+
+def encode_json_state(values):
+    ball_x, ball_y, player1_y, player2_y, score1, score2, countdown, winner, input_seq1, input_seq2 = values
+    return (JSON_STATE % (ball_x, ball_y, player1_y, player2_y, score1, score2,
+                          countdown if countdown >= 0 else "null", JSON_WINNERS[winner], input_seq1, input_seq2)).encode()
+
+
+def state_seq(body):
+    # Sequence number of a snapshot or delta without decoding the rest, both bodies start with it
+    return SNAPSHOT_HEADER.unpack_from(body)[0]
+
+
+def decode_snapshot(body):
+    (seq,) = SNAPSHOT_HEADER.unpack_from(body)
+    return seq, STATE_BODY.unpack_from(body, SNAPSHOT_HEADER.size)
+
+
+def decode_delta(body, baselines):
+    # Returns (seq, values), or (seq, None) when the baseline is no longer known here
+    seq, age, mask = DELTA_HEADER.unpack_from(body)
+    baseline_values = baselines.get(seq - age)
+    if baseline_values is None:
+        return seq, None
+    layout, merge = delta_layout(mask)
+    return seq, merge(layout.unpack_from(body, DELTA_HEADER.size) + tuple(baseline_values))
+
+
+def prune_baselines(baselines, seq, history):
+    # Forget states more than history before seq. Sequence numbers skip when states are coalesced
+    # or superseded, so everything old goes, once the dict holds twice the history to keep it cheap.
+    if len(baselines) > 2 * history:
+        for old_seq in [old_seq for old_seq in baselines if old_seq <= seq - history]:
+            del baselines[old_seq]
+
+
+def encode_ack(seq):
+    return encode_frame(MSG_ACK, ACK_BODY.pack(seq))
+
+
+def decode_ack(body):
+    return ACK_BODY.unpack(body)[0]
+
+
+def state_dict(values):
+    # Rebuild the same shape PongGame.get_state() produces so JSON and binary clients render alike
+    ball_x, ball_y, player1_y, player2_y, score1, score2, countdown, winner, input_seq1, input_seq2 = values
+    return {
+        "ball": {"x": ball_x, "y": ball_y},
+        "player1": {"y": player1_y},
+        "player2": {"y": player2_y},
+        "score": {"player1": score1, "player2": score2},
+        "countdown": countdown if countdown >= 0 else None,
+        "winner": WINNER_NAMES.get(winner),
+        "input_seq": {"player1": input_seq1, "player2": input_seq2}
+    }
+
+
+class StreamBuffer:
+    # Received bytes in one preallocated bytearray. Data is read straight into the free space
+    # with recv_into and consumed bytes are dropped by moving the rest down when space runs
+    # out, so each byte is copied a constant number of times however large the backlog.
+    def __init__(self, capacity=4096):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not yet consumed
+        self.end = 0  # End of the received bytes
+
+    def reserve(self, size):
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if pending + size <= len(self.buffer) // 2:
+            # Plenty of room once consumed bytes are gone, slide the rest to the front
+            self.buffer[:pending] = self.view[self.start:self.end]
+        else:
+            # Never resize in place, memoryviews of the old buffer may still be around
+            grown = bytearray(max(len(self.buffer) * 2, pending + size))
+            grown[:pending] = self.view[self.start:self.end]
+            self.buffer = grown
+            self.view = memoryview(grown)
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        # Returns the number of bytes read, 0 when the peer closed the connection
+        self.reserve(size)
+        received = sock.recv_into(self.view[self.end:self.end + size])
+        self.end += received
+        return received
+
+    def pending(self):
+        return self.end - self.start
+
+    def clear(self):
+        self.start = self.end = 0
+
+
+class FrameDecoder(StreamBuffer):
+    def frames(self, latest_only=()):
+        # Yield (message type, body) for every complete frame received so far. Bodies are views
+        # into the buffer, only valid until the next feed or recv_into. Frames whose type is in
+        # latest_only are skipped over by their length header and only the newest one is
+        # yielded, after the others, so superseded states are never even sliced.
+        buffer = self.buffer
+        header_size = FRAME_HEADER.size
+        latest = None
+        while self.end - self.start >= header_size:
+            (length,) = FRAME_HEADER.unpack_from(buffer, self.start)
+            frame_start = self.start
+            frame_end = frame_start + header_size + length
+            if frame_end > self.end:
+                break
+            self.start = frame_end
+            if length == 0:
+                continue
+            msg_type = buffer[frame_start + header_size]
+            if msg_type in latest_only:
+                latest = (msg_type, frame_start + header_size + 1, frame_end)
+                continue
+            yield msg_type, self.view[frame_start + header_size + 1:frame_end]
+
+        if latest is not None:
+            yield latest[0], self.view[latest[1]:latest[2]]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+
+class JsonStreamDecoder(StreamBuffer):
+    # Back to back JSON objects, as JSON-protocol servers send states. Brace depth and string
+    # state carry over between calls, so every byte is scanned once, by a regex rather than a
+    # Python loop. Only the newest complete object is ever parsed.
+    TOKENS = re.compile(rb'[{}"\\]')
+
+    def __init__(self, capacity=4096):
+        super().__init__(capacity)
+        self.scan = 0  # Bytes before this are already scanned
+        self.depth = 0
+        self.in_string = False
+        self.escaped_at = -1  # Position of the character after a backslash in a string
+        self.object_start = None
+
+    def reserve(self, size):
+        # Scan positions are relative to the buffer, keep them valid when data moves
+        start = self.start
+        super().reserve(size)
+        moved = start - self.start
+        self.scan -= moved
+        self.escaped_at -= moved
+        if self.object_start is not None:
+            self.object_start -= moved
+
+    def latest(self):
+        # Parse and return the newest complete object, dropping older ones, or None if none is complete
+        latest = None
+        buffer = self.buffer
+        for match in self.TOKENS.finditer(self.view[:self.end], self.scan):
+            position = match.start()
+            token = buffer[position]
+            if position == self.escaped_at:
+                continue
+            if self.in_string:
+                if token == 0x5C:  # Backslash
+                    self.escaped_at = position + 1
+                elif token == 0x22:  # Quote
+                    self.in_string = False
+            elif token == 0x22:
+                self.in_string = True
+            elif token == 0x7B:  # {
+                if self.depth == 0:
+                    self.object_start = position
+                self.depth += 1
+            elif token == 0x7D and self.depth > 0:  # }
+                self.depth -= 1
+                if self.depth == 0:
+                    latest = (self.object_start, position + 1)
+                    self.object_start = None
+                    self.start = position + 1
+        self.scan = self.end
+
+        if self.object_start is None:
+            # Nothing half received, whatever is left is noise between objects
+            self.start = self.end = self.scan = 0
+            self.escaped_at = -1
+        if latest is None:
+            return None
+        return json.loads(bytes(self.view[latest[0]:latest[1]]))
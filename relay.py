@@ -0,0 +1,227 @@
+import argparse
+import errno
+import json
+import os
+import selectors
+import socket
+import time
+
+import broadcast
+import protocol
+
+# Spectator relay, the second tier of the broadcast (see broadcast.py). It accepts spectators
+# like the server does and watches each match they ask for on the upstream server, or another
+# relay, over a single connection. The frames it receives go out again unchanged to all of its
+# viewers, so the game server sends a match once per relay however many people watch it.
+#
+#   python server.py --spectator-port 5556
+#   python relay.py --upstream localhost:5556 --port 5557
+#   python relay.py --upstream localhost:5557 --port 5558   (a third tier)
+
+UPSTREAM_TIMEOUT = 5.0  # Seconds to wait for the upstream to answer a watch request
+MAX_REPLY_SIZE = 1024  # Bytes of the upstream's answer before it counts as no answer
+RECV_SIZE = 65536
+
+
+class Upstream:
+    # One watched match on the upstream, its frames republished to this relay's viewers. Connecting
+    # and the watch request happen in the relay's selector like everything else, the viewers wait
+    # in the stream, which has no id until the upstream answers.
+    def __init__(self, relay, room_id):
+        self.relay = relay
+        self.room_id = room_id  # As asked for, None for any match
+        self.stream = broadcast.Broadcast(None)
+        self.snapshot_rate = None
+        self.request = json.dumps({"watch": room_id}).encode()  # Still to send
+        self.reply = b""  # The upstream's answer so far
+        self.deadline = time.monotonic() + UPSTREAM_TIMEOUT
+        self.frames = protocol.FrameDecoder()
+        self.baselines = {}  # The last state received, what the next delta refers to
+
+        family, _, _, _, address = relay.upstream_address
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        error = self.socket.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.socket.close()
+            raise ConnectionError(os.strerror(error))
+        relay.selector.register(self.socket, selectors.EVENT_WRITE, self.handle_event)
+
+    def handle_event(self, events):
+        if self.stream.stream_id is None:
+            try:
+                self.handshake()
+            except (OSError, ValueError) as e:
+                self.relay.upstream_failed(self, e)
+            return
+        try:
+            data = self.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            print(f"Upstream ended match {self.stream.stream_id}")
+            self.relay.close_upstream(self)
+            return
+        self.frames.feed(data)
+        self.read_frames()
+
+    def handshake(self):
+        # Once connected send the watch request, then read the answer. Frames may follow right behind it.
+        try:
+            if self.request:
+                error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise ConnectionError(os.strerror(error))
+                self.request = self.request[self.socket.send(self.request):]
+                if not self.request:
+                    self.relay.selector.modify(self.socket, selectors.EVENT_READ, self.handle_event)
+                return
+            data = self.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise ConnectionError("Upstream closed the connection")
+        self.reply += data
+        try:
+            reply, end = json.JSONDecoder().raw_decode(self.reply.decode("latin-1"))
+        except ValueError:
+            if len(self.reply) > MAX_REPLY_SIZE:
+                raise ConnectionError("Upstream didn't answer the watch request")
+            return  # Incomplete, wait for the rest
+        if not isinstance(reply, dict) or "watching" not in reply:
+            raise ConnectionError(reply.get("error", "No match in the upstream's answer") if isinstance(reply, dict)
+                                  else "Upstream didn't answer the watch request")
+
+        self.stream.stream_id = reply["watching"]
+        self.snapshot_rate = reply.get("snapshot_rate")
+        self.frames.feed(self.reply[end:])
+        self.reply = b""
+        self.relay.upstream_ready(self)
+
+    def read_frames(self):
+        for msg_type, body in self.frames.frames():
+            if msg_type == protocol.MSG_SNAPSHOT:
+                seq, values = protocol.decode_snapshot(body)
+            elif msg_type == protocol.MSG_DELTA:
+                seq, values = protocol.decode_delta(body, self.baselines)
+            else:
+                continue
+            if values is None:
+                continue  # Can't happen over TCP, the upstream's deltas follow its own previous frame
+            self.baselines = {seq: values}
+            self.relay.broadcaster.publish(self.stream, seq, values, protocol.encode_frame(msg_type, body))
+
+    def close(self):
+        try:
+            self.relay.selector.unregister(self.socket)
+        except (KeyError, ValueError):
+            pass
+        self.socket.close()
+
+
+class Relay:
+    def __init__(self, upstream, host='0.0.0.0', port=5557, snapshot_rate=broadcast.SPECTATOR_RATE):
+        self.upstream = upstream
+        self.upstream_address = socket.getaddrinfo(*upstream, socket.AF_INET, socket.SOCK_STREAM)[0]  # Resolved once, not per match
+        self.selector = selectors.DefaultSelector()
+        self.upstreams = {}  # Upstream indexed by room id
+        self.connecting = {}  # Upstream still waiting for its answer, indexed by the room id asked for
+        self.broadcaster = broadcast.Broadcaster(self.selector, host, port, self.find_stream, snapshot_rate,
+                                                 self.stream_empty)
+        self.running = False
+
+    def find_stream(self, room_id):
+        # Matches already relayed, or being asked for, are shared. Anything else is a new upstream
+        # connection, whose stream the viewer waits in until upstream_ready or upstream_failed.
+        if room_id is None and self.upstreams:
+            return next(iter(self.upstreams.values())).stream
+        upstream = self.upstreams.get(room_id) or self.connecting.get(room_id)
+        if upstream is not None:
+            return upstream.stream
+        try:
+            upstream = Upstream(self, room_id)
+        except OSError as e:
+            print(f"Can't watch match {room_id} upstream: {e}")
+            return None
+        self.connecting[room_id] = upstream
+        return upstream.stream
+
+    def upstream_ready(self, upstream):
+        del self.connecting[upstream.room_id]
+        existing = self.upstreams.get(upstream.stream.stream_id)
+        if existing is not None:
+            # Asked for any match and got one we already relay
+            self.broadcaster.stream_ready(upstream.stream, existing.stream)
+            upstream.close()
+            return
+        self.upstreams[upstream.stream.stream_id] = upstream
+        if upstream.snapshot_rate:
+            self.broadcaster.snapshot_rate = upstream.snapshot_rate
+        print(f"Relaying match {upstream.stream.stream_id}")
+        self.broadcaster.stream_ready(upstream.stream)
+        upstream.read_frames()
+
+    def upstream_failed(self, upstream, error):
+        print(f"Can't watch match {upstream.room_id} upstream: {error}")
+        self.connecting.pop(upstream.room_id, None)
+        upstream.close()
+        room_id = upstream.room_id
+        self.broadcaster.stream_failed(upstream.stream, f"No match {room_id} to watch" if room_id else "No match to watch")
+
+    def expire_connecting(self):
+        now = time.monotonic()
+        for upstream in [upstream for upstream in self.connecting.values() if now >= upstream.deadline]:
+            self.upstream_failed(upstream, "No answer in time")
+
+    def stream_empty(self, stream):
+        # Nobody watches this match here any more, stop receiving it
+        if stream.stream_id is None:
+            # Gone before the upstream answered
+            upstream = next((upstream for upstream in self.connecting.values() if upstream.stream is stream), None)
+            if upstream is not None:
+                del self.connecting[upstream.room_id]
+                upstream.close()
+            return
+        upstream = self.upstreams.pop(stream.stream_id, None)
+        if upstream is not None:
+            upstream.close()
+            print(f"Stopped relaying match {stream.stream_id}")
+
+    def close_upstream(self, upstream):
+        self.upstreams.pop(upstream.stream.stream_id, None)
+        upstream.close()
+        self.broadcaster.close_stream(upstream.stream)
+
+    def start(self):
+        self.running = True
+        try:
+            while self.running:
+                timeout = 0.0 if self.broadcaster.work else 1.0
+                for key, events in self.selector.select(timeout):
+                    key.data(events)
+                self.expire_connecting()
+                self.broadcaster.fan_out()
+        except KeyboardInterrupt:
+            print("Relay shutting down...")
+        finally:
+            for upstream in list(self.upstreams.values()) + list(self.connecting.values()):
+                upstream.close()
+            self.broadcaster.close()
+            self.selector.close()
+
+    def stop(self):
+        self.running = False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay Pong matches to more spectators")
+    parser.add_argument("--upstream", required=True, help="HOST:PORT of a server's spectator port or another relay")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5557)
+    args = parser.parse_args()
+
+    upstream_host, _, upstream_port = args.upstream.rpartition(":")
+    Relay((upstream_host, int(upstream_port)), args.host, args.port).start()
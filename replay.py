@@ -0,0 +1,261 @@
+import argparse
+import json
+import math
+import struct
+import sys
+import time
+import zlib
+
+from game import PongGame
+
+# Match recordings. With --record DIR the server writes one file per room: the game's random
+# seed, then everything that changed the game in the order it happened. Paddle moves, restarts
+# and countdowns are one byte each and every physics step adds three, a marker and a checksum
+# of the state after it, so a five minute match takes about 60 KB. A keyframe with the whole
+# state goes in every KEYFRAME_INTERVAL steps so a replay can start part way through, and a
+# paddle hit the server granted after the fact (lag compensation) goes in as the whole new state.
+#
+# The game draws its random numbers from its own seeded generator, so replaying the same
+# operations from the seed rebuilds the match step for step. `python replay.py FILE` does that
+# headless, far faster than the match was played, and checks every step against the checksums
+# and keyframes the server wrote. Any difference means the physics changed since the recording.
+#
+# The file only ever grows, a recording cut short by a crash replays up to the last whole
+# operation written.
+
+MAGIC = b"PONGRPL1"
+FILE_HEADER = struct.Struct("!8sIdH")  # Magic, game seed, physics step in seconds, keyframe interval in steps
+KEYFRAME_INTERVAL = 600  # Steps between keyframes, 10 seconds at 60 Hz
+FLUSH_SIZE = 4096  # Bytes buffered before they go to the file
+
+# Operations, the low bits of the first byte carry their argument
+OP_STEP = 0x00  # Followed by the state checksum
+OP_MOVE = 0x10  # Bit 1 is the player (0 for player 1), bit 0 is set for down
+OP_RESTART = 0x20
+OP_COUNTDOWN = 0x30  # Low bits are the seconds
+OP_KEYFRAME = 0x40  # Followed by the step count and the state
+OP_END = 0x50  # Followed by the step count and the final state
+OP_STATE = 0x60  # Followed by the state, the server rewound a missed paddle hit (see server.Room.rewind_hit)
+OP_KIND_MASK = 0xF0
+
+CHECKSUM = struct.Struct("!H")
+TICK = struct.Struct("!I")
+# Ball x, y, velocity x, y, paddle 1 y, paddle 2 y, scores, active, countdown, countdown timer
+# (NaN for none), winner, clock, random generator state
+GAME_STATE = struct.Struct("!6d2H?bdBdI")
+WINNER_CODES = {None: 0, "Player 1": 1, "Player 2": 2}
+WINNER_NAMES = {code: name for name, code in WINNER_CODES.items()}
+
+
+def pack_state(game):
+    timer = game.countdown_timer
+    return GAME_STATE.pack(game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y,
+                           game.player1_y, game.player2_y, game.score_player1, game.score_player2,
+                           game.game_active, game.countdown, math.nan if timer is None else timer,
+                           WINNER_CODES[game.winner], game.clock, game.rng_state)
+
+
+def pack_state_into(buffer, offset, game):
+    # pack_state without the bytes object, for the server's per-round state history
+    timer = game.countdown_timer
+    GAME_STATE.pack_into(buffer, offset, game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y,
+                         game.player1_y, game.player2_y, game.score_player1, game.score_player2,
+                         game.game_active, game.countdown, math.nan if timer is None else timer,
+                         WINNER_CODES[game.winner], game.clock, game.rng_state)
+
+
+def restore_state(game, data, offset=0):
+    (game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y, game.player1_y, game.player2_y,
+     game.score_player1, game.score_player2, game.game_active, game.countdown, timer, winner,
+     game.clock, game.rng_state) = GAME_STATE.unpack_from(data, offset)
+    game.countdown_timer = None if math.isnan(timer) else timer
+    game.winner = WINNER_NAMES[winner]
+
+
+def state_checksum(game):
+    return zlib.crc32(pack_state(game)) & 0xFFFF
+
+
+class ReplayWriter:
+    # Appends one room's operations to its file, the server calls it wherever the game changes
+    def __init__(self, path, game, physics_dt, keyframe_interval=KEYFRAME_INTERVAL):
+        self.file = open(path, "wb")
+        self.game = game
+        self.keyframe_interval = keyframe_interval
+        self.tick = 0
+        self.buffer = bytearray(FILE_HEADER.pack(MAGIC, game.seed, physics_dt, keyframe_interval))
+        # Replays start from a keyframe, this one is also what the seed alone must rebuild
+        self.write_keyframe(OP_KEYFRAME)
+
+    def move(self, player, direction):
+        self.buffer.append(OP_MOVE | (player - 1) << 1 | (direction == "down"))
+
+    def restart(self):
+        self.buffer.append(OP_RESTART)
+
+    def countdown(self, seconds):
+        self.buffer.append(OP_COUNTDOWN | seconds)
+
+    def set_state(self):
+        # After the server changed the game outside of a step
+        self.buffer.append(OP_STATE)
+        self.buffer += pack_state(self.game)
+
+    def step(self):
+        # After the game stepped
+        self.tick += 1
+        self.buffer.append(OP_STEP)
+        self.buffer += CHECKSUM.pack(state_checksum(self.game))
+        if self.tick % self.keyframe_interval == 0:
+            self.write_keyframe(OP_KEYFRAME)
+        if len(self.buffer) >= FLUSH_SIZE:
+            self.flush()
+
+    def write_keyframe(self, op):
+        self.buffer.append(op)
+        self.buffer += TICK.pack(self.tick)
+        self.buffer += pack_state(self.game)
+
+    def flush(self):
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self.write_keyframe(OP_END)
+        self.flush()
+        self.file.close()
+
+
+class ReplayMismatch(Exception):
+    pass
+
+
+class Replay:
+    # A recording read back into memory, with an index of its keyframes for seeking
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        if len(self.data) < FILE_HEADER.size:
+            raise ValueError(f"{path} is too short to be a replay")
+        magic, self.seed, self.physics_dt, self.keyframe_interval = FILE_HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a Pong replay")
+        self.keyframes = []  # (step count, offset of the keyframe operation)
+        self.ticks = 0
+        self.complete = False  # Has the END operation, the server closed the recording
+        self.end = FILE_HEADER.size  # Offset past the last whole operation
+        self.index()
+
+    def index(self):
+        data = self.data
+        offset = FILE_HEADER.size
+        frame_size = TICK.size + GAME_STATE.size
+        while offset < len(data):
+            kind = data[offset] & OP_KIND_MASK
+            if kind == OP_STEP:
+                if offset + 1 + CHECKSUM.size > len(data):
+                    break
+                self.ticks += 1
+                offset += 1 + CHECKSUM.size
+            elif kind in (OP_KEYFRAME, OP_END):
+                if offset + 1 + frame_size > len(data):
+                    break
+                self.keyframes.append((TICK.unpack_from(data, offset + 1)[0], offset))
+                if kind == OP_END:
+                    self.complete = True
+                offset += 1 + frame_size
+            elif kind in (OP_MOVE, OP_RESTART, OP_COUNTDOWN):
+                offset += 1
+            elif kind == OP_STATE:
+                if offset + 1 + GAME_STATE.size > len(data):
+                    break
+                offset += 1 + GAME_STATE.size
+            else:
+                raise ValueError(f"Unknown replay operation {data[offset]:#04x} at byte {offset}")
+            self.end = offset
+
+    def play(self, game=None, start=None, stop=None, verify=True):
+        # Re-simulate from the keyframe at offset start (the first one by default) and return the
+        # game as of step stop (the end by default). With verify every checksum and keyframe
+        # is compared and the first difference raises ReplayMismatch.
+        data = self.data
+        game = game if game is not None else PongGame(self.seed)
+        offset = start if start is not None else self.keyframes[0][1]
+        if verify and offset == self.keyframes[0][1] and pack_state(PongGame(self.seed)) != self.keyframe_state(offset):
+            raise ReplayMismatch(f"Seed {self.seed} doesn't give the recorded starting state")
+        tick = TICK.unpack_from(data, offset + 1)[0]
+        restore_state(game, data, offset + 1 + TICK.size)
+        offset += 1 + TICK.size + GAME_STATE.size
+        dt = self.physics_dt
+        step = game.step
+        unpack_checksum = CHECKSUM.unpack_from
+        while offset < self.end:
+            op = data[offset]
+            kind = op & OP_KIND_MASK
+            if kind == OP_STEP:
+                if tick == stop:
+                    break
+                step(dt)
+                tick += 1
+                if verify and state_checksum(game) != unpack_checksum(data, offset + 1)[0]:
+                    raise ReplayMismatch(f"State checksum differs after step {tick}")
+                offset += 1 + CHECKSUM.size
+            elif kind == OP_MOVE:
+                game.move_paddle(((op >> 1) & 1) + 1, "down" if op & 1 else "up")
+                offset += 1
+            elif kind == OP_RESTART:
+                game.restart_game()
+                offset += 1
+            elif kind == OP_COUNTDOWN:
+                game.start_countdown(op & 0x0F)
+                offset += 1
+            elif kind == OP_STATE:
+                restore_state(game, data, offset + 1)
+                offset += 1 + GAME_STATE.size
+            else:
+                if verify and self.keyframe_state(offset) != pack_state(game):
+                    raise ReplayMismatch(f"State differs from the keyframe at step {tick}")
+                offset += 1 + TICK.size + GAME_STATE.size
+        return game
+
+    def keyframe_state(self, offset):
+        start = offset + 1 + TICK.size
+        return self.data[start:start + GAME_STATE.size]
+
+    def seek(self, tick, verify=True):
+        # The game as of step tick, re-simulated from the nearest keyframe before it
+        start = self.keyframes[0][1]
+        for keyframe_tick, offset in self.keyframes:
+            if keyframe_tick > tick:
+                break
+            start = offset
+        return self.play(start=start, stop=tick, verify=verify)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay and verify a recorded Pong match")
+    parser.add_argument("file")
+    parser.add_argument("--seek", type=int, help="print the state after this many steps instead of replaying it all")
+    parser.add_argument("--no-verify", action="store_true", help="skip comparing against the recorded checksums")
+    args = parser.parse_args()
+
+    replay = Replay(args.file)
+    print(f"Seed {replay.seed}, {replay.ticks} steps of {replay.physics_dt * 1000:.2f} ms, "
+          f"{len(replay.keyframes)} keyframes{'' if replay.complete else ', recording cut short'}")
+    try:
+        start = time.perf_counter()
+        if args.seek is not None:
+            game = replay.seek(min(args.seek, replay.ticks), not args.no_verify)
+        else:
+            game = replay.play(verify=not args.no_verify)
+        elapsed = time.perf_counter() - start
+    except ReplayMismatch as e:
+        print(f"Replay does not match the recording: {e}")
+        sys.exit(1)
+
+    print(json.dumps(game.get_state()))
+    if args.seek is None:
+        match_seconds = replay.ticks * replay.physics_dt
+        print(f"Replayed {match_seconds:.1f} s of play in {elapsed * 1000:.1f} ms, "
+              f"{replay.ticks / max(elapsed, 1e-9):.0f} steps/s, {match_seconds / max(elapsed, 1e-9):.0f}x real time"
+              f"{'' if args.no_verify else ', every step matches'}")
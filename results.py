@@ -0,0 +1,250 @@
+import argparse
+import csv
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+# Match history. With --results FILE the server keeps every finished match in an SQLite database:
+# when it ended, how long it took, who played, the score and the replay file when recording.
+# The server loop only puts results on a queue, a writer thread takes them off and writes them a
+# batch per transaction, so a slow disk never holds up a step. Results wait at most
+# FLUSH_INTERVAL seconds for others to share a transaction with.
+#
+# Players are who they said they were (client.py --name), or their address. Next to the matches
+# the database keeps each player's totals, updated with every batch, so a player's stats and the
+# leaderboard are lookups rather than scans of every match. Worker processes (--workers) each
+# have their own writer on the same file, the WAL journal lets them take turns and readers
+# carry on while they write.
+#
+# `python results.py FILE` prints the leaderboard, --player NAME one player's stats and recent
+# matches and --export csv|jsonl every match, or those after --after ID for incremental exports.
+
+BATCH_SIZE = 1000  # Results written per transaction at most
+FLUSH_INTERVAL = 0.5  # Seconds the first result of a batch waits for more
+MAX_PENDING = 100000  # Results queued for the writer before new ones are dropped, only a stuck disk gets there
+BUSY_TIMEOUT = 5.0  # Seconds to wait for another process's transaction to finish
+CLOSE_POLL = 0.1  # Seconds between checks that the writer is still alive while closing
+MAX_NAME_LENGTH = 32
+LEADERBOARD_SIZE = 10
+RECENT_MATCHES = 10
+EXPORT_BATCH = 1000  # Rows fetched at a time while exporting
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    finished_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    player1 TEXT NOT NULL,
+    player2 TEXT NOT NULL,
+    score1 INTEGER NOT NULL,
+    score2 INTEGER NOT NULL,
+    winner INTEGER NOT NULL,
+    replay TEXT
+);
+CREATE TABLE IF NOT EXISTS match_players (
+    name TEXT NOT NULL,
+    match_id INTEGER NOT NULL,
+    side INTEGER NOT NULL,
+    PRIMARY KEY (name, match_id, side)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS players (
+    name TEXT PRIMARY KEY,
+    played INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    conceded INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS players_by_wins ON players (won DESC, played);
+"""
+
+MATCH_COLUMNS = ("id", "finished_at", "duration", "player1", "player2", "score1", "score2", "winner", "replay")
+INSERT_MATCH = f"INSERT INTO matches ({', '.join(MATCH_COLUMNS)}) VALUES ({', '.join('?' * len(MATCH_COLUMNS))})"
+INSERT_MATCH_PLAYER = "INSERT INTO match_players (name, match_id, side) VALUES (?, ?, ?)"
+ADD_PLAYER_TOTALS = """
+INSERT INTO players (name, played, won, points, conceded) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET played = played + excluded.played, won = won + excluded.won,
+    points = points + excluded.points, conceded = conceded + excluded.conceded
+"""
+
+
+def connect(path):
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")  # With WAL a crash can lose the last batches but not corrupt the file
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def player_name(name, address):
+    # The name a client asked for, cleaned up, or its address
+    if isinstance(name, str):
+        name = " ".join(name.split())[:MAX_NAME_LENGTH]
+        if name:
+            return name
+    return str(address[0])
+
+
+class ResultStore:
+    # The server's side: record() from the server loop, everything else happens on the writer thread
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(MAX_PENDING)
+        self.written = 0  # Results in the database
+        self.batches = 0
+        self.dropped = 0  # Results lost to a full queue or a failed write
+        connect(path).close()  # A bad path fails here, when the server starts
+        self.thread = threading.Thread(target=self.write_loop, name="results-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, finished_at, duration, player1, player2, score1, score2, winner, replay=None):
+        try:
+            self.queue.put_nowait((finished_at, duration, player1, player2, score1, score2, winner, replay))
+        except queue.Full:
+            self.dropped += 1
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def close(self):
+        # Write what is queued and stop the writer. A writer that died leaves its queue full for good,
+        # so waiting for room in it gives up once the thread is gone.
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=CLOSE_POLL)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+
+    def write_loop(self):
+        connection = connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = []
+            result = self.queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if result is None:
+                    stopping = True
+                    break
+                batch.append(result)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    result = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    write_results(connection, batch)
+                    self.written += len(batch)
+                    self.batches += 1
+                except sqlite3.Error as e:
+                    print(f"Error writing {len(batch)} match result(s) to {self.path}: {e}")
+                    self.dropped += len(batch)
+        connection.close()
+
+
+def write_results(connection, results):
+    # One transaction: the matches, who played in which, and the players' new totals
+    totals = {}
+    for _, _, player1, player2, score1, score2, winner, _ in results:
+        for name, points, conceded, won in ((player1, score1, score2, winner == 1), (player2, score2, score1, winner == 2)):
+            total = totals.setdefault(name, [name, 0, 0, 0, 0])
+            total[1] += 1
+            total[2] += won
+            total[3] += points
+            total[4] += conceded
+
+    connection.execute("BEGIN IMMEDIATE")  # Take the write lock now, the ids below must stay free
+    try:
+        first_id = connection.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM matches").fetchone()[0]
+        connection.executemany(INSERT_MATCH, ((first_id + index,) + result for index, result in enumerate(results)))
+        connection.executemany(INSERT_MATCH_PLAYER, (row for index, result in enumerate(results)
+                                                     for row in ((result[2], first_id + index, 1),
+                                                                 (result[3], first_id + index, 2))))
+        connection.executemany(ADD_PLAYER_TOTALS, totals.values())
+        connection.execute("COMMIT")
+    except sqlite3.Error:
+        connection.execute("ROLLBACK")
+        raise
+
+
+def player_stats(connection, name):
+    row = connection.execute("SELECT played, won, points, conceded FROM players WHERE name = ?", (name,)).fetchone()
+    played, won, points, conceded = row if row is not None else (0, 0, 0, 0)
+    return {"name": name, "played": played, "won": won, "points": points, "conceded": conceded}
+
+
+def recent_matches(connection, name, limit=RECENT_MATCHES):
+    # DISTINCT for a name on both sides, two machines on one address
+    rows = connection.execute(f"SELECT DISTINCT {', '.join('m.' + column for column in MATCH_COLUMNS)} "
+                              "FROM match_players p JOIN matches m ON m.id = p.match_id "
+                              "WHERE p.name = ? ORDER BY m.id DESC LIMIT ?", (name, limit))
+    return [dict(zip(MATCH_COLUMNS, row)) for row in rows]
+
+
+def leaderboard(connection, limit=LEADERBOARD_SIZE):
+    # Most wins first, fewer matches played breaks ties
+    rows = connection.execute("SELECT name, played, won, points, conceded FROM players "
+                              "ORDER BY won DESC, played LIMIT ?", (limit,))
+    return [dict(zip(("name", "played", "won", "points", "conceded"), row)) for row in rows]
+
+
+def export(connection, out, fmt="csv", after_id=0):
+    # Stream the matches after after_id to out in id order, returns how many
+    cursor = connection.execute(f"SELECT {', '.join(MATCH_COLUMNS)} FROM matches WHERE id > ? ORDER BY id", (after_id,))
+    count = 0
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(MATCH_COLUMNS)
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH)
+        if not rows:
+            return count
+        if writer is not None:
+            writer.writerows(rows)
+        else:
+            out.write("".join(json.dumps(dict(zip(MATCH_COLUMNS, row))) + "\n" for row in rows))
+        count += len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pong match history")
+    parser.add_argument("file")
+    parser.add_argument("--player", help="this player's stats and recent matches instead of the leaderboard")
+    parser.add_argument("--top", type=int, default=LEADERBOARD_SIZE, help="players on the leaderboard")
+    parser.add_argument("--export", choices=["csv", "jsonl"], help="write every match to --output")
+    parser.add_argument("--after", type=int, default=0, help="export only matches with a higher id")
+    parser.add_argument("--output", help="export to this file instead of standard output")
+    args = parser.parse_args()
+
+    connection = connect(args.file)
+    if args.export:
+        out = open(args.output, "w", newline="") if args.output else sys.stdout
+        start = time.perf_counter()
+        count = export(connection, out, args.export, args.after)
+        if args.output:
+            out.close()
+        print(f"Exported {count} match(es) in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+    elif args.player:
+        stats = player_stats(connection, args.player)
+        print(f"{stats['name']}: {stats['won']} won of {stats['played']} played, "
+              f"{stats['points']} points scored, {stats['conceded']} conceded")
+        for match in recent_matches(connection, args.player):
+            finished = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(match["finished_at"]))
+            print(f"  #{match['id']} {finished}  {match['player1']} {match['score1']} - {match['score2']} "
+                  f"{match['player2']}  {match['duration']:.0f} s")
+    else:
+        matches = connection.execute("SELECT COUNT(*) FROM matches").fetchone()[0]
+        print(f"{matches} match(es) played")
+        for rank, stats in enumerate(leaderboard(connection, args.top), 1):
+            print(f"{rank:3d}. {stats['name']:{MAX_NAME_LENGTH}s} {stats['won']:6d} won of {stats['played']:6d}, "
+                  f"{stats['points'] - stats['conceded']:+d} points")
+    connection.close()
@@ -1,296 +1,1224 @@
+import argparse
+import array
+import os
+import signal
 import socket
+import selectors
 import threading
+import collections
 import json
 import time
-import random
 
-# Game settings
-WINDOW_WIDTH = 800
-WINDOW_HEIGHT = 600
-PADDLE_WIDTH = 15
-PADDLE_HEIGHT = 100
-BALL_SIZE = 15
-BALL_SPEED = 5
-TICK_RATE = 1 / 60  # 60 FPS
+import ai
+import broadcast
+import engines
+import metrics
+import protocol
+import replay
+import results
+import udp
+from game import PongGame, TICK_RATE, PADDLE_WIDTH, BALL_RIGHT_CONTACT_X
 
-class PongGame:
-    def __init__(self):
-        # Game state
-        self.ball_x = WINDOW_WIDTH // 2
-        self.ball_y = WINDOW_HEIGHT // 2
-        self.ball_velocity_x = BALL_SPEED * random.choice([-1, 1])
-        self.ball_velocity_y = BALL_SPEED * random.choice([-0.5, 0.5])
-        
-        self.player1_y = WINDOW_HEIGHT // 2 - PADDLE_HEIGHT // 2
-        self.player2_y = WINDOW_HEIGHT // 2 - PADDLE_HEIGHT // 2
-        
-        self.score_player1 = 0
-        self.score_player2 = 0
-        
-        self.game_active = False
-        self.countdown = 3
-        self.countdown_timer = None
-        self.winner = None
+# Server settings
+PHYSICS_RATE = 60  # Simulation steps per second
+SNAPSHOT_RATE = 60  # States sent to clients per second
+MAX_CATCH_UP_STEPS = 5  # Steps run back to back after a stall before dropping time
+TIMING_HISTORY = 100000  # Step and send durations kept for load tests
+PHYSICS_ENGINE = "scalar"  # See engines.ENGINES, "numpy" steps all rooms in one batch
 
-    def update(self):
-        if not self.game_active:
+MAX_ROOMS = 5000
+PLAYERS_PER_ROOM = 2
+
+# Network settings
+LISTEN_BACKLOG = 1024
+MAX_OUTBOUND_MESSAGES = 64  # Queued messages per client before it counts as too slow
+SEND_STALL_TIMEOUT = 5.0  # Seconds a client's socket can take nothing before it counts as gone
+# Kernel send buffer per client. Small, so a slow link's states queue up here where a newer one
+# can replace them instead of in the kernel where they'd all go out late.
+CLIENT_SEND_BUFFER = 8192
+MAX_INBOUND_BUFFER = 65536  # Unparsed bytes per client before it counts as flooding
+HANDSHAKE_TIMEOUT = 1.0  # Seconds to wait for a protocol choice before assuming a JSON-only client
+SNAPSHOT_HISTORY = 64  # Snapshots per room kept as delta baselines
+RTT_SMOOTHING = 0.1  # Weight of each new round trip time in a client's average
+METRICS_HOST = "127.0.0.1"  # The metrics endpoint is for the machine's own monitoring unless told otherwise
+ENCODE_BUFFER_SIZE = 4096  # Bytes of frames encoded for one room per snapshot round, reused every round
+BROADCAST_MARGIN = 0.001  # Seconds before the next physics step when sending to spectators stops
+
+# Per-client snapshot rate: a client whose link can't keep up gets every second, third... snapshot
+# round, down to MIN_SNAPSHOT_RATE, and gets its full rate back once the link has been clear for a while
+MIN_SNAPSHOT_RATE = 20
+RTT_CONGESTION_MARGIN = 0.05  # Seconds of round trip time over the client's best that count as queueing
+RATE_DECREASE_HOLD = 0.5  # Seconds after lowering a client's rate before lowering it again
+RATE_INCREASE_DELAY = 2.0  # Seconds without congestion before raising a client's rate a step
+
+# Lag compensation: a paddle hit is judged against the snapshot the player was looking at when
+# they moved, up to MAX_REWIND seconds back (see Room.rewind_hit). By the time a move arrives,
+# what the player looked at lags the server by the round trip, the client's interpolation delay
+# and up to a snapshot interval, so the window covers round trips up to MAX_COMPENSATED_RTT and
+# players further away get no compensation past that. It also bounds what a client lying about
+# what it saw can gain. 0 turns it off.
+MAX_COMPENSATED_RTT = 0.3
+MAX_REWIND = MAX_COMPENSATED_RTT + protocol.INTERPOLATION_DELAY + 1 / MIN_SNAPSHOT_RATE
+NO_MISS = -1  # Room.miss_seqs entry of a player the ball hasn't got past
+
+# Input settings
+MAX_QUEUED_INPUTS = 32  # Moves per client waiting for the next step, older ones are dropped past this
+MAX_INPUT_RATE = 60  # Paddle moves per second of simulation time, whatever the client sends
+INPUT_BURST = 2  # Moves a client can bank while idle on top of a step's worth, absorbs network jitter
+
+
+class Room:
+    def __init__(self, room_id, game=None, recorder=None, ai_service=None, ai_difficulty=ai.DEFAULT_DIFFICULTY,
+                 bot_match=False, max_rewind=0, result_store=None):
+        self.room_id = room_id
+        self.game = game if game is not None else PongGame()
+        self.recorder = recorder  # replay.ReplayWriter when the server records matches
+        self.results = result_store  # results.ResultStore when the server keeps match history
+        self.match_clock = self.game.clock  # Game clock when the match started
+        self.finish = None  # (Unix time, match seconds, player names) of the winning point, until the result is saved
+        self.ai = ai_service  # Plays the paddles nobody else does, None leaves them still
+        self.ai_difficulty = ai_difficulty
+        self.bot_match = bot_match  # Bots on both paddles, nobody joins
+        self.bots = {}  # ai.Bot indexed by player number
+        self.broadcast = None  # broadcast.Broadcast once someone watches
+        self.players = {}  # Client connection indexed by player number
+        self.snapshot_seq = 0
+        self.snapshots = [None] * SNAPSHOT_HISTORY  # Recent state values by sequence number modulo the history, the delta baselines
+        self.snapshot_times = [0.0] * SNAPSHOT_HISTORY  # When each of those was taken, for round trip times
+        self.input_seqs = {1: 0, 2: 0}  # Newest move sequence number processed per player
+        self.events = []  # Score and winner changes since the last snapshot round, for UDP players
+        
+        # Lag compensation, see rewind_hit
+        self.max_rewind = max_rewind  # Snapshot rounds a paddle hit can be judged back, 0 turns it off
+        self.history = bytearray(SNAPSHOT_HISTORY * replay.GAME_STATE.size) if max_rewind else None  # Whole game per round
+        # Last snapshot before the ball got past each player's paddle, by player number, NO_MISS for none.
+        # An array so setting one each round doesn't keep a new int object per room.
+        self.miss_seqs = array.array("q", [NO_MISS] * 3)
+        self.rewound = False  # A granted hit took a point back since the last snapshot round
+        self.record_snapshot(time.monotonic())
+        self.seat_bots()
+    
+    def is_full(self):
+        return len(self.players) >= PLAYERS_PER_ROOM
+    
+    def is_empty(self):
+        return len(self.players) == 0
+    
+    def add_player(self, client):
+        # Take the first free paddle so a player rejoining a half-empty room gets the open side
+        player_number = 1 if 1 not in self.players else 2
+        self.players[player_number] = client
+        self.input_seqs[player_number] = 0
+        self.seat_bots()
+        
+        # Start the countdown when first player connects (for testing single player)
+        if len(self.players) == 1:
+            print(f"Room {self.room_id}: first player connected. Starting game in 5 seconds...")
+            self.start_countdown(5)
+        
+        # Start actual game when second player connects
+        else:
+            print(f"Room {self.room_id}: second player connected. Game starting!")
+            self.start_countdown(3)
+        
+        return player_number
+    
+    def remove_player(self, player_number):
+        self.players.pop(player_number, None)
+        self.seat_bots()
+    
+    def seat_bots(self):
+        # Bots play both paddles of a bot match and the free one when a single player is waiting
+        if self.ai is None:
             return
-            
-        # Move the ball
-        self.ball_x += self.ball_velocity_x
-        self.ball_y += self.ball_velocity_y
-        
-        # Ball collision with top and bottom walls
-        if self.ball_y <= 0 or self.ball_y >= WINDOW_HEIGHT - BALL_SIZE:
-            self.ball_velocity_y *= -1
-        
-        # Ball collision with paddles
-        # Player 1 paddle (left)
-        if (self.ball_x <= PADDLE_WIDTH and 
-            self.ball_y + BALL_SIZE >= self.player1_y and 
-            self.ball_y <= self.player1_y + PADDLE_HEIGHT):
-            self.ball_velocity_x *= -1.1  # Increase speed slightly
-            # Change angle based on where the ball hits the paddle
-            paddle_center = self.player1_y + PADDLE_HEIGHT // 2
-            offset = (self.ball_y + BALL_SIZE // 2 - paddle_center) / (PADDLE_HEIGHT // 2)
-            self.ball_velocity_y = BALL_SPEED * offset
-        
-        # Player 2 paddle (right)
-        if (self.ball_x >= WINDOW_WIDTH - PADDLE_WIDTH - BALL_SIZE and 
-            self.ball_y + BALL_SIZE >= self.player2_y and 
-            self.ball_y <= self.player2_y + PADDLE_HEIGHT):
-            self.ball_velocity_x *= -1.1  # Increase speed slightly
-            # Change angle based on where the ball hits the paddle
-            paddle_center = self.player2_y + PADDLE_HEIGHT // 2
-            offset = (self.ball_y + BALL_SIZE // 2 - paddle_center) / (PADDLE_HEIGHT // 2)
-            self.ball_velocity_y = BALL_SPEED * offset
-        
-        # Ball out of bounds (scoring)
-        if self.ball_x < 0:
-            self.score_player2 += 1
-            self.reset_ball()
-            if self.score_player2 >= 5:
-                self.winner = "Player 2"
-                self.game_active = False
-        elif self.ball_x > WINDOW_WIDTH:
-            self.score_player1 += 1
-            self.reset_ball()
-            if self.score_player1 >= 5:
-                self.winner = "Player 1"
-                self.game_active = False
-    
-    def reset_ball(self):
-        self.ball_x = WINDOW_WIDTH // 2
-        self.ball_y = WINDOW_HEIGHT // 2
-        self.ball_velocity_x = BALL_SPEED * random.choice([-1, 1])
-        self.ball_velocity_y = BALL_SPEED * random.choice([-0.5, 0.5])
-        self.game_active = False
-        self.countdown = 3
-        self.countdown_timer = time.time() + 1
-    
-    def update_countdown(self):
-        if self.countdown_timer and time.time() >= self.countdown_timer:
-            self.countdown -= 1
-            if self.countdown <= 0:
-                self.game_active = True
-                self.countdown_timer = None
-            else:
-                self.countdown_timer = time.time() + 1
+        if self.bot_match:
+            wanted = (1, 2)
+        elif len(self.players) == 1:
+            wanted = (2 if 1 in self.players else 1,)
+        else:
+            wanted = ()
+        for player in list(self.bots):
+            if player not in wanted:
+                del self.bots[player]
+        for player in wanted:
+            if player not in self.bots:
+                self.bots[player] = self.ai.new_bot(self, player, self.ai_difficulty)
+    
+    # Everything that changes the game between steps goes through these, so recordings see it
+    def start_countdown(self, seconds):
+        self.game.start_countdown(seconds)
+        if self.recorder is not None:
+            self.recorder.countdown(seconds)
     
     def move_paddle(self, player, direction):
-        paddle_speed = 15  # Increased from 10
-        if player == 1:
-            if direction == "up" and self.player1_y > 0:
-                self.player1_y -= paddle_speed
-            elif direction == "down" and self.player1_y < WINDOW_HEIGHT - PADDLE_HEIGHT:
-                self.player1_y += paddle_speed
-        elif player == 2:
-            if direction == "up" and self.player2_y > 0:
-                self.player2_y -= paddle_speed
-            elif direction == "down" and self.player2_y < WINDOW_HEIGHT - PADDLE_HEIGHT:
-                self.player2_y += paddle_speed
-    
-    def get_state(self):
-        return {
-            "ball": {"x": self.ball_x, "y": self.ball_y},
-            "player1": {"y": self.player1_y},
-            "player2": {"y": self.player2_y},
-            "score": {"player1": self.score_player1, "player2": self.score_player2},
-            "countdown": self.countdown if not self.game_active and self.countdown_timer else None,
-            "winner": self.winner
-        }
+        self.game.move_paddle(player, direction)
+        if self.recorder is not None:
+            self.recorder.move(player, direction)
+    
+    def restart(self):
+        self.save_result()
+        self.game.restart_game()
+        self.match_clock = self.game.clock
+        self.miss_seqs[1] = self.miss_seqs[2] = NO_MISS
+        if self.recorder is not None:
+            self.recorder.restart()
+    
+    def close(self):
+        self.save_result()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+    
+    def record_snapshot(self, now=0.0):
+        previous = self.snapshot(self.snapshot_seq)
+        self.snapshot_seq += 1
+        values = protocol.state_values(self.game, self.input_seqs[1], self.input_seqs[2])
+        self.snapshots[self.snapshot_seq % SNAPSHOT_HISTORY] = values
+        self.snapshot_times[self.snapshot_seq % SNAPSHOT_HISTORY] = now
+        if previous is not None and (values[4] != previous[4] or values[5] != previous[5] or values[7] != previous[7]):
+            self.events.append(self.match_event(values, previous))
+            if values[7] and not previous[7]:
+                self.finish = (time.time(), self.game.clock - self.match_clock, self.player_name(1), self.player_name(2))
+        self.rewound = False
+        if self.history is not None:
+            replay.pack_state_into(self.history, self.snapshot_seq % SNAPSHOT_HISTORY * replay.GAME_STATE.size, self.game)
+            if previous is not None:
+                # The ball got past a paddle face, or scored, since the last round
+                if previous[0] >= PADDLE_WIDTH and (values[0] < PADDLE_WIDTH or values[5] > previous[5]):
+                    self.miss_seqs[1] = self.snapshot_seq - 1
+                if previous[0] <= BALL_RIGHT_CONTACT_X and (values[0] > BALL_RIGHT_CONTACT_X or values[4] > previous[4]):
+                    self.miss_seqs[2] = self.snapshot_seq - 1
+    
+    def player_name(self, player):
+        client = self.players.get(player)
+        if client is not None:
+            return client.name
+        if player in self.bots:
+            return f"bot ({self.bots[player].difficulty})"
+        return "nobody"
     
-    def restart_game(self):
-        self.score_player1 = 0
-        self.score_player2 = 0
-        self.winner = None
-        self.reset_ball()
+    def save_result(self):
+        # A match is over for good when it restarts or its room closes, a late hit can't take the
+        # winning point back any more
+        game = self.game
+        if self.results is not None and self.finish is not None and game.winner:
+            finished_at, duration, player1, player2 = self.finish
+            replay_name = os.path.basename(self.recorder.file.name) if self.recorder is not None else None
+            self.results.record(finished_at, duration, player1, player2, game.score_player1, game.score_player2,
+                                protocol.WINNER_CODES[game.winner], replay_name)
+        self.finish = None
+    
+    def snapshot(self, seq):
+        # State values of snapshot seq, None once it has left the history
+        if seq is None or not 0 <= self.snapshot_seq - seq < SNAPSHOT_HISTORY:
+            return None
+        return self.snapshots[seq % SNAPSHOT_HISTORY]
+    
+    def match_event(self, values, previous):
+        # Scores and winner go to UDP players reliably as well, their states may never arrive
+        if self.rewound:
+            kind = "rewind"  # A late paddle hit took the point back
+        elif values[7] and not previous[7]:
+            kind = "winner"
+        elif previous[7] and not values[7] or values[4] + values[5] < previous[4] + previous[5]:
+            kind = "restart"
+        else:
+            kind = "score"
+        return {"event": kind, "score": {"player1": values[4], "player2": values[5]},
+                "winner": protocol.WINNER_NAMES.get(values[7])}
+    
+    def rewind_hit(self, player, view_seq, dt):
+        # Lag compensation. The player moved while looking at snapshot view_seq, from before the
+        # ball got past their paddle, so play the ball again from the last round before it did
+        # with the paddles where they are now. If the paddle hits it that way the hit counts: the
+        # ball, scores and countdown become the replayed ones, the paddles and clock stay.
+        # Returns whether the hit was granted.
+        miss_seq = self.miss_seqs[player]
+        if miss_seq == NO_MISS or view_seq > miss_seq or self.snapshot_seq - view_seq > self.max_rewind:
+            return False
+        game = self.game
+        replayed = PongGame(0)
+        replay.restore_state(replayed, self.history, miss_seq % SNAPSHOT_HISTORY * replay.GAME_STATE.size)
+        scores = (replayed.score_player1, replayed.score_player2)
+        replayed.player1_y = game.player1_y
+        replayed.player2_y = game.player2_y
+        for _ in range(round((game.clock - replayed.clock) / dt)):
+            replayed.step(dt)
+        if (replayed.score_player1, replayed.score_player2) != scores:
+            return False  # Missed anyway
+        if (replayed.ball_velocity_x > 0) != (player == 1):
+            return False  # Not back yet
+        
+        game.ball_x, game.ball_y = replayed.ball_x, replayed.ball_y
+        game.ball_velocity_x, game.ball_velocity_y = replayed.ball_velocity_x, replayed.ball_velocity_y
+        game.score_player1, game.score_player2 = scores
+        game.game_active, game.countdown, game.countdown_timer = replayed.game_active, replayed.countdown, replayed.countdown_timer
+        game.winner = replayed.winner
+        game.rng_state = replayed.rng_state
+        self.miss_seqs[player] = NO_MISS
+        self.rewound = True
+        if self.recorder is not None:
+            self.recorder.set_state()
+        return True
+
+
+def advance_rooms(engine, ai_service, rooms, dt):
+    # Update game state, the engine steps every room's game at once, then the recordings and bots follow
+    engine.step(dt)
+    for room in rooms:
+        if room.recorder is not None:
+            room.recorder.step()
+    ai_service.update(rooms, dt)
+
+
+class ClientConnection:
+    def __init__(self, client_socket, address):
+        self.socket = client_socket
+        self.address = address
+        self.name = results.player_name(None, address)  # For the match history, the client can pick its own
+        self.room = None
+        self.player_number = None
+        self.protocol = None  # Negotiated wire protocol, None until the handshake is done
+        self.connected_at = time.monotonic()
+        self.inbound = ""  # Received JSON text not yet parsed into commands
+        self.frames = protocol.FrameDecoder()  # Received binary frames once the handshake picks binary
+        self.acked_seq = None  # Newest snapshot the client confirmed, the baseline for its next delta
+        self.rtt = None  # Smoothed seconds from sending a snapshot to its acknowledgement
+        self.min_rtt = None  # Best round trip time seen, the link without queueing
+        self.peer = None  # udp.Peer when the client plays over UDP, then socket is None
+        self.last_move_seq = None  # Newest move sequence number received, UDP moves can arrive out of order
+        self.view_seq = None  # Snapshot the client was looking at when it last moved, for lag compensation
+        
+        # Moves wait here until the next physics step, which applies as many as the rate limit allows
+        self.inputs = collections.deque(maxlen=MAX_QUEUED_INPUTS)  # (direction, sequence number)
+        self.input_tokens = INPUT_BURST  # Rate limiter bucket, refilled with simulation time
+        self.input_tokens_clock = 0.0
+        self.inputs_deferred = 0
+        self.inputs_dropped = 0
+        self.outbound = collections.deque()  # Encoded messages waiting for the socket to drain
+        self.out_offset = 0  # Bytes of the first queued message already sent
+        self.state_queued = False  # The last queued message is a state not started yet, a newer one replaces it
+        self.last_send_at = self.connected_at  # When the socket last took any bytes
+        self.closed = False
+        
+        # Snapshot rate, adapted to the link (see adapt_snapshot_rate)
+        self.snapshot_every = 1  # Snapshot rounds per state sent
+        self.snapshot_wait = 0  # Rounds until the next state is sent
+        self.rate_changed_at = self.connected_at
+        self.congested_at = None  # When the link last looked congested
+        self.snapshots_coalesced = 0
 
 
 class PongServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, max_rooms=MAX_ROOMS,
+                 physics_rate=PHYSICS_RATE, snapshot_rate=SNAPSHOT_RATE, engine=PHYSICS_ENGINE,
+                 use_udp=False, loss=0.0, latency=0.0, jitter=0.0, record_dir=None,
+                 metrics_host=METRICS_HOST, metrics_port=None,
+                 spectator_port=None, spectator_rate=broadcast.SPECTATOR_RATE,
+                 bot_matches=0, ai_difficulty=ai.DEFAULT_DIFFICULTY, max_rewind=MAX_REWIND, results_path=None):
         self.host = host
         self.port = port
+        self.max_rooms = max_rooms
+        self.physics_dt = 1 / physics_rate
+        self.input_bucket = INPUT_BURST + MAX_INPUT_RATE * self.physics_dt  # Most moves one step can apply
+        self.snapshot_interval = 1 / snapshot_rate
+        # In snapshot rounds, the history has to hold the round before the oldest view too
+        self.max_rewind = min(SNAPSHOT_HISTORY - 2, round(max_rewind * snapshot_rate))
+        self.rewound_hits = 0  # Paddle hits granted by lag compensation since start
+        self.engine = engines.create_engine(engine)
+        self.record_dir = record_dir  # Each room's match is recorded to a replay file here when set
+        self.results = results.ResultStore(results_path) if results_path is not None else None  # Match history
+        self.ai = ai.AIService()  # Moves every bot paddle, see ai.py
+        self.ai_difficulty = ai_difficulty
+        self.bot_matches = bot_matches  # Rooms played by bots alone, for soak tests without clients
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.game = PongGame()
+        
+        # UDP clients share one socket on the same port, the shim simulates a bad network on what we send them
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) if use_udp else None
+        self.udp_out = self.udp_socket
+        self.network_shim = None
+        if use_udp and (loss or latency or jitter):
+            self.network_shim = self.udp_out = udp.LossySocket(self.udp_socket, loss, latency, jitter)
+        self.udp_clients = {}  # UDP clients indexed by address
+        self.selector = selectors.DefaultSelector()
+        self.decoder = json.JSONDecoder()
+        self.rooms = {}  # Room indexed by room id
+        self.waiting_rooms = {}  # Rooms with a free paddle, in the order they opened up
+        self.next_room_id = 1
         self.clients = []
-        self.client_data = {}  # Store player info indexed by client socket
-    
-    def start(self):
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(2)
-        print(f"Server started on {self.host}:{self.port}")
+        self.input_clients = {}  # Clients with queued moves, the only ones the input step visits
+        
+        # Each room's frames are packed into this buffer and sent straight from it, so a steady
+        # snapshot round allocates next to nothing. A frame is only copied out when a socket
+        # can't take it right away.
+        self.encode_buffer = bytearray(ENCODE_BUFFER_SIZE)
+        self.encode_view = memoryview(self.encode_buffer)
+        self.encode_offset = 0
+        self.encoded = {}  # Frames for the room being sent, indexed by baseline, shared by its clients
+        
+        # Spectators get every broadcast_every-th snapshot through the broadcaster, which sends
+        # them in the time left between physics steps (see broadcast.py)
+        self.spectator_port = spectator_port
+        self.broadcaster = None
+        self.broadcast_every = max(1, round(snapshot_rate / spectator_rate))
+        self.snapshot_round = 0
+        self.skipped_broadcasts = 0  # Rounds not published because the previous one was still being sent
+        self.running = False
+        self.event_time = 0.0  # When the loop last woke up, stamps acknowledgements without a clock call each
+        
+        # Instrumentation, served over HTTP when metrics_port is set (see metrics.py)
+        self.metrics_address = (metrics_host, metrics_port) if metrics_port is not None else None
+        self.metrics_endpoint = None
+        self.profiler = None
+        self.tick_histogram = metrics.Histogram(metrics.TIME_BUCKETS)
+        self.send_histogram = metrics.Histogram(metrics.TIME_BUCKETS)
+        self.serialize_histogram = metrics.Histogram(metrics.TIME_BUCKETS)  # Encoding time per snapshot round
+        self.rtt_histogram = metrics.Histogram(metrics.RTT_BUCKETS)
+        self.encode_time = 0.0  # Encoding time in the current snapshot round
+        self.traffic = {"tcp_in": 0, "tcp_out": 0, "udp_in": 0, "udp_out": 0}  # Bytes since start
+        self.overrun_totals = {"slow_step": 0, "dropped_step": 0, "skipped_snapshot": 0}  # Up to the last debug print
+        
+        # Input counters since start
+        # deferred counts the moves still queued after each step, waiting for the rate limit
+        self.input_stats = {"received": 0, "applied": 0, "deferred": 0, "overflow": 0, "stale": 0}
         
-        # Start the game loop in a separate thread
-        game_thread = threading.Thread(target=self.game_loop)
-        game_thread.daemon = True
-        game_thread.start()
+        # Tick overrun counters, reported with the debug info
+        self.slow_steps = 0  # Steps whose work took longer than the step itself
+        self.dropped_steps = 0  # Steps skipped because the loop fell too far behind
+        self.skipped_snapshots = 0
+        self.max_lag = 0.0  # Longest a step started after its deadline
         
+        # Congestion control, see adapt_snapshot_rate
+        self.max_snapshot_every = max(1, round(snapshot_rate / MIN_SNAPSHOT_RATE))
+        self.rate_changes = {"decrease": 0, "increase": 0}
+        self.snapshots_coalesced = 0  # Queued states replaced by a newer one before they went out
+        self.drop_reasons = collections.Counter()  # Clients removed, by why
+        
+        # Recent durations in seconds, for load tests
+        self.step_times = collections.deque(maxlen=TIMING_HISTORY)
+        self.send_times = collections.deque(maxlen=TIMING_HISTORY)  # Encoding and sending one round of snapshots
+    
+    def start(self):
+        self.listen()
+        self.open_bot_matches()
+        self.profiler = metrics.SamplingProfiler()
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.profiler.toggle())
+        if self.metrics_address is not None:
+            self.metrics_endpoint = metrics.HttpEndpoint(*self.metrics_address, self.selector, self.handle_http)
+        if self.spectator_port is not None:
+            self.broadcaster = broadcast.Broadcaster(self.selector, self.host, self.spectator_port, self.find_stream,
+                                                     1 / (self.snapshot_interval * self.broadcast_every))
+        self.running = True
         try:
-            # Accept connections and handle clients
-            while True:
-                client_socket, client_address = self.server_socket.accept()
-                print(f"Client connected from {client_address}")
-                
-                # Assign player number based on connection order
-                player_number = len(self.clients) + 1
-                if player_number > 2:
-                    print(f"Rejecting client {client_address}, server full")
-                    client_socket.send(json.dumps({"error": "Server full"}).encode())
-                    client_socket.close()
-                    continue
-                    
-                # Send player number to client
-                client_socket.send(json.dumps({"player_number": player_number}).encode())
-                
-                # Add client to list and start handling thread
-                self.clients.append(client_socket)
-                self.client_data[client_socket] = {
-                    "address": client_address,
-                    "player_number": player_number
-                }
-                
-                # Start a new thread to handle this client
-                client_thread = threading.Thread(target=self.handle_client, args=(client_socket,))
-                client_thread.daemon = True
-                client_thread.start()
-                
-                # Start the countdown when first player connects (for testing single player)
-                if player_number == 1:
-                    print("First player connected. Starting game in 5 seconds...")
-                    self.game.countdown = 5
-                    self.game.countdown_timer = time.time() + 1
-                
-                # Start actual game when second player connects
-                if player_number == 2:
-                    print("Second player connected. Game starting!")
-                    self.game.countdown = 3
-                    self.game.countdown_timer = time.time() + 1
-                
+            self.run_loop()
         except KeyboardInterrupt:
             print("Server shutting down...")
         finally:
+            for client in self.clients.copy():
+                self.remove_client(client, "shutdown")
+            for room in self.rooms.values():
+                room.close()  # Bot matches, the rest closed with their last player
+            if self.results is not None:
+                self.results.close()  # Waits for the last results to be written
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.close()
+            if self.broadcaster is not None:
+                self.broadcaster.close()
+            self.selector.close()
             self.server_socket.close()
+            if self.udp_socket is not None:
+                self.udp_socket.close()
     
-    def game_loop(self):
-        # Initial delay to make sure the server is fully set up
-        time.sleep(1)
-        
+    def listen(self):
+        # Open the sockets new clients arrive on, readiness on them is handled by accept_clients and read_datagrams
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(LISTEN_BACKLOG)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        print(f"Server started on {self.host}:{self.port}")
+        if self.udp_socket is not None:
+            self.udp_socket.bind((self.host, self.port))
+            self.udp_socket.setblocking(False)
+            self.selector.register(self.udp_socket, selectors.EVENT_READ, None)
+            print(f"Accepting UDP clients on {self.host}:{self.port}")
+    
+    def stop(self):
+        self.running = False
+    
+    def run_loop(self):
+        # One thread runs all socket I/O and the game ticks, so nothing else touches the rooms.
+        # Steps and snapshots run on fixed deadlines advanced by their interval, never by
+        # "now + interval", so time spent in I/O or sleeping can't make the loop drift.
         last_update_time = time.time()
+        next_step = time.perf_counter() + self.physics_dt
+        next_snapshot = time.perf_counter() + self.snapshot_interval
         
-        while True:
-            current_time = time.time()
+        while self.running:
+            timeout = max(0.0, min(next_step, next_snapshot) - time.perf_counter())
+            if self.broadcaster is not None and self.broadcaster.work:
+                timeout = 0.0  # Spectators still have frames to go out
+            if self.network_shim is not None:
+                # Release delayed datagrams on time
+                self.network_shim.flush()
+                due = self.network_shim.next_due()
+                if due is not None:
+                    timeout = min(timeout, max(0.0, due - time.monotonic()))
+            ready = self.selector.select(timeout)
+            self.event_time = time.monotonic()
+            for key, events in ready:
+                if key.fileobj is self.udp_socket:
+                    self.read_datagrams()
+                    continue
+                if key.data is None:
+                    self.accept_clients()
+                    continue
+                if callable(key.data):
+                    key.data(events)  # The metrics endpoint and spectators
+                    continue
+                client = key.data
+                if client.closed:
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.guarded(client, self.read_client)
+                if events & selectors.EVENT_WRITE and not client.closed:
+                    self.flush_client(client)
             
-            # Update game state
-            self.game.update_countdown()
-            self.game.update()
+            # Catch up on every step that is due, up to a limit
+            now = time.perf_counter()
+            steps = 0
+            while now >= next_step and steps < MAX_CATCH_UP_STEPS:
+                self.max_lag = max(self.max_lag, now - next_step)
+                self.step_rooms(self.physics_dt)
+                next_step += self.physics_dt
+                steps += 1
+                finished = time.perf_counter()
+                self.step_times.append(finished - now)
+                self.tick_histogram.observe(finished - now)
+                if finished - now > self.physics_dt:
+                    self.slow_steps += 1
+                now = finished
+            if now >= next_step:
+                # Too far behind to catch up, drop the missed time instead of spiralling
+                missed = int((now - next_step) / self.physics_dt) + 1
+                self.dropped_steps += missed
+                next_step += missed * self.physics_dt
             
-            # Send game state to all connected clients
-            game_state = self.game.get_state()
-            state_json = json.dumps(game_state).encode()
+            if now >= next_snapshot:
+                self.encode_time = 0.0
+                self.send_snapshots()
+                self.send_times.append(time.perf_counter() - now)
+                self.send_histogram.observe(self.send_times[-1])
+                self.serialize_histogram.observe(self.encode_time)
+                self.service_peers()
+                self.snapshot_round += 1
+                if self.broadcaster is not None and self.snapshot_round % self.broadcast_every == 0:
+                    self.broadcast_snapshots()
+                next_snapshot += self.snapshot_interval
+                if next_snapshot <= now:
+                    missed = int((now - next_snapshot) / self.snapshot_interval) + 1
+                    self.skipped_snapshots += missed
+                    next_snapshot += missed * self.snapshot_interval
             
-            # Create a copy of clients list to avoid modification during iteration
-            clients_copy = self.clients.copy()
-            for client in clients_copy:
-                try:
-                    client.send(state_json)
-                except ConnectionResetError:
-                    self.remove_client(client)
-                except BrokenPipeError:
-                    self.remove_client(client)
-                except:
-                    # Client disconnected, remove it properly
-                    self.remove_client(client)
+            # Spectators get whatever time is left before the next step
+            if self.broadcaster is not None and self.broadcaster.work:
+                self.broadcaster.fan_out(next_step - BROADCAST_MARGIN)
             
             # Debug info 
+            current_time = time.time()
             if len(self.clients) > 0 and current_time - last_update_time >= 5:
-                print(f"Game state update: {len(self.clients)} client(s) connected")
-                print(f"Game active: {self.game.game_active}, Countdown: {self.game.countdown}")
+                print(f"Game state update: {len(self.clients)} client(s) connected in {len(self.rooms)} room(s)")
+                stats = self.input_stats
+                print(f"Inputs: {stats['received']} received, {stats['applied']} applied, {stats['deferred']} deferred, "
+                      f"{stats['overflow']} dropped on overflow, {stats['stale']} stale")
+                if self.udp_clients:
+                    resends = sum(client.peer.channel.resends for client in self.udp_clients.values())
+                    lost = f", {self.network_shim.lost} datagram(s) lost by the network shim" if self.network_shim else ""
+                    print(f"UDP: {len(self.udp_clients)} client(s), {resends} control message resend(s){lost}")
+                reduced = sum(client.snapshot_every > 1 for client in self.clients)
+                if reduced or self.snapshots_coalesced:
+                    print(f"Snapshot rates: {reduced} client(s) on a reduced rate, "
+                          f"{self.rate_changes['decrease']} decrease(s), {self.rate_changes['increase']} increase(s), "
+                          f"{self.snapshots_coalesced} queued state(s) coalesced")
+                if self.results is not None and (self.results.written or self.results.pending()):
+                    print(f"Match history: {self.results.written} result(s) written, {self.results.pending()} waiting, "
+                          f"{self.results.dropped} dropped")
+                if self.rewound_hits:
+                    print(f"Lag compensation: {self.rewound_hits} paddle hit(s) granted from what the player saw")
+                if self.slow_steps or self.dropped_steps or self.skipped_snapshots:
+                    print(f"Tick overruns: {self.slow_steps} slow step(s), {self.dropped_steps} dropped step(s), "
+                          f"{self.skipped_snapshots} skipped snapshot(s), max lag {self.max_lag * 1000:.1f} ms")
+                self.overrun_totals["slow_step"] += self.slow_steps
+                self.overrun_totals["dropped_step"] += self.dropped_steps
+                self.overrun_totals["skipped_snapshot"] += self.skipped_snapshots
+                self.slow_steps = self.dropped_steps = self.skipped_snapshots = 0
+                self.max_lag = 0.0
                 last_update_time = current_time
-            
-            # Special case: Single player - make player 2 follow the ball
-            if len(self.clients) == 1 and self.game.game_active:
-                # Simple AI: Move paddle towards the ball
-                paddle_center = self.game.player2_y + PADDLE_HEIGHT // 2
-                ball_center = self.game.ball_y + BALL_SIZE // 2
-                
-                if paddle_center < ball_center - 10:  # Add some threshold to avoid jitter
-                    self.game.move_paddle(2, "down")
-                elif paddle_center > ball_center + 10:
-                    self.game.move_paddle(2, "up")
-            
-            # Control game speed
-            time.sleep(TICK_RATE)
-    
-    def remove_client(self, client_socket):
-        if client_socket in self.clients:
-            player_num = self.client_data[client_socket]["player_number"]
-            print(f"Client {player_num} disconnected")
-            self.clients.remove(client_socket)
-            del self.client_data[client_socket]
+    
+    def accept_clients(self):
+        # Drain the accept backlog without blocking
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors and similar, try again on the next readiness event
+                print(f"Error accepting client: {e}")
+                return
+            self.add_client(client_socket, client_address)
+    
+    def add_client(self, client_socket, client_address):
+        client_socket.setblocking(False)
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SEND_BUFFER)
+        
+        room = self.find_room()
+        if room is None:
+            print(f"Rejecting client {client_address}, server full")
             try:
-                client_socket.close()
-            except:
+                client_socket.send(json.dumps({"error": "Server full"}).encode())
+            except OSError:
                 pass
+            client_socket.close()
+            return
+        
+        client = ClientConnection(client_socket, client_address)
+        self.selector.register(client_socket, selectors.EVENT_READ, client)
+        self.send_to_client(client, json.dumps(self.seat_client(client, room)).encode())
+    
+    def seat_client(self, client, room):
+        # Assign player number based on the free paddle in the room
+        self.clients.append(client)
+        client.room = room
+        client.player_number = room.add_player(client)
+        if room.is_full():
+            self.waiting_rooms.pop(room.room_id, None)
+        
+        # Welcome with the player number and the protocols we speak, states follow once the client picks one
+        return {"player_number": client.player_number, "protocols": protocol.SUPPORTED_PROTOCOLS,
+                "snapshot_rate": 1 / self.snapshot_interval}
+    
+    def read_datagrams(self):
+        # Drain the UDP socket, a datagram from an unknown address can only be a join request
+        while True:
+            try:
+                packet, address = self.udp_socket.recvfrom(udp.MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # An earlier datagram bounced, that is for the timeouts to notice
+            self.traffic["udp_in"] += len(packet)
+            
+            client = self.udp_clients.get(address)
+            if client is None:
+                self.join_over_udp(packet, address)
+                continue
+            
+            self.guarded(client, self.read_datagram, packet)
     
-    def handle_client(self, client_socket):
+    def read_datagram(self, client, packet):
+        frames, messages = client.peer.receive(packet)
+        if frames is not None:
+            client.frames.feed(frames)
+            self.read_frames(client)
+            client.frames.clear()  # Datagrams hold whole frames, never carry a broken one over
+        for message in messages:
+            if client.closed:
+                break
+            if not isinstance(message, dict):
+                continue
+            if message.get("leave"):
+                self.remove_client(client, "left")
+            else:
+                self.handle_command(client, message)
+    
+    def guarded(self, client, handler, *args):
+        # Everything shares one loop, so a client whose messages break a handler is dropped
+        # rather than taking every room down with it
         try:
-            player_number = self.client_data[client_socket]["player_number"]
+            handler(client, *args)
+        except Exception as e:
+            self.remove_client(client, "bad_message", repr(e))
+    
+    def join_over_udp(self, packet, address):
+        peer = udp.Peer(self.udp_out, address)
+        _, messages = peer.receive(packet)
+        join = next((message for message in messages if isinstance(message, dict) and message.get("join")), None)
+        if join is None:
+            return  # Left over from a client we already dropped
+        
+        room = self.find_room()
+        if room is None:
+            print(f"Rejecting client {address}, server full")
+            peer.send_reliable({"error": "Server full"})
+            return
+        
+        # UDP clients always get binary states, there is nothing to negotiate
+        client = ClientConnection(None, address)
+        client.peer = peer
+        client.protocol = protocol.BINARY_PROTOCOL
+        client.name = results.player_name(join.get("name"), address)
+        self.udp_clients[address] = client
+        welcome = self.seat_client(client, room)
+        welcome["protocol"] = protocol.BINARY_PROTOCOL
+        peer.send_reliable(welcome)
+    
+    def service_peers(self):
+        # Resend unacknowledged control messages and drop UDP clients that went quiet
+        now = time.monotonic()
+        for client in list(self.udp_clients.values()):
+            if not client.peer.service(now):
+                print(f"Client {client.address} stopped responding over UDP, dropping it")
+                self.remove_client(client, "udp_timeout")
+    
+    def find_room(self):
+        # Match into the room that has waited longest for a player, otherwise open a new one
+        for room in self.waiting_rooms.values():
+            return room
+        if len(self.rooms) >= self.max_rooms:
+            return None
+        room = self.open_room()
+        self.waiting_rooms[room.room_id] = room
+        return room
+    
+    def open_bot_matches(self):
+        for _ in range(min(self.bot_matches, self.max_rooms)):
+            room = self.open_room(bot_match=True)
+            room.start_countdown(3)
+        if self.bot_matches:
+            print(f"Started {min(self.bot_matches, self.max_rooms)} bot match(es) at {self.ai_difficulty} difficulty")
+    
+    def open_room(self, bot_match=False):
+        game = self.engine.new_game()
+        recorder = None
+        if self.record_dir is not None:
+            # Worker processes number their rooms independently, the process id keeps the names apart
+            name = f"match-{os.getpid()}-{self.next_room_id}-{time.strftime('%Y%m%d-%H%M%S')}.pongreplay"
+            recorder = replay.ReplayWriter(os.path.join(self.record_dir, name), game, self.physics_dt)
+        room = Room(self.next_room_id, game, recorder, self.ai, self.ai_difficulty, bot_match, self.max_rewind,
+                    self.results)
+        self.next_room_id += 1
+        self.rooms[room.room_id] = room
+        return room
+    
+    def step_rooms(self, dt):
+        self.apply_inputs()
+        advance_rooms(self.engine, self.ai, self.rooms.values(), dt)
+    
+    def send_snapshots(self):
+        now = time.monotonic()
+        for room in list(self.rooms.values()):
+            room.record_snapshot(now)
             
-            # Send initial game state immediately after connection
+            # Send game state to the players in this room, players sharing a baseline share the encoding
+            self.encoded.clear()
+            self.encode_offset = 0
+            for client in list(room.players.values()):
+                if client.protocol is None:
+                    if now - client.connected_at < HANDSHAKE_TIMEOUT:
+                        continue
+                    client.protocol = protocol.JSON_PROTOCOL
+                if client.snapshot_wait > 1:
+                    client.snapshot_wait -= 1
+                    continue
+                self.adapt_snapshot_rate(client, now)
+                client.snapshot_wait = client.snapshot_every
+                self.send_state(client, self.encode_state(client, room, self.encoded), now)
+            
+            if room.events:
+                for client in room.players.values():
+                    if client.peer is not None:
+                        for event in room.events:
+                            client.peer.send_reliable(event)
+                room.events.clear()
+    
+    def adapt_snapshot_rate(self, client, now):
+        # Additive increase, multiplicative decrease, like TCP's own congestion control. The link
+        # counts as congested when the last state hasn't left the socket by the time the next is
+        # due, or when the round trip time rises well over the best seen, the sign of a queue
+        # building up somewhere on the way.
+        backlog = bool(client.outbound)
+        queueing = client.rtt is not None and client.rtt > client.min_rtt + RTT_CONGESTION_MARGIN
+        if backlog or queueing:
+            client.congested_at = now
+            if client.snapshot_every < self.max_snapshot_every and now - client.rate_changed_at >= RATE_DECREASE_HOLD:
+                client.snapshot_every = min(self.max_snapshot_every, client.snapshot_every * 2)
+                client.rate_changed_at = now
+                self.rate_changes["decrease"] += 1
+                print(f"Client {client.address} link congested ({'send backlog' if backlog else 'round trip time'} "
+                      f"{client.rtt * 1000 if client.rtt is not None else 0:.0f} ms), "
+                      f"snapshot rate down to {self.client_snapshot_rate(client):.0f} Hz")
+        elif client.snapshot_every > 1 and now - max(client.rate_changed_at, client.congested_at or 0.0) >= RATE_INCREASE_DELAY:
+            client.snapshot_every -= 1
+            client.rate_changed_at = now
+            self.rate_changes["increase"] += 1
+    
+    def client_snapshot_rate(self, client):
+        return 1 / (self.snapshot_interval * client.snapshot_every)
+    
+    def broadcast_snapshots(self):
+        # Publish each watched room's latest snapshot to its spectators, encoded once per room
+        if self.broadcaster.work:
+            # Spectators haven't all had the previous round yet, their rate drops until they do
+            self.skipped_broadcasts += 1
+            return
+        for room in self.rooms.values():
+            if room.broadcast is not None and room.broadcast.viewers:
+                self.broadcaster.publish(room.broadcast, room.snapshot_seq, room.snapshot(room.snapshot_seq))
+    
+    def find_stream(self, room_id):
+        # The room a spectator asked for, or without one the longest running match with both paddles played
+        if room_id is None:
+            room = next((room for room in self.rooms.values() if room.is_full() or room.bot_match), None)
+        else:
+            room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        if room.broadcast is None:
+            room.broadcast = broadcast.Broadcast(room.room_id)
+            room.broadcast.publish(room.snapshot_seq, room.snapshot(room.snapshot_seq))
+        return room.broadcast
+    
+    def encode_state(self, client, room, encoded):
+        # Binary clients get a delta against their acknowledged snapshot, or a full one without it
+        if client.protocol == protocol.BINARY_PROTOCOL:
+            baseline_seq = client.acked_seq if room.snapshot(client.acked_seq) is not None else None
+            if baseline_seq is not None and room.snapshot_seq - baseline_seq > protocol.MAX_BASELINE_AGE:
+                baseline_seq = None
+            key = baseline_seq
+        else:
+            key = protocol.JSON_PROTOCOL
+        
+        if key not in encoded:
+            started = time.perf_counter()
+            values = room.snapshot(room.snapshot_seq)
+            offset = self.encode_offset
+            if key == protocol.JSON_PROTOCOL:
+                encoded[key] = protocol.encode_json_state(values)
+            elif offset + protocol.MAX_STATE_FRAME > len(self.encode_buffer):
+                # Buffer used up by this room's other baselines, encode on the side
+                encoded[key] = (protocol.encode_snapshot(room.snapshot_seq, values) if key is None else
+                                protocol.encode_delta(room.snapshot_seq, values, baseline_seq, room.snapshot(baseline_seq)))
+            else:
+                if key is None:
+                    self.encode_offset = protocol.encode_snapshot_into(self.encode_buffer, offset, room.snapshot_seq, values)
+                else:
+                    self.encode_offset = protocol.encode_delta_into(self.encode_buffer, offset, room.snapshot_seq, values,
+                                                                    baseline_seq, room.snapshot(baseline_seq))
+                encoded[key] = self.encode_view[offset:self.encode_offset]
+            self.encode_time += time.perf_counter() - started
+        return encoded[key]
+    
+    def send_state(self, client, data, now):
+        if client.outbound:
+            if now - client.last_send_at > SEND_STALL_TIMEOUT:
+                print(f"Client {client.address} took nothing for {now - client.last_send_at:.1f} s, "
+                      f"{self.backlog_bytes(client)} bytes queued, dropping it")
+                self.remove_client(client, "stalled")
+                return
+            if client.state_queued and (len(client.outbound) > 1 or client.out_offset == 0):
+                # The queued state hasn't started going out, it would only arrive stale, send this one instead.
+                # Every state is complete against the client's acknowledged baseline, so none is missed.
+                client.outbound[-1] = bytes(data)
+                client.snapshots_coalesced += 1
+                self.snapshots_coalesced += 1
+                return
+        self.send_to_client(client, data)
+        client.state_queued = bool(client.outbound)
+    
+    def backlog_bytes(self, client):
+        return sum(len(data) for data in client.outbound) - client.out_offset
+    
+    def send_to_client(self, client, data):
+        # data may be a view into encode_buffer, anything kept for later is copied out of it
+        if client.closed:
+            return
+        if client.peer is not None:
+            client.peer.send_state(data)  # Never queued or resent, a newer state replaces a lost one
+            self.traffic["udp_out"] += len(data) + 1
+            return
+        
+        # Queue behind anything still waiting so messages stay in order
+        if client.outbound:
+            if len(client.outbound) >= MAX_OUTBOUND_MESSAGES:
+                print(f"Client {client.address} is not keeping up, {len(client.outbound)} messages "
+                      f"({self.backlog_bytes(client)} bytes) queued, dropping it")
+                self.remove_client(client, "send_backlog")
+                return
+            client.outbound.append(bytes(data))
+            client.state_queued = False
+            return
+        
+        try:
+            sent = client.socket.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError as e:
+            # Client disconnected, remove it properly
+            self.remove_client(client, "send_error", e)
+            return
+        self.traffic["tcp_out"] += sent
+        if sent:
+            client.last_send_at = self.event_time
+        
+        if sent < len(data):
+            # Socket buffer is full, keep the rest and wait until it is writable
+            client.outbound.append(bytes(data))
+            client.out_offset = sent
+            self.selector.modify(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+    
+    def flush_client(self, client):
+        while client.outbound:
+            data = client.outbound[0]
             try:
-                initial_state = self.game.get_state()
-                client_socket.send(json.dumps(initial_state).encode())
-            except:
-                print("Failed to send initial state")
+                sent = client.socket.send(memoryview(data)[client.out_offset:])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.remove_client(client, "send_error", e)
+                return
+            self.traffic["tcp_out"] += sent
+            client.last_send_at = self.event_time
+            client.out_offset += sent
+            if client.out_offset < len(data):
+                return
+            client.outbound.popleft()
+            client.out_offset = 0
+        client.state_queued = False
+        
+        # Everything is sent, stop waiting for writability
+        self.selector.modify(client.socket, selectors.EVENT_READ, client)
+    
+    def read_client(self, client):
+        try:
+            data = client.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.remove_client(client)
+            return
+        self.traffic["tcp_in"] += len(data)
+        
+        if client.protocol == protocol.BINARY_PROTOCOL:
+            client.frames.feed(data)
+            self.read_frames(client)
+            return
+        
+        # Latin-1 keeps one character per byte, so leftovers after the handshake map back exactly
+        client.inbound += data.decode("latin-1")
+        if len(client.inbound) > MAX_INBOUND_BUFFER:
+            print(f"Client {client.address} sent too much unparsed data, dropping it")
+            self.remove_client(client, "inbound_flood")
+            return
+        
+        # Commands arrive back to back on the stream, decode as many complete ones as we have
+        position = 0
+        while True:
+            while position < len(client.inbound) and client.inbound[position].isspace():
+                position += 1
+            if position >= len(client.inbound):
+                break
+            try:
+                command, position = self.decoder.raw_decode(client.inbound, position)
+            except json.JSONDecodeError:
+                if client.inbound.find("}", position) == -1:
+                    break  # Incomplete command, wait for more data
+                print(f"Received invalid JSON: {client.inbound[position:]}")
+                position = len(client.inbound)
+                break
+            if isinstance(command, dict):
+                self.handle_command(client, command)
+            if client.closed:
+                return
+            if client.protocol == protocol.BINARY_PROTOCOL:
+                # Everything after the handshake is framed, hand the rest to the frame decoder
+                client.frames.feed(client.inbound[position:].encode("latin-1"))
+                client.inbound = ""
+                self.read_frames(client)
+                return
+        client.inbound = client.inbound[position:]
+    
+    def read_frames(self, client):
+        if client.frames.pending() > MAX_INBOUND_BUFFER:
+            print(f"Client {client.address} sent too much unparsed data, dropping it")
+            self.remove_client(client, "inbound_flood")
+            return
+        
+        for msg_type, body in client.frames.frames():
+            if msg_type in protocol.MOVE_DIRECTIONS:
+                self.apply_move(client, protocol.MOVE_DIRECTIONS[msg_type], *protocol.decode_move(body))
+            elif msg_type == protocol.MSG_RESTART:
+                self.apply_restart(client)
+            elif msg_type == protocol.MSG_REQUEST_STATE:
+                # Also sent when the client lost its baseline, so start over from a full snapshot
+                client.acked_seq = None
+                self.send_current_state(client)
+            elif msg_type == protocol.MSG_ACK and len(body) == protocol.ACK_BODY.size:
+                seq = protocol.decode_ack(body)
+                if client.acked_seq is None or seq > client.acked_seq:
+                    client.acked_seq = seq
+                    self.measure_rtt(client, seq)
+            if client.closed:
+                return
+    
+    def measure_rtt(self, client, seq):
+        # Time since the acknowledged snapshot was taken, which includes the client's frame time
+        room = client.room
+        if room.snapshot(seq) is None:
+            return
+        rtt = self.event_time - room.snapshot_times[seq % SNAPSHOT_HISTORY]
+        self.rtt_histogram.observe(rtt)
+        client.rtt = rtt if client.rtt is None else client.rtt + (rtt - client.rtt) * RTT_SMOOTHING
+        client.min_rtt = rtt if client.min_rtt is None else min(client.min_rtt, rtt)
+    
+    def handle_command(self, client, command):
+        if client.protocol is None:
+            client.protocol = protocol.JSON_PROTOCOL
+            if "protocols" in command:
+                # Protocol handshake, answer in JSON and switch after it
+                chosen = protocol.choose_protocol(command["protocols"])
+                self.send_to_client(client, json.dumps({"protocol": chosen}).encode())
+                client.protocol = chosen
+                client.name = results.player_name(command.get("name"), client.address)
+                return
+        
+        if "move" in command:
+            self.apply_move(client, command["move"], command.get("seq"))
+        elif "restart" in command and command["restart"]:
+            self.apply_restart(client)
+        elif "request_state" in command:
+            # Client is requesting game state, send it
+            self.send_current_state(client)
+    
+    def apply_move(self, client, direction, seq=None, view_seq=None):
+        # Queue the move for the next physics step, the client's socket handler never moves paddles itself.
+        # Anything but a known direction is ignored, JSON clients can send any value.
+        if not isinstance(direction, str) or direction not in protocol.MOVE_MESSAGES:
+            return
+        self.input_stats["received"] += 1
+        if client.peer is not None and isinstance(seq, int):
+            if client.last_move_seq is not None and protocol.input_acked(seq, client.last_move_seq):
+                self.input_stats["stale"] += 1
+                return
+            client.last_move_seq = seq
+        if len(client.inputs) == client.inputs.maxlen:
+            self.input_stats["overflow"] += 1
+            client.inputs_dropped += 1
+        client.inputs.append((direction, seq))
+        if view_seq is not None:
+            client.view_seq = view_seq
+        self.input_clients[client] = True
+    
+    def apply_inputs(self):
+        # Once per physics step: each client's queued moves are applied in order, as many as the
+        # token bucket allows, so a paddle moves as far as the client predicted at any physics rate
+        # but flooding can't speed it past MAX_INPUT_RATE. The rest wait for the next step.
+        waiting = {}
+        for client in self.input_clients:
+            if client.closed or not client.inputs:
+                continue
+            room = client.room
+            clock = room.game.clock
+            client.input_tokens = min(self.input_bucket,
+                                      client.input_tokens + (clock - client.input_tokens_clock) * MAX_INPUT_RATE)
+            client.input_tokens_clock = clock
             
-            while True:
-                data = client_socket.recv(1024).decode()
-                if not data:
-                    break
-                
-                try:
-                    command = json.loads(data)
-                    if "move" in command:
-                        self.game.move_paddle(player_number, command["move"])
-                    elif "restart" in command and command["restart"] and self.game.winner:
-                        self.game.restart_game()
-                    elif "request_state" in command:
-                        # Client is requesting game state, send it
-                        try:
-                            state = self.game.get_state()
-                            client_socket.send(json.dumps(state).encode())
-                        except:
-                            pass
-                except json.JSONDecodeError:
-                    print(f"Received invalid JSON: {data}")
-        except:
-            print(f"Error handling client")
-        finally:
-            self.remove_client(client_socket)
+            applied_seq = None
+            while client.inputs and client.input_tokens >= 1:
+                direction, seq = client.inputs.popleft()
+                client.input_tokens -= 1
+                room.move_paddle(client.player_number, direction)
+                self.input_stats["applied"] += 1
+                if isinstance(seq, int):
+                    applied_seq = seq
+                if room.max_rewind and client.view_seq is not None and room.rewind_hit(
+                        client.player_number, client.view_seq, self.physics_dt):
+                    self.rewound_hits += 1
+            
+            # The client's prediction lets go of the moves applied, the waiting ones stay predicted
+            if applied_seq is not None:
+                room.input_seqs[client.player_number] = applied_seq % protocol.INPUT_SEQ_MODULO
+            if client.inputs:
+                self.input_stats["deferred"] += len(client.inputs)
+                client.inputs_deferred += len(client.inputs)
+                waiting[client] = True
+        self.input_clients = waiting
+    
+    def apply_restart(self, client):
+        room = client.room
+        if room.game.winner:
+            room.restart()
+    
+    def send_current_state(self, client):
+        self.encoded.clear()
+        self.encode_offset = 0
+        self.send_to_client(client, self.encode_state(client, client.room, self.encoded))
+    
+    def remove_client(self, client, reason="disconnected", error=None):
+        if client.closed:
+            return
+        client.closed = True
+        self.drop_reasons[reason] += 1
+        self.clients.remove(client)
+        if client.peer is not None:
+            del self.udp_clients[client.address]
+            self.traffic["udp_out"] += client.peer.control_bytes_sent
+        else:
+            try:
+                self.selector.unregister(client.socket)
+            except (KeyError, ValueError):
+                pass
+            try:
+                client.socket.close()
+            except OSError:
+                pass
+        
+        room = client.room
+        room.remove_player(client.player_number)
+        print(f"Client {client.player_number} disconnected from room {room.room_id} ({reason.replace('_', ' ')}"
+              f"{f': {error}' if error else ''})")
+        
+        # Close empty rooms, otherwise offer the free paddle to the next player
+        if room.is_empty():
+            del self.rooms[room.room_id]
+            room.close()
+            if room.broadcast is not None:
+                self.broadcaster.close_stream(room.broadcast)
+            self.engine.remove_game(room.game)
+            self.waiting_rooms.pop(room.room_id, None)
+        else:
+            self.waiting_rooms[room.room_id] = room
+    
+    def collect_metrics(self):
+        # Everything /metrics reports, see metrics.py for the format
+        traffic = dict(self.traffic)
+        traffic["udp_out"] += sum(client.peer.control_bytes_sent for client in self.udp_clients.values())
+        spectators = self.broadcaster
+        traffic["spectator_out"] = spectators.bytes_sent if spectators is not None else 0
+        store = self.results
+        overruns = {"slow_step": self.slow_steps, "dropped_step": self.dropped_steps,
+                    "skipped_snapshot": self.skipped_snapshots}
+        rtts = [client.rtt for client in self.clients if client.rtt is not None]
+        return {
+            "pong_rooms": {"type": "gauge", "help": "Rooms open", "value": len(self.rooms)},
+            "pong_waiting_rooms": {"type": "gauge", "help": "Rooms with a free paddle", "value": len(self.waiting_rooms)},
+            "pong_players": {"type": "gauge", "help": "Players connected", "value": len(self.clients)},
+            "pong_udp_players": {"type": "gauge", "help": "Players connected over UDP", "value": len(self.udp_clients)},
+            "pong_bots": {"type": "gauge", "help": "Paddles played by the server",
+                          "value": sum(len(room.bots) for room in self.rooms.values())},
+            "pong_bot_decisions_total": {"type": "counter", "help": "Bot paddle decisions, one per bot per tick",
+                                         "value": self.ai.decisions},
+            "pong_spectators": {"type": "gauge", "help": "Spectators connected",
+                                "value": len(spectators.viewers) if spectators is not None else 0},
+            "pong_spectators_dropped_total": {"type": "counter", "help": "Spectators dropped for falling behind",
+                                              "value": spectators.dropped if spectators is not None else 0},
+            "pong_spectator_rounds_skipped_total": {"type": "counter",
+                                                    "help": "Spectator rounds skipped while the last was still being sent",
+                                                    "value": self.skipped_broadcasts},
+            "pong_tick_seconds": {"type": "histogram", "help": "Time to run one physics step of every room",
+                                  "value": self.tick_histogram.export()},
+            "pong_send_seconds": {"type": "histogram", "help": "Time to encode and send one snapshot round",
+                                  "value": self.send_histogram.export()},
+            "pong_serialize_seconds": {"type": "histogram", "help": "Time spent encoding states in one snapshot round",
+                                       "value": self.serialize_histogram.export()},
+            "pong_ack_rtt_seconds": {"type": "histogram", "help": "Time from taking a snapshot to its acknowledgement",
+                                     "value": self.rtt_histogram.export()},
+            "pong_client_rtt_seconds": {"type": "histogram", "help": "Smoothed round trip time of connected players",
+                                        "value": metrics.Histogram.of(metrics.RTT_BUCKETS, rtts).export()},
+            "pong_client_queue_depth": {"type": "histogram", "help": "Messages queued for connected players",
+                                        "value": metrics.Histogram.of(metrics.QUEUE_BUCKETS, (
+                                            len(client.outbound) for client in self.clients)).export()},
+            "pong_client_snapshot_rate": {"type": "gauge", "help": "Players by the snapshot rate their link gets",
+                                          "label": "hz", "value": dict(collections.Counter(
+                                              f"{self.client_snapshot_rate(client):.0f}" for client in self.clients))},
+            "pong_snapshot_rate_changes_total": {"type": "counter", "help": "Player snapshot rate changes",
+                                                 "label": "direction", "value": dict(self.rate_changes)},
+            "pong_snapshots_coalesced_total": {"type": "counter",
+                                               "help": "Queued states replaced by a newer one before going out",
+                                               "value": self.snapshots_coalesced},
+            "pong_rewound_hits_total": {"type": "counter",
+                                        "help": "Paddle hits granted by lag compensation",
+                                        "value": self.rewound_hits},
+            "pong_results_written_total": {"type": "counter", "help": "Match results written to the history",
+                                           "value": store.written if store is not None else 0},
+            "pong_results_dropped_total": {"type": "counter", "help": "Match results lost to a full queue or a failed write",
+                                           "value": store.dropped if store is not None else 0},
+            "pong_results_pending": {"type": "gauge", "help": "Match results waiting for the writer",
+                                     "value": store.pending() if store is not None else 0},
+            "pong_clients_removed_total": {"type": "counter", "help": "Players removed, by why", "label": "reason",
+                                           "value": dict(self.drop_reasons)},
+            "pong_bytes_total": {"type": "counter", "help": "Bytes received and sent", "label": "direction",
+                                 "value": traffic},
+            "pong_inputs_total": {"type": "counter", "help": "Paddle moves by what happened to them", "label": "outcome",
+                                  "value": dict(self.input_stats)},
+            "pong_tick_overruns_total": {"type": "counter", "help": "Steps and snapshots that ran late or were dropped",
+                                         "label": "kind", "value": {name: total + overruns[name]
+                                                                    for name, total in self.overrun_totals.items()}},
+            "pong_cpu_seconds_total": {"type": "counter", "help": "CPU time used by the process",
+                                       "value": time.process_time()},
+        }
+    
+    def handle_http(self, path):
+        if path == "/metrics":
+            return metrics.prometheus(self.collect_metrics())
+        if path == "/profile/start":
+            self.profiler.start()
+            return metrics.text("Profiling, fetch /profile/stop for the result\n")
+        if path == "/profile/stop":
+            elapsed = time.monotonic() - self.profiler.started_at
+            profile = self.profiler.stop()
+            if profile:
+                self.profiler.print_summary(elapsed)
+            return metrics.text(profile or "The profiler is not running\n")
+        return metrics.text("Not found\n", 404)
 
 
 if __name__ == "__main__":
-    server = PongServer()
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Pong game server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--max-rooms", type=int, default=MAX_ROOMS)
+    parser.add_argument("--physics-rate", type=int, default=PHYSICS_RATE, help="simulation steps per second")
+    parser.add_argument("--snapshot-rate", type=int, default=SNAPSHOT_RATE, help="states sent to clients per second")
+    parser.add_argument("--engine", choices=sorted(engines.ENGINES), default=PHYSICS_ENGINE, help="physics engine")
+    parser.add_argument("--workers", type=int, default=1, help="processes to spread rooms over, up to one per core")
+    parser.add_argument("--udp", action="store_true", help="also accept clients over UDP on the same port")
+    parser.add_argument("--loss", type=float, default=0.0, help="simulated loss of UDP datagrams sent, 0 to 1")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated delay of UDP datagrams sent, in ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- variation of that delay, in ms")
+    parser.add_argument("--record", metavar="DIR", help="record every match to a replay file in this directory")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics and the profiler over HTTP on this port")
+    parser.add_argument("--metrics-host", default=METRICS_HOST, help="address the metrics endpoint listens on")
+    parser.add_argument("--spectator-port", type=int, help="let spectators watch matches on this port")
+    parser.add_argument("--spectator-rate", type=int, default=broadcast.SPECTATOR_RATE,
+                        help="states sent to spectators per second")
+    parser.add_argument("--bots", type=int, default=0, help="matches played by bots alone, for soak tests")
+    parser.add_argument("--ai-difficulty", choices=sorted(ai.DIFFICULTIES), default=ai.DEFAULT_DIFFICULTY,
+                        help="how well bots play, in bot matches and against a single player")
+    parser.add_argument("--max-rewind", type=float, default=MAX_REWIND * 1000,
+                        help="how far back in ms a paddle hit is judged from what the player saw, 0 to turn it off")
+    parser.add_argument("--results", metavar="FILE", help="keep every finished match in this SQLite database")
+    args = parser.parse_args()
+    
+    if args.workers > 1:
+        if args.spectator_port is not None:
+            parser.error("spectators are only supported with a single worker")
+        import shards
+        server = shards.ShardedServer(args.host, args.port, args.workers, args.max_rooms,
+                                      physics_rate=args.physics_rate, snapshot_rate=args.snapshot_rate,
+                                      engine=args.engine, use_udp=args.udp,
+                                      loss=args.loss, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                                      record_dir=args.record, metrics_host=args.metrics_host,
+                                      metrics_port=args.metrics_port, bot_matches=args.bots,
+                                      ai_difficulty=args.ai_difficulty, max_rewind=args.max_rewind / 1000,
+                                      results_path=args.results)
+    else:
+        server = PongServer(args.host, args.port, args.max_rooms, args.physics_rate, args.snapshot_rate, args.engine,
+                            args.udp, args.loss, args.latency / 1000, args.jitter / 1000, args.record,
+                            args.metrics_host, args.metrics_port, args.spectator_port, args.spectator_rate,
+                            args.bots, args.ai_difficulty, args.max_rewind / 1000, args.results)
+    server.start()
@@ -0,0 +1,283 @@
+import json
+import multiprocessing
+import selectors
+import signal
+import socket
+import time
+
+import metrics
+import server
+
+# Multi-process server for machines with more than one core. One Python process can only use
+# one core, so with --workers N the server starts N worker processes that each run a PongServer
+# over their own shard of rooms. The main process only accepts TCP connections and hands each
+# one to a worker over a Unix socket, picking the worker with a player waiting for an opponent
+# so players are still matched as they connect. UDP clients go to the workers directly: each
+# worker binds the UDP port with SO_REUSEPORT and the kernel spreads clients between them by
+# address, so two UDP players can end up in different workers.
+#
+# The Unix sockets are also the control channel. Workers report their stats and metrics every
+# STATS_INTERVAL seconds and the main process balances on them, prints the totals and serves
+# them added up on its metrics endpoint. Profiler requests to the main process go to every
+# worker, each writes its own profile file when it stops.
+
+STATS_INTERVAL = 1.0
+REPORT_INTERVAL = 5.0
+CONTROL_MESSAGE_SIZE = 65536  # Stats reports carry the worker's metrics
+RECENT_STEPS = 600  # Steps the reported step time percentile covers
+WORKER_STOP_TIMEOUT = 2.0
+
+
+class ShardWorker(server.PongServer):
+    # A PongServer whose clients come over the control socket instead of a listening socket
+    def __init__(self, control_socket, worker_id, **settings):
+        super().__init__(**settings)
+        self.control_socket = control_socket
+        self.worker_id = worker_id
+        self.next_report = 0.0
+
+    def listen(self):
+        self.control_socket.setblocking(False)
+        self.selector.register(self.control_socket, selectors.EVENT_READ, None)
+        if self.udp_socket is not None:
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.bind((self.host, self.port))
+            self.udp_socket.setblocking(False)
+            self.selector.register(self.udp_socket, selectors.EVENT_READ, None)
+        print(f"Worker {self.worker_id} started")
+
+    def accept_clients(self):
+        # Connections the main process accepted, one per message along with the client's address
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(self.control_socket, CONTROL_MESSAGE_SIZE, 1)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data, fds = b"", []
+            if not data and not fds:
+                self.stop()  # The main process is gone
+                return
+            message = json.loads(data)
+            if message.get("profile") == "start":
+                self.profiler.start()
+            elif message.get("profile") == "stop" and self.profiler.running:
+                self.profiler.toggle()
+            for fd in fds:
+                self.add_client(socket.socket(fileno=fd), tuple(message["address"]))
+
+    def send_snapshots(self):
+        super().send_snapshots()
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + STATS_INTERVAL
+            self.report_stats()
+
+    def report_stats(self):
+        recent = sorted(self.step_times[-index] for index in range(1, min(RECENT_STEPS, len(self.step_times)) + 1))
+        stats = {
+            "worker": self.worker_id,
+            "clients": len(self.clients),
+            "rooms": len(self.rooms),
+            "waiting_rooms": len(self.waiting_rooms),
+            "step_p99": recent[int(len(recent) * 0.99)] if recent else 0.0,
+            "cpu_seconds": time.process_time(),
+            "inputs": self.input_stats,
+            "metrics": self.collect_metrics(),
+        }
+        try:
+            self.control_socket.send(json.dumps(stats).encode())
+        except (BlockingIOError, InterruptedError):
+            pass  # The main process is busy, the next report will do
+        except OSError:
+            self.stop()
+
+
+def run_worker(control_socket, worker_id, settings):
+    ShardWorker(control_socket, worker_id, **settings).start()
+
+
+class WorkerHandle:
+    # The main process's view of a worker, as of its last report plus the clients handed over since
+    def __init__(self, worker_id, process, control_socket):
+        self.worker_id = worker_id
+        self.process = process
+        self.control_socket = control_socket
+        self.stats = {}
+        self.clients = 0
+        self.waiting_rooms = 0
+
+
+class ShardedServer:
+    def __init__(self, host='0.0.0.0', port=5555, workers=2, max_rooms=server.MAX_ROOMS,
+                 metrics_host=server.METRICS_HOST, metrics_port=None, **settings):
+        if not hasattr(socket, "send_fds") or not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Running several workers needs a Unix system")
+        self.host = host
+        self.port = port
+        self.worker_count = workers
+        self.settings = dict(settings, host=host, port=port, max_rooms=max(1, max_rooms // workers))
+        self.bot_matches = settings.get("bot_matches", 0)  # Shared out between the workers
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.selector = selectors.DefaultSelector()
+        self.workers = []
+        self.running = False
+        self.last_cpu_seconds = 0.0
+        self.metrics_address = (metrics_host, metrics_port) if metrics_port is not None else None
+        self.metrics_endpoint = None
+        self.profiling = False
+
+    def start(self):
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(server.LISTEN_BACKLOG)
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+
+        # Spawned rather than forked, so workers don't inherit the listener or each other's sockets
+        context = multiprocessing.get_context("spawn")
+        for worker_id in range(1, self.worker_count + 1):
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            settings = dict(self.settings, bot_matches=(self.bot_matches + self.worker_count - worker_id) // self.worker_count)
+            process = context.Process(target=run_worker, args=(child_end, worker_id, settings), daemon=True)
+            process.start()
+            child_end.close()
+            parent_end.setblocking(False)
+            worker = WorkerHandle(worker_id, process, parent_end)
+            self.workers.append(worker)
+            self.selector.register(parent_end, selectors.EVENT_READ, worker)
+        print(f"Server started on {self.host}:{self.port} with {self.worker_count} workers")
+        if self.metrics_address is not None:
+            self.metrics_endpoint = metrics.HttpEndpoint(*self.metrics_address, self.selector, self.handle_http)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.profile_workers(not self.profiling))
+
+        self.running = True
+        try:
+            self.run_loop()
+        except KeyboardInterrupt:
+            print("Server shutting down...")
+        finally:
+            # Workers stop when their control socket closes
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.close()
+            for worker in self.workers:
+                worker.control_socket.close()
+            for worker in self.workers:
+                worker.process.join(WORKER_STOP_TIMEOUT)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+            self.selector.close()
+            self.server_socket.close()
+
+    def stop(self):
+        self.running = False
+
+    def run_loop(self):
+        last_report = time.monotonic()
+        while self.running and self.workers:
+            for key, events in self.selector.select(REPORT_INTERVAL):
+                if key.data is None:
+                    self.accept_clients()
+                elif callable(key.data):
+                    key.data(events)  # The metrics endpoint
+                else:
+                    self.read_worker(key.data)
+
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL:
+                self.print_stats(now - last_report)
+                last_report = now
+
+    def accept_clients(self):
+        while True:
+            try:
+                client_socket, client_address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Error accepting client: {e}")
+                return
+
+            worker = self.pick_worker()
+            try:
+                socket.send_fds(worker.control_socket, [json.dumps({"address": client_address}).encode()],
+                                [client_socket.fileno()])
+            except OSError as e:
+                print(f"Error handing client {client_address} to worker {worker.worker_id}: {e}")
+            client_socket.close()  # The worker has its own copy now
+
+    def pick_worker(self):
+        # A worker with a player waiting for an opponent, so they get matched, otherwise the least loaded one
+        worker = next((worker for worker in self.workers if worker.waiting_rooms > 0), None)
+        if worker is not None:
+            worker.waiting_rooms -= 1
+        else:
+            worker = min(self.workers, key=lambda worker: worker.clients)
+            worker.waiting_rooms += 1
+        worker.clients += 1
+        return worker
+
+    def read_worker(self, worker):
+        while True:
+            try:
+                data = worker.control_socket.recv(CONTROL_MESSAGE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                data = b""
+            if not data:
+                print(f"Worker {worker.worker_id} stopped, its clients are gone")
+                self.selector.unregister(worker.control_socket)
+                worker.control_socket.close()
+                self.workers.remove(worker)
+                return
+            worker.stats = json.loads(data)
+            worker.clients = worker.stats["clients"]
+            worker.waiting_rooms = worker.stats["waiting_rooms"]
+
+    def aggregate_stats(self):
+        # Totals over all workers from their latest reports
+        reports = [worker.stats for worker in self.workers if worker.stats]
+        inputs = {}
+        for report in reports:
+            for name, count in report["inputs"].items():
+                inputs[name] = inputs.get(name, 0) + count
+        return {
+            "workers": len(self.workers),
+            "clients": sum(report["clients"] for report in reports),
+            "rooms": sum(report["rooms"] for report in reports),
+            "step_p99": max((report["step_p99"] for report in reports), default=0.0),
+            "cpu_seconds": sum(report["cpu_seconds"] for report in reports),
+            "inputs": inputs,
+        }
+
+    def profile_workers(self, start):
+        self.profiling = start
+        message = json.dumps({"profile": "start" if start else "stop"}).encode()
+        for worker in self.workers:
+            try:
+                worker.control_socket.send(message)
+            except OSError as e:
+                print(f"Error sending profiler request to worker {worker.worker_id}: {e}")
+
+    def handle_http(self, path):
+        if path == "/metrics":
+            merged = metrics.merge_metrics(worker.stats["metrics"] for worker in self.workers if worker.stats)
+            merged["pong_workers"] = {"type": "gauge", "help": "Worker processes running", "value": len(self.workers)}
+            return metrics.prometheus(merged)
+        if path in ("/profile/start", "/profile/stop"):
+            self.profile_workers(path == "/profile/start")
+            pids = ", ".join(str(worker.process.pid) for worker in self.workers)
+            if self.profiling:
+                return metrics.text(f"Profiling workers {pids}, fetch /profile/stop to write their profiles\n")
+            return metrics.text(f"Workers {pids} write their profiles to profile-<pid>-<time>.txt\n")
+        return metrics.text("Not found\n", 404)
+
+    def print_stats(self, elapsed):
+        stats = self.aggregate_stats()
+        cpu = max(0.0, stats["cpu_seconds"] - self.last_cpu_seconds) / elapsed
+        self.last_cpu_seconds = stats["cpu_seconds"]
+        if stats["clients"]:
+            print(f"All workers: {stats['clients']} client(s) in {stats['rooms']} room(s) over {stats['workers']} worker(s), "
+                  f"worst step p99 {stats['step_p99'] * 1000:.2f} ms, {cpu * 100:.0f}% CPU")
@@ -0,0 +1,162 @@
+import math
+import random
+
+import pytest
+
+import engines
+import protocol
+from game import (PongGame, WINDOW_WIDTH, WINDOW_HEIGHT, PADDLE_WIDTH, PADDLE_HEIGHT, BALL_SIZE, BALL_SPEED,
+                  BALL_MAX_Y, BALL_RIGHT_CONTACT_X, TICK_RATE)
+
+# Property tests of the swept ball step (PongGame.update) on seeded random rallies, up to balls
+# far faster than a paddle is wide per tick, at physics rates from 120 Hz down to 20 Hz.
+
+CASES = 300
+MAX_SPEED = 200  # Pixels per tick of the fastest ball
+STEP_LENGTHS = (1 / 120, 1 / 60, 1 / 30, 1 / 20)
+SUBSTEP = 0.05  # Pixels the reference moves the ball at most between checks
+TOLERANCE = 0.25  # Pixels, or pixels per tick, the swept step may differ from the reference by
+
+
+def random_rally(rng):
+    # An active game mid-rally: ball anywhere on the court between the paddle faces, any speed
+    game = PongGame(rng.getrandbits(32))
+    game.game_active = True
+    game.countdown_timer = None
+    game.ball_x = rng.uniform(PADDLE_WIDTH, BALL_RIGHT_CONTACT_X)
+    game.ball_y = rng.uniform(0, BALL_MAX_Y)
+    game.ball_velocity_x = rng.choice([-1, 1]) * rng.uniform(1, MAX_SPEED)
+    game.ball_velocity_y = rng.uniform(-MAX_SPEED / 2, MAX_SPEED / 2)
+    game.player1_y = rng.uniform(0, WINDOW_HEIGHT - PADDLE_HEIGHT)
+    game.player2_y = rng.uniform(0, WINDOW_HEIGHT - PADDLE_HEIGHT)
+    return game
+
+
+def rally_cases(seed):
+    rng = random.Random(seed)
+    return [(random_rally(rng), rng.choice(STEP_LENGTHS)) for _ in range(CASES)]
+
+
+def copy_rally(source, game=None):
+    game = game if game is not None else PongGame(source.seed)
+    for name in ("ball_x", "ball_y", "ball_velocity_x", "ball_velocity_y", "player1_y", "player2_y",
+                 "game_active", "countdown_timer", "clock", "rng_state"):
+        setattr(game, name, getattr(source, name))
+    return game
+
+
+def ball(game):
+    return game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y
+
+
+def fine_substeps(game, dt):
+    # Reference: the ball moved in substeps of at most SUBSTEP pixels, bouncing whenever a
+    # substep ends past a wall or a paddle face it was moving towards. No scoring.
+    x, y, velocity_x, velocity_y = ball(game)
+    substeps = max(1, math.ceil(math.hypot(velocity_x, velocity_y) * 1.1 ** 8 * dt / TICK_RATE / SUBSTEP))
+    scale = dt / TICK_RATE / substeps
+    passed_left = passed_right = False
+    for _ in range(substeps):
+        x += velocity_x * scale
+        y += velocity_y * scale
+        if y < 0 and velocity_y < 0:
+            y, velocity_y = 0.0, -velocity_y
+        elif y > BALL_MAX_Y and velocity_y > 0:
+            y, velocity_y = BALL_MAX_Y, -velocity_y
+        for paddle_y, face_x, moving, passed in ((game.player1_y, PADDLE_WIDTH, velocity_x < 0 and x < PADDLE_WIDTH,
+                                                  passed_left),
+                                                 (game.player2_y, BALL_RIGHT_CONTACT_X,
+                                                  velocity_x > 0 and x > BALL_RIGHT_CONTACT_X, passed_right)):
+            if not moving or passed:
+                continue
+            if y + BALL_SIZE >= paddle_y and y <= paddle_y + PADDLE_HEIGHT:
+                x = face_x
+                velocity_x *= -1.1
+                velocity_y = BALL_SPEED * (y + BALL_SIZE // 2 - (paddle_y + PADDLE_HEIGHT // 2)) / (PADDLE_HEIGHT // 2)
+            elif face_x == PADDLE_WIDTH:
+                passed_left = True
+            else:
+                passed_right = True
+    return x, y, velocity_x, velocity_y
+
+
+def discrete_update(game, dt):
+    # The physics before swept collisions: jump the ball, then check for overlaps
+    scale = dt / TICK_RATE
+    game.ball_x += game.ball_velocity_x * scale
+    game.ball_y += game.ball_velocity_y * scale
+    if game.ball_y <= 0 or game.ball_y >= WINDOW_HEIGHT - BALL_SIZE:
+        game.ball_velocity_y *= -1
+    for paddle_y, hit_x in ((game.player1_y, game.ball_x <= PADDLE_WIDTH),
+                            (game.player2_y, game.ball_x >= WINDOW_WIDTH - PADDLE_WIDTH - BALL_SIZE)):
+        if hit_x and game.ball_y + BALL_SIZE >= paddle_y and game.ball_y <= paddle_y + PADDLE_HEIGHT:
+            game.ball_velocity_x *= -1.1
+            game.ball_velocity_y = BALL_SPEED * (game.ball_y + BALL_SIZE // 2 - (paddle_y + PADDLE_HEIGHT // 2)) / (PADDLE_HEIGHT // 2)
+
+
+def scored(game):
+    return game.score_player1 + game.score_player2 > 0
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_swept_step_matches_fine_substeps(seed):
+    for index, (rally, dt) in enumerate(rally_cases(seed)):
+        expected = fine_substeps(rally, dt)
+        game = copy_rally(rally)
+        game.update(dt)
+        if scored(game):
+            # The reference doesn't score, it has to end off the court on the side that conceded
+            assert (expected[0] < 0) == (game.score_player2 > 0), f"case {index}"
+            assert (expected[0] > WINDOW_WIDTH) == (game.score_player1 > 0), f"case {index}"
+        else:
+            assert max(abs(a - b) for a, b in zip(ball(game), expected)) <= TOLERANCE, f"case {index}"
+            assert 0 <= game.ball_y <= BALL_MAX_Y, f"case {index}"
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_shorter_steps_end_in_the_same_place(seed):
+    # A lower physics rate plays the same: one step lands where several shorter ones do
+    rng = random.Random(seed)
+    for index, (rally, dt) in enumerate(rally_cases(seed)):
+        whole = copy_rally(rally)
+        whole.update(dt)
+        split = copy_rally(rally)
+        pieces = rng.randint(2, 8)
+        for _ in range(pieces):
+            split.update(dt / pieces)
+        assert (split.score_player1, split.score_player2) == (whole.score_player1, whole.score_player2), f"case {index}"
+        if not scored(whole):
+            assert max(abs(a - b) for a, b in zip(ball(split), ball(whole))) <= 1e-6, f"case {index}"
+
+
+def test_reference_catches_the_old_discrete_step():
+    # The reference is sharp enough to tell: the overlap checks the swept step replaced tunnel
+    # through paddles and walls on fast balls
+    differing = 0
+    for rally, dt in rally_cases(1):
+        expected = fine_substeps(rally, dt)
+        old = copy_rally(rally)
+        discrete_update(old, dt)
+        if max(abs(a - b) for a, b in zip(ball(old), expected)) > TOLERANCE:
+            differing += 1
+    assert differing > CASES // 20
+
+
+def test_numpy_engine_matches_scalar():
+    # Fast balls included, the batched engine has to agree with PongGame bit for bit
+    pytest.importorskip("numpy")
+    engine = engines.create_engine("numpy")
+    cases = rally_cases(4)
+    for dt in STEP_LENGTHS:
+        rallies = [rally for rally, case_dt in cases if case_dt == dt]
+        scalar_games = [copy_rally(rally) for rally in rallies]
+        numpy_games = [copy_rally(rally, engine.new_game(rally.seed)) for rally in rallies]
+        for _ in range(3):
+            engine.step(dt)
+            for scalar_game in scalar_games:
+                scalar_game.step(dt)
+        for index, (scalar_game, numpy_game) in enumerate(zip(scalar_games, numpy_games)):
+            assert protocol.state_values(scalar_game) + ball(scalar_game)[2:] == \
+                protocol.state_values(numpy_game) + ball(numpy_game)[2:], f"{dt:.4f} s step, rally {index}"
+        for numpy_game in numpy_games:
+            engine.remove_game(numpy_game)
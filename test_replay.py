@@ -0,0 +1,85 @@
+import random
+
+import pytest
+
+import engines
+import replay
+from server import Room, TICK_RATE
+
+STEPS = 3000  # 50 s of play, five keyframes
+SEEK_TICKS = (0, 1, 599, 600, 1234, 2999, STEPS)
+
+
+def record_match(path, engine_name, seed):
+    # A seeded match recorded the way the server records it, with both paddles moving at random.
+    # Returns the live game's packed state as of each of SEEK_TICKS, the moves made after that
+    # step included as seek() includes them, and the file offsets of a few steps' checksums.
+    if engine_name == "numpy":
+        pytest.importorskip("numpy")
+    engine = engines.create_engine(engine_name)
+    game = engine.new_game(seed)
+    recorder = replay.ReplayWriter(path, game, TICK_RATE)
+    room = Room(1, game, recorder)
+    room.start_countdown(0)
+    moves = random.Random(seed)
+    states = {}
+    checksum_offsets = {}
+    for tick in range(STEPS):
+        for player in (1, 2):
+            if moves.random() < 0.4:
+                room.move_paddle(player, moves.choice(("up", "down")))
+        if tick in SEEK_TICKS:
+            states[tick] = replay.pack_state(game)
+        engine.step(TICK_RATE)
+        recorder.step()
+        if (tick + 1) % 500 == 0:
+            checksum_offsets[tick + 1] = recorder.file.tell() + len(recorder.buffer) - replay.CHECKSUM.size
+        if game.winner:
+            room.restart()
+            room.start_countdown(0)
+    states[STEPS] = replay.pack_state(game)
+    room.close()
+    return states, checksum_offsets
+
+
+@pytest.mark.parametrize("engine_name", ["scalar", "numpy"])
+def test_replay_verifies_and_seeks(tmp_path, engine_name):
+    path = tmp_path / "match.pongreplay"
+    states, _ = record_match(path, engine_name, 42)
+    recording = replay.Replay(path)
+    assert recording.complete
+    assert recording.ticks == STEPS
+    assert replay.pack_state(recording.play()) == states[STEPS]
+    for tick in SEEK_TICKS:
+        assert replay.pack_state(recording.seek(tick)) == states[tick], f"seek to step {tick}"
+
+
+def test_changed_byte_fails_verification(tmp_path):
+    path = tmp_path / "match.pongreplay"
+    _, checksum_offsets = record_match(path, "scalar", 7)
+    data = bytearray(path.read_bytes())
+    data[checksum_offsets[1500]] ^= 0x01
+    path.write_bytes(data)
+
+    recording = replay.Replay(path)
+    recording.seek(1499)  # Before the change, still fine
+    with pytest.raises(replay.ReplayMismatch, match="after step 1500"):
+        recording.play()
+    with pytest.raises(replay.ReplayMismatch, match="after step 1500"):
+        recording.seek(1600)
+    recording.play(verify=False)  # Only the checksum changed, the moves are all there
+
+
+def test_recording_cut_short_replays_up_to_its_end(tmp_path):
+    # A server that died mid-match leaves no END and maybe half an operation, what is there still plays
+    path = tmp_path / "match.pongreplay"
+    states, _ = record_match(path, "scalar", 11)
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2 - 1])
+
+    recording = replay.Replay(path)
+    assert not recording.complete
+    assert 0 < recording.ticks < STEPS
+    game = recording.play()
+    assert game.clock == pytest.approx(recording.ticks * TICK_RATE)
+    assert replay.pack_state(recording.seek(600)) == states[600]
@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+import threading
+
+import pytest
+
+import results
+
+MATCHES = [
+    # finished at, duration, player 1, player 2, score 1, score 2, winner, replay
+    (1000.0, 90.0, "ann", "bob", 5, 3, 1, "1.pongreplay"),
+    (1001.0, 120.0, "bob", "cy", 5, 4, 1, None),
+    (1002.0, 60.0, "cy", "ann", 2, 5, 2, None),
+    (1003.0, 75.0, "ann", "bob", 4, 5, 2, "4.pongreplay"),
+    (1004.0, 80.0, "dee", "ann", 5, 1, 1, None),
+]
+
+
+def store_matches(path, matches, batch_size=2):
+    # Through the writer thread, in batches of batch_size
+    store = results.ResultStore(str(path), batch_size=batch_size, flush_interval=0.01)
+    for match in matches:
+        store.record(*match)
+    store.close()
+    assert store.written == len(matches)
+    assert store.dropped == 0
+    return store
+
+
+def test_totals_and_leaderboard(tmp_path):
+    path = tmp_path / "matches.db"
+    store_matches(path, MATCHES[:3])
+    store_matches(path, MATCHES[3:])  # A second server run adds to the same totals
+    connection = results.connect(str(path))
+    assert results.player_stats(connection, "ann") == {"name": "ann", "played": 4, "won": 2, "points": 15, "conceded": 15}
+    assert results.player_stats(connection, "bob") == {"name": "bob", "played": 3, "won": 2, "points": 13, "conceded": 13}
+    assert results.player_stats(connection, "nobody")["played"] == 0
+    assert [stats["name"] for stats in results.leaderboard(connection, 3)] == ["bob", "ann", "dee"]
+    assert [match["id"] for match in results.recent_matches(connection, "cy")] == [3, 2]
+    connection.close()
+
+
+def test_export_after_id(tmp_path):
+    path = tmp_path / "matches.db"
+    store_matches(path, MATCHES)
+    connection = results.connect(str(path))
+
+    out = io.StringIO()
+    assert results.export(connection, out, "jsonl", after_id=3) == 2
+    rows = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [row["id"] for row in rows] == [4, 5]
+    assert rows[0] == dict(zip(results.MATCH_COLUMNS, (4,) + MATCHES[3]))
+
+    out = io.StringIO()
+    assert results.export(connection, out, "csv") == len(MATCHES)
+    table = list(csv.reader(io.StringIO(out.getvalue())))
+    assert table[0] == list(results.MATCH_COLUMNS)
+    assert [row[3:5] for row in table[1:]] == [[match[2], match[3]] for match in MATCHES]
+
+    assert results.export(connection, io.StringIO(), "jsonl", after_id=len(MATCHES)) == 0
+    connection.close()
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_close_returns_when_the_writer_died(tmp_path, monkeypatch):
+    def broken(connection, batch):
+        raise RuntimeError("writer bug")
+    monkeypatch.setattr(results, "write_results", broken)
+    monkeypatch.setattr(results, "MAX_PENDING", 2)
+    store = results.ResultStore(str(tmp_path / "matches.db"), batch_size=1, flush_interval=0.01)
+    store.record(*MATCHES[0])
+    store.thread.join(5)
+    assert not store.thread.is_alive()
+    for match in MATCHES:
+        store.record(*match)  # Fills the queue nobody takes from any more
+    assert store.dropped == len(MATCHES) - 2
+
+    closing = threading.Thread(target=store.close, daemon=True)
+    closing.start()
+    closing.join(5)
+    assert not closing.is_alive()
@@ -0,0 +1,160 @@
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import bench
+import protocol
+import server
+from game import PADDLE_HEIGHT, TICK_RATE
+
+CLIENT_TIMEOUT = 2.0
+
+
+@pytest.fixture
+def running_server():
+    # A server on a free port, run by its own loop in a thread like `python server.py`
+    game_server = server.PongServer("127.0.0.1", 0)
+    thread = threading.Thread(target=game_server.start, daemon=True)
+    thread.start()
+    while not game_server.running:
+        time.sleep(0.01)
+    yield game_server
+    game_server.stop()
+    thread.join(CLIENT_TIMEOUT)
+
+
+def join(game_server):
+    # A raw JSON client, past the server's greeting
+    sock = socket.create_connection(game_server.server_socket.getsockname(), CLIENT_TIMEOUT)
+    greeting, _ = json.JSONDecoder().raw_decode(sock.recv(4096).decode())
+    assert "player_number" in greeting
+    return sock
+
+
+def closed_by_server(sock):
+    try:
+        while sock.recv(4096):
+            pass
+    except ConnectionResetError:
+        pass
+    return True
+
+
+def still_serving(game_server, sock):
+    # The loop is alive and still sends this client its states
+    sock.send(json.dumps({"request_state": True}).encode())
+    return game_server.running and b"ball" in sock.recv(4096)
+
+
+def test_failing_client_is_dropped_alone(running_server, monkeypatch):
+    def broken(client):
+        raise RuntimeError("broken handler")
+    monkeypatch.setattr(running_server, "apply_restart", broken)
+    first, second = join(running_server), join(running_server)
+    first.send(json.dumps({"restart": True}).encode())
+    assert closed_by_server(first)
+    assert running_server.drop_reasons["bad_message"] == 1
+    assert still_serving(running_server, second)
+    second.close()
+
+
+@pytest.mark.parametrize("offered, chosen", [(5, "json"), (None, "json"), ("bin3", "json"), ({"bin3": 1}, "json"),
+                                             ([[], {}, 7, "bin3"], "bin3"), (["carrier pigeon"], "json")])
+def test_malformed_protocol_offer_falls_back_to_json(running_server, offered, chosen):
+    player = join(running_server)
+    player.send(json.dumps({"protocols": offered}).encode())
+    reply, _ = json.JSONDecoder().raw_decode(player.recv(4096).decode("latin-1"))
+    assert reply == {"protocol": chosen}
+    if chosen == "json":
+        assert still_serving(running_server, player)
+    assert running_server.drop_reasons["bad_message"] == 0
+    player.close()
+
+
+@pytest.mark.parametrize("move", [[], {}, 5, None, "sideways"])
+def test_malformed_move_is_ignored(running_server, move):
+    player = join(running_server)
+    player.send(json.dumps({"move": move}).encode())
+    player.send(json.dumps({"move": "up", "seq": 1}).encode())
+    assert still_serving(running_server, player)
+    assert running_server.drop_reasons["bad_message"] == 0
+    assert running_server.input_stats["received"] == 1
+    player.close()
+
+
+def missed_ball(max_rewind, steps_after=3):
+    # Player 1's paddle is at the top while the ball comes in level at the middle, it gets past
+    # and scores. Returns the room and the last snapshot from before it reached the paddle.
+    game = server.PongGame(1)
+    game.game_active = True
+    game.countdown_timer = None
+    room = server.Room(1, game, max_rewind=max_rewind)
+    game.ball_x, game.ball_y, game.ball_velocity_x, game.ball_velocity_y = 200.0, 300.0, -12.0, 0.0
+    game.player1_y = 0
+    while room.miss_seqs[1] == server.NO_MISS:
+        game.step(TICK_RATE)
+        room.record_snapshot()
+    view_seq = room.miss_seqs[1]
+    for _ in range(steps_after):
+        game.step(TICK_RATE)
+        room.record_snapshot()
+    assert game.score_player2 == 1
+    return room, view_seq
+
+
+def max_rewind_rounds():
+    return round(server.MAX_REWIND / TICK_RATE)
+
+
+def test_late_hit_inside_the_window_is_granted():
+    room, view_seq = missed_ball(max_rewind_rounds())
+    game = room.game
+    game.player1_y = 300 - PADDLE_HEIGHT // 2  # Where the late move put the paddle, in front of the ball
+    assert room.rewind_hit(1, view_seq, TICK_RATE)
+    assert game.score_player2 == 0  # The point is taken back
+    assert game.ball_velocity_x > 0 and game.game_active
+    assert not room.rewind_hit(1, view_seq, TICK_RATE)  # Once only
+
+
+def test_view_older_than_the_window_is_refused():
+    rounds = max_rewind_rounds()
+    room, view_seq = missed_ball(rounds, steps_after=rounds + 1)
+    game = room.game
+    game.player1_y = 300 - PADDLE_HEIGHT // 2
+    assert room.snapshot_seq - view_seq > rounds
+    assert not room.rewind_hit(1, view_seq, TICK_RATE)
+    assert not room.rewind_hit(1, room.snapshot_seq - server.SNAPSHOT_HISTORY - 1, TICK_RATE)
+    assert game.score_player2 == 1
+
+
+def test_miss_at_the_rewound_position_is_still_a_miss():
+    room, view_seq = missed_ball(max_rewind_rounds())
+    game = room.game
+    game.player1_y = 300 + PADDLE_HEIGHT  # Moved, but the wrong way
+    assert not room.rewind_hit(1, view_seq, TICK_RATE)
+    assert game.score_player2 == 1
+
+
+def test_window_covers_the_supported_round_trips():
+    # Lagged players who see the ball the interpolation delay late (bench.py lag), at the largest
+    # round trip the window is meant for: rewinding has to win back hits they made on screen
+    delay = round(server.MAX_COMPENSATED_RTT / TICK_RATE)
+    hits, misses, _ = bench.play_lag_match(1, delay, 0, 120 * 60)
+    compensated_hits, compensated_misses, granted = bench.play_lag_match(1, delay, max_rewind_rounds(), 120 * 60)
+    assert granted > 0
+    assert compensated_misses / (compensated_hits + compensated_misses) < misses / (hits + misses) / 2
+
+
+@pytest.mark.parametrize("engine", ["scalar", "numpy"])
+@pytest.mark.parametrize("protocol_name", protocol.SUPPORTED_PROTOCOLS)
+def test_steady_ticks_keep_no_memory(engine, protocol_name):
+    # What `python bench.py allocations` reports: once warmed up, ticks only replace per-room
+    # state (a ball velocity, a cached delta layout) and keep nothing that grows with them
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+    rooms = 20
+    retained, _, growth = bench.measure_allocations(rooms, 300, 300, protocol_name, engine)
+    assert retained < 1024 + 16 * rooms, [str(stat) for stat in growth[:5]]
@@ -0,0 +1,186 @@
+import heapq
+import json
+import random
+import struct
+import time
+
+# UDP transport, used by server.py and client.py when started with --udp.
+#
+# Every datagram starts with a packet type byte:
+#
+# PACKET_STATE is unreliable and carries binary protocol frames: snapshots and deltas from the
+# server, moves and snapshot acks from the client. Nothing is resent. Snapshots are numbered,
+# so the client applies only those newer than the last one it applied and drops the rest, and
+# a lost one never holds back the fresher ones behind it the way it does on TCP. Deltas are
+# against a snapshot the client acknowledged, so losing one doesn't break the ones after it.
+#
+# PACKET_RELIABLE carries one JSON control message: joining, leaving, restarts and the score
+# and winner events. Each has a sequence number and is resent until the other side
+# acknowledges it, and the receiver delivers them in order, each once.
+#
+# PACKET_ACK carries only the acknowledgement, when there is no reliable message to carry it.
+
+PACKET_STATE = 0x01
+PACKET_RELIABLE = 0x02
+PACKET_ACK = 0x03
+RELIABLE_HEADER = struct.Struct("!BHH")  # Packet type, sequence number, newest sequence number received in order
+SEQ_MODULO = 1 << 16
+
+MAX_DATAGRAM = 1400  # Stays under a typical MTU
+RESEND_INTERVAL = 0.1  # Seconds before an unacknowledged reliable message is sent again
+MAX_UNACKED = 256  # Reliable messages in flight before the other side counts as gone
+MAX_EARLY_MESSAGES = 256  # Reliable messages kept while waiting for a missing earlier one
+PEER_TIMEOUT = 5.0  # Seconds without any packet before the other side counts as gone
+
+
+def seq_newer(seq, other):
+    # True when seq comes after other, allowing for the 16-bit counter wrapping around
+    return 0 < (seq - other) % SEQ_MODULO < SEQ_MODULO // 2
+
+
+class ReliableChannel:
+    def __init__(self):
+        self.next_seq = 1
+        self.unacked = {}  # [payload, last send time] indexed by sequence number, oldest first
+        self.received_seq = 0  # Newest sequence number delivered, everything before it was too
+        self.early = {}  # Payloads received ahead of a missing one, indexed by sequence number
+        self.resends = 0
+
+    def packet(self, seq, payload):
+        # The acknowledgement is filled in at send time so resends carry the current one
+        return RELIABLE_HEADER.pack(PACKET_RELIABLE, seq, self.received_seq) + payload
+
+    def send(self, payload, now):
+        seq = self.next_seq
+        self.next_seq = (self.next_seq + 1) % SEQ_MODULO
+        self.unacked[seq] = [payload, now]
+        return self.packet(seq, payload)
+
+    def on_ack(self, ack):
+        for seq in [seq for seq in self.unacked if not seq_newer(seq, ack)]:
+            del self.unacked[seq]
+
+    def on_message(self, seq, payload):
+        # Returns the payloads now deliverable in order, none for duplicates or early arrivals
+        if not seq_newer(seq, self.received_seq):
+            return []
+        if seq != (self.received_seq + 1) % SEQ_MODULO:
+            if len(self.early) < MAX_EARLY_MESSAGES:
+                self.early[seq] = payload
+            return []
+        delivered = [payload]
+        self.received_seq = seq
+        while (self.received_seq + 1) % SEQ_MODULO in self.early:
+            self.received_seq = (self.received_seq + 1) % SEQ_MODULO
+            delivered.append(self.early.pop(self.received_seq))
+        return delivered
+
+    def due(self, now):
+        # Packets to send again because their acknowledgement hasn't come back in time
+        packets = []
+        for seq, entry in self.unacked.items():
+            if now - entry[1] >= RESEND_INTERVAL:
+                entry[1] = now
+                packets.append(self.packet(seq, entry[0]))
+        self.resends += len(packets)
+        return packets
+
+
+class Peer:
+    # The other end of a UDP conversation. The server keeps one per client, all sharing its socket.
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.channel = ReliableChannel()
+        self.last_heard = time.monotonic()
+        self.ack_due = False  # A reliable message arrived and its acknowledgement hasn't gone out yet
+        self.control_bytes_sent = 0  # Reliable messages, resends and acknowledgements, for the server's metrics
+
+    def send(self, packet):
+        try:
+            self.socket.sendto(packet, self.address)
+        except OSError:
+            pass  # A full socket buffer or an unreachable peer, the same as a lost datagram
+
+    def send_state(self, frames):
+        self.send(bytes((PACKET_STATE,)) + frames)
+
+    def send_control(self, packet):
+        self.control_bytes_sent += len(packet)
+        self.send(packet)
+
+    def send_reliable(self, message):
+        self.send_control(self.channel.send(json.dumps(message).encode(), time.monotonic()))
+
+    def receive(self, packet):
+        # Returns (state frames or None, control messages delivered in order)
+        self.last_heard = time.monotonic()
+        if not packet:
+            return None, []
+        if packet[0] == PACKET_STATE:
+            return packet[1:], []
+        if len(packet) < RELIABLE_HEADER.size:
+            return None, []
+        packet_type, seq, ack = RELIABLE_HEADER.unpack_from(packet)
+        self.channel.on_ack(ack)
+        if packet_type != PACKET_RELIABLE:
+            return None, []
+        self.ack_due = True
+        messages = []
+        for payload in self.channel.on_message(seq, packet[RELIABLE_HEADER.size:]):
+            try:
+                messages.append(json.loads(payload))
+            except ValueError:
+                print(f"Received invalid control message from {self.address}")
+        return None, messages
+
+    def service(self, now):
+        # Resend what is overdue and acknowledge what arrived, returns False once the peer looks gone
+        for packet in self.channel.due(now):
+            self.send_control(packet)
+        if self.ack_due:
+            self.ack_due = False
+            self.send_control(RELIABLE_HEADER.pack(PACKET_ACK, 0, self.channel.received_seq))
+        return now - self.last_heard < PEER_TIMEOUT and len(self.channel.unacked) < MAX_UNACKED
+
+
+class LossySocket:
+    # Wraps a UDP socket to simulate a bad network on its sending side: each datagram is lost with
+    # probability loss and the rest go out latency +/- jitter seconds late, which reorders some of
+    # them. Delayed datagrams leave on the next sendto or flush, so callers flush regularly and
+    # wake up by next_due(). Everything else is passed through to the socket.
+    def __init__(self, sock, loss=0.0, latency=0.0, jitter=0.0, seed=None):
+        self.socket = sock
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.queue = []  # (due time, order, data, address) heap
+        self.order = 0  # Keeps datagrams due at the same time in send order
+        self.lost = 0
+
+    def sendto(self, data, address):
+        if self.random.random() < self.loss:
+            self.lost += 1
+            return len(data)
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        heapq.heappush(self.queue, (time.monotonic() + delay, self.order, data, address))
+        self.order += 1
+        self.flush()
+        return len(data)
+
+    def flush(self):
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, data, address = heapq.heappop(self.queue)
+            try:
+                self.socket.sendto(data, address)
+            except OSError:
+                pass
+
+    def next_due(self):
+        return self.queue[0][0] if self.queue else None
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+